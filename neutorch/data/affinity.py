@@ -0,0 +1,484 @@
+from functools import cache, cached_property
+from importlib.util import find_spec
+
+import numpy as np
+import torch
+
+# numba is only imported when the kernels are first used
+HAS_NUMBA = find_spec('numba') is not None
+
+
+# the affinity channels are z,y,x
+NUM_AFFINITY_CHANNELS = 3
+# the nearest neighbor affinity offsets, z,y,x
+DEFAULT_AFFINITY_OFFSETS = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+
+
+def _check_segmentation(seg: np.ndarray):
+    assert seg.ndim == 3, f'only support 3D segmentation, but got shape {seg.shape}'
+    assert np.issubdtype(seg.dtype, np.integer), \
+        f'segmentation should be integer, but got {seg.dtype}'
+
+
+def _seg_to_affs_numpy(seg: np.ndarray, output: np.ndarray):
+    # the affinity of a voxel is connecting it with the previous voxel
+    # along each axis. The first voxel of each axis has no affinity,
+    # so the affinity map is one voxel smaller than the segmentation.
+    current = seg[1:, 1:, 1:]
+    foreground = current > 0
+    connected = np.empty(current.shape, dtype=bool)
+    neighbors = (
+        seg[:-1, 1:, 1:],
+        seg[1:, :-1, 1:],
+        seg[1:, 1:, :-1],
+    )
+    for channel, neighbor in enumerate(neighbors):
+        np.equal(current, neighbor, out=connected)
+        np.logical_and(connected, foreground, out=connected)
+        np.copyto(output[channel], connected, casting='unsafe')
+    return output
+
+
+def _remove_contact_xy_numpy(seg: np.ndarray):
+    # the voxels are visited in C order and the contacts are removed in place,
+    # so a voxel only contacts the neighbors that are not removed yet.
+    # The rows are scanned one by one and vectorized over the sections.
+    sz, sy, sx = seg.shape
+    index = np.arange(sx)
+    left = np.zeros((sz, sx), dtype=bool)
+    up = np.zeros((sz, sx), dtype=bool)
+    for y in range(sy):
+        row = seg[:, y, :]
+        foreground = row > 0
+        # the contact with the previous voxel along x.
+        # it is not removed before the turn of this voxel.
+        np.not_equal(row[:, 1:], row[:, :-1], out=left[:, 1:])
+        left[:, 1:] &= foreground[:, 1:]
+        left[:, 1:] &= foreground[:, :-1]
+        # the contact with the previous row after its turn
+        if y > 0:
+            above = seg[:, y-1, :]
+            np.not_equal(above, row, out=up)
+            up &= foreground
+            up &= above > 0
+
+        # a voxel is removed in its turn if it contacts the previous row,
+        # or contacts the previous voxel which is not removed in its own turn.
+        # Along a chain of x contacts, the removal alternates after the
+        # last voxel whose removal does not depend on the previous one.
+        anchor = np.where(up | ~left, index, 0)
+        np.maximum.accumulate(anchor, axis=1, out=anchor)
+        removed = np.take_along_axis(up, anchor, axis=1)
+        removed ^= (index - anchor) % 2 == 1
+
+        if y > 0:
+            above[up] = 0
+        # the previous voxel is removed together with this one
+        left[:, 1:] &= ~removed[:, :-1]
+        row[:, :-1][left[:, 1:]] = 0
+        row[removed] = 0
+    return seg
+
+
+def _seg_to_affs_kernel(seg, output):
+    sz, sy, sx = seg.shape
+    for z in range(1, sz):
+        for y in range(1, sy):
+            for x in range(1, sx):
+                label = seg[z, y, x]
+                if label == 0:
+                    output[0, z-1, y-1, x-1] = 0
+                    output[1, z-1, y-1, x-1] = 0
+                    output[2, z-1, y-1, x-1] = 0
+                else:
+                    output[0, z-1, y-1, x-1] = label == seg[z-1, y, x]
+                    output[1, z-1, y-1, x-1] = label == seg[z, y-1, x]
+                    output[2, z-1, y-1, x-1] = label == seg[z, y, x-1]
+    return output
+
+
+def _remove_contact_xy_kernel(seg):
+    sz, sy, sx = seg.shape
+    for z in range(sz):
+        for y in range(sy):
+            for x in range(sx):
+                label = seg[z, y, x]
+                if label == 0:
+                    continue
+                if y > 0:
+                    neighbor = seg[z, y-1, x]
+                    if neighbor > 0 and neighbor != label:
+                        seg[z, y, x] = 0
+                        seg[z, y-1, x] = 0
+                if x > 0:
+                    neighbor = seg[z, y, x-1]
+                    if neighbor > 0 and neighbor != label:
+                        seg[z, y, x] = 0
+                        seg[z, y, x-1] = 0
+    return seg
+
+
+@cache
+def _numba_kernels():
+    """compile the kernels with numba on first use."""
+    import numba
+    jit = numba.njit(cache=True, nogil=True)
+    return jit(_seg_to_affs_kernel), jit(_remove_contact_xy_kernel)
+
+
+def _select_method(method: str):
+    if method == 'auto':
+        method = 'numba' if HAS_NUMBA else 'numpy'
+    if method == 'numba':
+        assert HAS_NUMBA, 'numba is not installed.'
+    elif method != 'numpy':
+        raise ValueError(f'only support auto, numpy and numba method, but got {method}')
+    return method
+
+
+def seg_to_affs(seg: np.ndarray, output: np.ndarray = None,
+        method: str = 'auto') -> np.ndarray:
+    """transform segmentation to nearest neighbor affinity map.
+    The semantics are the same with `reneu.lib.segmentation.seg_to_affs`.
+    The affinity of channel z, y and x at a voxel is 1 if the voxel is
+    not background and has the same label with the previous voxel along that axis.
+
+    Args:
+        seg (np.ndarray): 3D segmentation with any integer data type.
+        output (np.ndarray, optional): the output buffer with shape of
+            (3, Z-1, Y-1, X-1). Defaults to None, a float32 array will be created.
+        method (str, optional): auto, numpy or numba.
+            The auto method will use numba if it is installed. Defaults to 'auto'.
+
+    Returns:
+        np.ndarray: the affinity map with shape of (3, Z-1, Y-1, X-1).
+    """
+    _check_segmentation(seg)
+    shape = (NUM_AFFINITY_CHANNELS, *(s - 1 for s in seg.shape))
+    if output is None:
+        output = np.empty(shape, dtype=np.float32)
+    assert output.shape == shape, \
+        f'the output shape should be {shape}, but got {output.shape}'
+
+    if _select_method(method) == 'numba':
+        return _numba_kernels()[0](seg, output)
+    else:
+        return _seg_to_affs_numpy(seg, output)
+
+
+def remove_contact_xy(seg: np.ndarray, method: str = 'auto') -> np.ndarray:
+    """set the contacting voxels of different objects in each section to background.
+    The semantics are the same with `reneu.lib.segmentation.remove_contact_xy`.
+    The voxels are visited in C order. If the previous voxel along y or x 
+    is not background and has a different label, both of them are set 
+    to background in place, so the later voxels do not contact them anymore.
+
+    Args:
+        seg (np.ndarray): 3D segmentation with any integer data type.
+        method (str, optional): auto, numpy or numba. Defaults to 'auto'.
+
+    Returns:
+        np.ndarray: the segmentation itself.
+    """
+    _check_segmentation(seg)
+    if _select_method(method) == 'numba':
+        return _numba_kernels()[1](seg)
+    else:
+        return _remove_contact_xy_numpy(seg)
+
+
+def update_affinity_plane(affs: np.ndarray, seg: np.ndarray,
+        axis: int, loc: int):
+    """recompute the affinity of one plane from the segmentation.
+    It is used to correct the affinity after a spatial transform 
+    changes the neighbors of the voxels in this plane.
+
+    Args:
+        affs (np.ndarray): the affinity map with shape of (...,3,Z,Y,X). 
+            The affinity is aligned with the segmentation.
+        seg (np.ndarray): the segmentation with shape of (...,1,Z,Y,X).
+        axis (int): the spatial axis, 0 for z, 1 for y and 2 for x.
+        loc (int): the plane location along the axis.
+    """
+    assert affs.shape[-3:] == seg.shape[-3:]
+    assert 0 < loc < seg.shape[axis - 3]
+    current = [slice(None)] * seg.ndim
+    previous = [slice(None)] * seg.ndim
+    current[axis - 3] = loc
+    previous[axis - 3] = loc - 1
+    current = tuple(current)
+    current_seg = seg[current]
+    connected = np.logical_and(current_seg == seg[tuple(previous)], current_seg > 0)
+    # the channel axis is removed in the plane
+    affs[..., axis, :, :, :][current[:-4] + current[-3:]] = connected[..., 0, :, :]
+
+
+def _unpack_cutout(packed: np.ndarray, start: tuple, size: tuple) -> np.ndarray:
+    """unpack a region of an array bit packed along the last axis.
+
+    Args:
+        packed (np.ndarray): the packed array with shape of (...,Z,Y,ceil(X/8)).
+        start (tuple): the z,y,x start of the region.
+        size (tuple): the z,y,x size of the region.
+    """
+    z0, y0, x0 = start
+    sz, sy, sx = size
+    # only unpack the bytes covering the region
+    byte_start = x0 // 8
+    byte_stop = (x0 + sx + 7) // 8
+    unpacked = np.unpackbits(
+        packed[..., z0:z0+sz, y0:y0+sy, byte_start:byte_stop], axis=-1)
+    bit_start = x0 - byte_start * 8
+    return unpacked[..., bit_start : bit_start + sx]
+
+
+class PackedAffinityMap(object):
+    def __init__(self, packed: np.ndarray, shape: tuple,
+            contact: np.ndarray = None):
+        """nearest neighbor affinity map of a whole segmentation volume.
+        The affinity is bit packed along the x axis, 
+        so it takes 3 bits per voxel in memory.
+        The affinity is aligned with the segmentation, the affinity
+        at the first voxel of each axis is 0.
+
+        Args:
+            packed (np.ndarray): the bit packed affinity map with shape of (3,Z,Y,ceil(X/8)).
+            shape (tuple): the z,y,x shape of the segmentation.
+            contact (np.ndarray, optional): the bit packed mask of contacting voxels
+                removed before computing the affinity with shape of (Z,Y,ceil(X/8)).
+                Defaults to None, the contacts are not removed.
+        """
+        assert packed.dtype == np.uint8
+        assert packed.shape[:3] == (NUM_AFFINITY_CHANNELS, *shape[:2])
+        assert packed.shape[3] == (shape[2] + 7) // 8
+        if contact is not None:
+            assert contact.dtype == np.uint8
+            assert contact.shape == packed.shape[1:]
+        self.packed = packed
+        self.shape = tuple(shape)
+        self.contact = contact
+
+    @classmethod
+    def from_segmentation(cls, seg: np.ndarray, block_size: int = 32,
+            remove_contact: bool = False):
+        """compute the affinity map of a segmentation.
+        The segmentation is processed block by block along z axis
+        to limit the memory usage.
+
+        Args:
+            seg (np.ndarray): 3D segmentation with any integer data type.
+            block_size (int, optional): number of sections in a block. Defaults to 32.
+            remove_contact (bool, optional): remove the contacts in each section 
+                from a copy of every block before computing the affinity.
+                The segmentation is not modified. Defaults to False.
+        """
+        _check_segmentation(seg)
+        sz, sy, sx = seg.shape
+        packed = np.zeros((NUM_AFFINITY_CHANNELS, sz, sy, (sx + 7) // 8), dtype=np.uint8)
+        contact = np.zeros(packed.shape[1:], dtype=np.uint8) if remove_contact else None
+        previous = None
+        for z0 in range(0, sz, block_size):
+            z1 = min(z0 + block_size, sz)
+            current = seg[z0:z1]
+            if remove_contact:
+                # the contacts are removed section by section
+                current = remove_contact_xy(current.copy())
+                contact[z0:z1] = np.packbits(current != seg[z0:z1], axis=-1)
+            affs = np.zeros((NUM_AFFINITY_CHANNELS, *current.shape), dtype=bool)
+            if previous is not None:
+                np.equal(current[0], previous, out=affs[0, 0])
+            np.equal(current[1:], current[:-1], out=affs[0, 1:])
+            np.equal(current[:, 1:, :], current[:, :-1, :], out=affs[1, :, 1:, :])
+            np.equal(current[:, :, 1:], current[:, :, :-1], out=affs[2, :, :, 1:])
+            affs &= current > 0
+            packed[:, z0:z1] = np.packbits(affs, axis=-1)
+            previous = current[-1]
+        return cls(packed, seg.shape, contact=contact)
+
+    @cached_property
+    def nbytes(self):
+        nbytes = self.packed.nbytes
+        if self.contact is not None:
+            nbytes += self.contact.nbytes
+        return nbytes
+
+    def _check_region(self, start: tuple, size: tuple):
+        z0, y0, x0 = start
+        sz, sy, sx = size
+        assert z0 >= 0 and y0 >= 0 and x0 >= 0
+        assert z0 + sz <= self.shape[0]
+        assert y0 + sy <= self.shape[1]
+        assert x0 + sx <= self.shape[2]
+
+    def cutout(self, start: tuple, size: tuple) -> np.ndarray:
+        """unpack the affinity map of a region.
+
+        Args:
+            start (tuple): the z,y,x start of the region.
+            size (tuple): the z,y,x size of the region.
+
+        Returns:
+            np.ndarray: the affinity map with shape of (3, *size) and data type of uint8. 
+        """
+        self._check_region(start, size)
+        return _unpack_cutout(self.packed, start, size)
+
+    def contact_cutout(self, start: tuple, size: tuple) -> np.ndarray:
+        """unpack the mask of removed contacts in a region.
+
+        Args:
+            start (tuple): the z,y,x start of the region.
+            size (tuple): the z,y,x size of the region.
+
+        Returns:
+            np.ndarray: the boolean mask with shape of size.
+        """
+        assert self.contact is not None, 'the contacts are not removed.'
+        self._check_region(start, size)
+        return _unpack_cutout(self.contact, start, size).view(bool)
+
+
+def compact_labels(seg: np.ndarray, output: np.ndarray = None) -> np.ndarray:
+    """relabel the segmentation to consecutive integers.
+    The background 0 is kept and the smallest data type supported 
+    by pytorch is used, so the segmentation is cheap to transfer.
+
+    Args:
+        seg (np.ndarray): segmentation with any integer data type.
+        output (np.ndarray, optional): the output buffer. Defaults to None.
+
+    Returns:
+        np.ndarray: the relabeled segmentation.
+    """
+    uniques, inverse = np.unique(seg, return_inverse=True)
+    if uniques[0] != 0:
+        # make sure that no object is relabeled as background
+        inverse += 1
+    
+    dtype = compact_label_dtype(len(uniques) + 1)
+    if output is None:
+        output = np.empty(seg.shape, dtype=dtype)
+    assert output.shape == seg.shape
+    np.copyto(output, inverse.reshape(seg.shape), casting='unsafe')
+    return output
+
+
+def compact_label_dtype(num_labels: int) -> np.dtype:
+    """the smallest data type for a number of labels that could be
+    converted to pytorch tensor."""
+    for dtype in (np.uint8, np.int16, np.int32):
+        if num_labels <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _offset_slices(offset: tuple, shape: tuple):
+    # the affinity of a voxel connects it with the voxel minus the offset 
+    current = []
+    neighbor = []
+    for o, s in zip(offset, shape):
+        assert abs(o) < s, f'offset {offset} is too large for shape {shape}'
+        if o >= 0:
+            current.append(slice(o, s))
+            neighbor.append(slice(0, s - o))
+        else:
+            current.append(slice(0, s + o))
+            neighbor.append(slice(-o, s))
+    return tuple(current), tuple(neighbor)
+
+
+def seg_to_affs_tensor(seg: torch.Tensor,
+        offsets: tuple = DEFAULT_AFFINITY_OFFSETS,
+        dtype: torch.dtype = torch.float32) -> tuple:
+    """transform a batch of segmentation to affinity map with arbitrary offsets.
+    It runs on the device of the segmentation tensor, 
+    so the long range affinity could be computed in the GPU of trainer.
+    The nearest neighbor offsets give the same affinity with `seg_to_affs`
+    without cropping the first voxel of each axis.
+
+    Args:
+        seg (torch.Tensor): integer segmentation with shape of (N,1,Z,Y,X).
+        offsets (tuple, optional): the z,y,x offset of each affinity channel. 
+            Defaults to DEFAULT_AFFINITY_OFFSETS.
+        dtype (torch.dtype, optional): data type of the affinity map. Defaults to torch.float32.
+
+    Returns:
+        tuple: the affinity map and the validity mask with shape of (N,C,Z,Y,X).
+            The mask is 0 if the connected voxel is outside of the patch.
+    """
+    assert seg.ndim == 5
+    assert seg.shape[1] == 1
+    seg = seg[:, 0, ...]
+    shape = tuple(seg.shape[-3:])
+    affs = torch.zeros((seg.shape[0], len(offsets), *shape),
+        dtype=dtype, device=seg.device)
+    mask = torch.zeros_like(affs)
+    foreground = seg > 0
+
+    for channel, offset in enumerate(offsets):
+        assert len(offset) == 3
+        current, neighbor = _offset_slices(offset, shape)
+        current = (slice(None), *current)
+        neighbor = (slice(None), *neighbor)
+        connected = torch.logical_and(seg[current] == seg[neighbor], foreground[current])
+        affs[:, channel][current] = connected.to(dtype)
+        mask[:, channel][current] = 1
+    return affs, mask
+
+
+if __name__ == '__main__':
+    import time
+    from scipy.ndimage import zoom
+
+    def random_segmentation(size: int, object_size: int = 16):
+        rng = np.random.default_rng(0)
+        num = size // object_size
+        seeds = rng.integers(0, 2**40, size=(num, num, num), dtype=np.uint64)
+        seg = zoom(seeds, object_size, order=0)
+        # some background voxels
+        seg[rng.random(seg.shape) < 0.01] = 0
+        return seg
+
+    def timeit(func, *args):
+        start = time.time()
+        result = func(*args)
+        return result, time.time() - start
+
+    try:
+        from reneu.lib.segmentation import seg_to_affs as reneu_seg_to_affs
+        from reneu.lib.segmentation import remove_contact_xy as reneu_remove_contact_xy
+    except ImportError:
+        reneu_seg_to_affs = None
+        print('reneu is not installed, skip the comparison.')
+
+    methods = ['numpy']
+    if HAS_NUMBA:
+        methods.append('numba')
+        # compile it first
+        seg_to_affs(random_segmentation(32), method='numba')
+        remove_contact_xy(random_segmentation(32), method='numba')
+
+    for size in (128, 192, 256):
+        seg = random_segmentation(size)
+        print(f'\nsegmentation shape: {seg.shape}')
+        results = {}
+        for method in methods:
+            affs, elapsed = timeit(seg_to_affs, seg, None, method)
+            print(f'{method} seg_to_affs: {elapsed:.3f} secs')
+            cleaned, elapsed = timeit(remove_contact_xy, seg.copy(), method)
+            print(f'{method} remove_contact_xy: {elapsed:.3f} secs')
+            results[method] = (affs, cleaned)
+
+        if reneu_seg_to_affs is not None:
+            affs, elapsed = timeit(reneu_seg_to_affs, seg)
+            print(f'reneu seg_to_affs: {elapsed:.3f} secs')
+            cleaned = seg.copy()
+            _, elapsed = timeit(reneu_remove_contact_xy, cleaned)
+            print(f'reneu remove_contact_xy: {elapsed:.3f} secs')
+            results['reneu'] = (affs, cleaned)
+
+        reference_affs, reference_seg = results['numpy']
+        for method, (affs, cleaned) in results.items():
+            print(f'{method} is identical with numpy: ',
+                np.array_equal(affs, reference_affs) and \
+                    np.array_equal(cleaned, reference_seg))
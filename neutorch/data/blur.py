@@ -0,0 +1,133 @@
+from typing import Union
+
+import numpy as np
+
+
+# the separable convolution cost grows linearly with sigma
+# while the FFT cost is almost independent of sigma.
+FFT_SIGMA_THRESHOLD = 6.
+# the same with scipy.ndimage.gaussian_filter
+DEFAULT_TRUNCATE = 4.
+
+
+def _normalize_sigma(sigma: Union[float, tuple], axes: tuple):
+    if np.isscalar(sigma):
+        sigma = (sigma,) * len(axes)
+    assert len(sigma) == len(axes), \
+        f'sigma {sigma} should have the same length with axes {axes}'
+    return tuple(float(s) for s in sigma)
+
+
+def _separable_blur(arr: np.ndarray, sigma: tuple, axes: tuple,
+        output: np.ndarray, truncate: float):
+    # scipy is only imported when the first patch is blurred
+    from scipy.ndimage import gaussian_filter1d
+
+    # the first pass reads from input and writes to output
+    # the following passes are in place in output
+    source = arr
+    for s, axis in zip(sigma, axes):
+        if s <= 0.:
+            continue
+        gaussian_filter1d(source, s, axis=axis, output=output,
+            mode='reflect', truncate=truncate)
+        source = output
+
+    if source is arr and output is not arr:
+        # all the sigma is zero
+        output[...] = arr
+    return output
+
+
+def _fft_blur(arr: np.ndarray, sigma: tuple, axes: tuple,
+        output: np.ndarray, truncate: float):
+    from scipy import fft
+    from scipy.ndimage import fourier_gaussian
+
+    # pad with reflection to get the same boundary handling with
+    # the separable convolution rather than the periodic one.
+    pad_width = [(0, 0)] * arr.ndim
+    for s, axis in zip(sigma, axes):
+        # the reflection could not be larger than the array size
+        width = min(int(truncate * s + 0.5), arr.shape[axis] - 1)
+        pad_width[axis] = (width, width)
+    # scipy reflect mode is numpy symmetric mode
+    padded = np.pad(arr.astype(output.dtype, copy=False), pad_width, mode='symmetric')
+
+    real_axis = axes[-1]
+    spectrum = fft.rfftn(padded, axes=axes, workers=-1)
+    full_sigma = [0.] * arr.ndim
+    for s, axis in zip(sigma, axes):
+        full_sigma[axis] = s
+    # fourier_gaussian requires the length of the real axis before rfft
+    spectrum = fourier_gaussian(spectrum, full_sigma,
+        n=padded.shape[real_axis], axis=real_axis, output=spectrum)
+    padded = fft.irfftn(spectrum, s=[padded.shape[a] for a in axes],
+        axes=axes, workers=-1)
+
+    slices = tuple(slice(p0, p0 + n) for (p0, _), n in zip(pad_width, arr.shape))
+    output[...] = padded[slices]
+    return output
+
+
+def gaussian_blur(arr: np.ndarray, sigma: Union[float, tuple],
+        axes: tuple = (-3, -2, -1), output: np.ndarray = None,
+        truncate: float = DEFAULT_TRUNCATE,
+        method: str = 'auto') -> np.ndarray:
+    """Gaussian blur along some axes only.
+    The batch and channel axes of a patch should not be blurred.
+
+    Args:
+        arr (np.ndarray): the input array.
+        sigma (Union[float, tuple]): the sigma of each axis.
+        axes (tuple, optional): the axes to blur. Defaults to (-3, -2, -1).
+        output (np.ndarray, optional): the output buffer.
+            It could be the input array itself for in place blurring.
+            Defaults to None, a float32 array will be created.
+        truncate (float, optional): truncate the kernel at this many sigmas. Defaults to DEFAULT_TRUNCATE.
+        method (str, optional): auto, separable or fft.
+            The auto method use separable convolution for small sigma and FFT for large sigma.
+            Defaults to 'auto'.
+
+    Returns:
+        np.ndarray: the blurred array.
+    """
+    axes = tuple(a % arr.ndim for a in axes)
+    assert len(set(axes)) == len(axes)
+    sigma = _normalize_sigma(sigma, axes)
+
+    if output is None:
+        output = np.empty(arr.shape, dtype=np.float32)
+    assert output.shape == arr.shape
+    assert np.issubdtype(output.dtype, np.floating)
+
+    if method == 'auto':
+        if max(sigma) > FFT_SIGMA_THRESHOLD:
+            method = 'fft'
+        else:
+            method = 'separable'
+
+    if method == 'separable':
+        return _separable_blur(arr, sigma, axes, output, truncate)
+    elif method == 'fft':
+        # skip the axes without blurring
+        blur_axes = tuple(a for a, s in zip(axes, sigma) if s > 0.)
+        blur_sigma = tuple(s for s in sigma if s > 0.)
+        if len(blur_axes) == 0:
+            output[...] = arr
+            return output
+        return _fft_blur(arr, blur_sigma, blur_axes, output, truncate)
+    else:
+        raise ValueError(f'only support auto, separable and fft method, but got {method}')
+
+
+def gaussian_blur_2d(arr: np.ndarray, sigma: Union[float, tuple],
+        output: np.ndarray = None, **kwargs) -> np.ndarray:
+    """blur inside each section, the last two axes."""
+    return gaussian_blur(arr, sigma, axes=(-2, -1), output=output, **kwargs)
+
+
+def gaussian_blur_3d(arr: np.ndarray, sigma: Union[float, tuple],
+        output: np.ndarray = None, **kwargs) -> np.ndarray:
+    """blur the spatial axes, the last three axes."""
+    return gaussian_blur(arr, sigma, axes=(-3, -2, -1), output=output, **kwargs)
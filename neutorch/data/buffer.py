@@ -0,0 +1,135 @@
+import threading
+import weakref
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+# maximum number of free buffers for each shape and data type
+DEFAULT_MAX_FREE_BUFFERS = 8
+
+
+class BufferPool(object):
+    def __init__(self, max_free_buffers: int = DEFAULT_MAX_FREE_BUFFERS):
+        """Preallocated array buffers keyed by shape and data type.
+        The patch cutout, the transforms and the final contiguous copy
+        write into the buffers acquired from this pool.
+        After the arrays are collated to a batch, they are released
+        back to the pool and reused for the next patch.
+
+        Args:
+            max_free_buffers (int, optional): maximum number of free buffers for
+                each shape and data type. Defaults to DEFAULT_MAX_FREE_BUFFERS.
+        """
+        assert max_free_buffers > 0
+        self.max_free_buffers = max_free_buffers
+        self._free = defaultdict(list)
+        # the buffers acquired from this pool. use the data pointer as key.
+        # the buffers that are dropped without releasing will be 
+        # freed by the garbage collector and removed automatically.
+        self._owned = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(shape: tuple, dtype: np.dtype):
+        return (tuple(int(s) for s in shape), np.dtype(dtype).str)
+
+    def acquire(self, shape: tuple, dtype: np.dtype) -> np.ndarray:
+        """get a C contiguous buffer. The content is not initialized.
+
+        Args:
+            shape (tuple): shape of the array.
+            dtype (np.dtype): data type of the array.
+        """
+        key = self._key(shape, dtype)
+        with self._lock:
+            if len(self._free[key]) > 0:
+                return self._free[key].pop()
+
+        buf = np.empty(key[0], dtype=dtype)
+        with self._lock:
+            self._owned[buf.ctypes.data] = buf
+        return buf
+
+    def release(self, arr) -> bool:
+        """return the buffer of an array or tensor to the pool.
+        The array should not be used anymore after releasing.
+        Arrays that are not acquired from this pool are ignored.
+
+        Args:
+            arr (np.ndarray | torch.Tensor): the buffer or a view of it.
+
+        Returns:
+            bool: the buffer is returned to the pool or not.
+        """
+        if torch.is_tensor(arr):
+            if arr.device.type != 'cpu':
+                return False
+            pointer = arr.data_ptr()
+        else:
+            # find the array owning the memory
+            while isinstance(arr.base, np.ndarray):
+                arr = arr.base
+            pointer = arr.ctypes.data
+
+        with self._lock:
+            buf = self._owned.get(pointer, None)
+            if buf is None:
+                return False
+            key = self._key(buf.shape, buf.dtype)
+            free = self._free[key]
+            if any(b is buf for b in free):
+                # already released
+                return False
+            if len(free) >= self.max_free_buffers:
+                # let the garbage collector free it
+                return False
+            free.append(buf)
+        return True
+
+    def owns(self, arr: np.ndarray) -> bool:
+        """the array is a whole C contiguous buffer acquired from this pool."""
+        if not arr.flags.c_contiguous:
+            return False
+        with self._lock:
+            buf = self._owned.get(arr.ctypes.data, None)
+        return buf is not None and buf.shape == arr.shape and \
+            buf.dtype == arr.dtype
+
+    def ascontiguousarray(self, arr: np.ndarray) -> np.ndarray:
+        """make sure that the array is a C contiguous buffer of this pool.
+        If a copy is made, the original buffer is released.
+        """
+        if self.owns(arr):
+            return arr
+        buf = self.copy(arr)
+        self.release(arr)
+        return buf
+
+    def copy(self, arr: np.ndarray, dtype: np.dtype = None) -> np.ndarray:
+        """copy an array to a C contiguous buffer of this pool.
+
+        Args:
+            arr (np.ndarray): the source array.
+            dtype (np.dtype, optional): the data type of the copy. Defaults to None.
+
+        Returns:
+            np.ndarray: the buffer with the data copied.
+        """
+        if dtype is None:
+            dtype = arr.dtype
+        buf = self.acquire(arr.shape, dtype)
+        np.copyto(buf, arr, casting='unsafe')
+        return buf
+
+    def __len__(self):
+        return len(self._owned)
+
+
+# the buffer pool is shared by all the threads in current process.
+# every data loading worker process has its own pool.
+_buffer_pool = BufferPool()
+
+def get_buffer_pool() -> BufferPool:
+    return _buffer_pool
@@ -0,0 +1,329 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+import click
+import numpy as np
+from yacs.config import CfgNode
+
+from chunkflow.lib.cartesian_coordinate import BoundingBoxes
+from chunkflow.lib.synapses import Synapses
+
+from neutorch.data.residency import LazySample
+
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/neutorch')
+DEFAULT_SYNAPSE_CATALOG_PATH = os.path.join(DEFAULT_CACHE_DIR, 'synapse_catalog.npz')
+
+
+def _file_key(path: str):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _concatenate(arrays: list, ncol: int, dtype: np.dtype):
+    arrays = [a for a in arrays if a is not None]
+    if len(arrays) == 0:
+        return np.zeros((0, ncol), dtype=dtype)
+    return np.concatenate(arrays, axis=0)
+
+
+def _indptr(arrays: list):
+    indptr = np.zeros((len(arrays) + 1,), dtype=np.int64)
+    np.cumsum([0 if a is None else len(a) for a in arrays], out=indptr[1:])
+    return indptr
+
+
+class SynapseCatalog(object):
+    def __init__(self, path: str = DEFAULT_SYNAPSE_CATALOG_PATH):
+        """A consolidated binary cache of parsed synapse files.
+        The entries are keyed by the file path, modification time and size,
+        so a modified file will be parsed again.
+        Only the presynapse and postsynapse coordinates are cached.
+
+        Args:
+            path (str, optional): the catalog file path. Defaults to DEFAULT_SYNAPSE_CATALOG_PATH.
+        """
+        self.path = path
+        # file path -> (mtime, size, pre, post, resolution)
+        self.entries = {}
+        self.modified = False
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with np.load(self.path) as data:
+                paths = data['paths']
+                pre_indptr = data['pre_indptr']
+                post_indptr = data['post_indptr']
+                pre = data['pre']
+                post = data['post']
+                resolutions = data['resolutions']
+                for idx, path in enumerate(paths):
+                    entry_pre = pre[pre_indptr[idx] : pre_indptr[idx+1]]
+                    if data['has_post'][idx]:
+                        entry_post = post[post_indptr[idx] : post_indptr[idx+1]]
+                    else:
+                        entry_post = None
+                    resolution = resolutions[idx]
+                    if np.any(np.isnan(resolution)):
+                        resolution = None
+                    self.entries[str(path)] = (
+                        int(data['mtimes'][idx]), int(data['sizes'][idx]),
+                        entry_pre, entry_post, resolution)
+        except (OSError, KeyError, ValueError) as err:
+            print(f'ignore the broken synapse catalog {self.path}: {err}')
+            self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load_synapses(self, path: str) -> Synapses:
+        """load synapses from the catalog or parse the file if the entry is stale.
+
+        Args:
+            path (str): the synapse file path.
+
+        Returns:
+            Synapses: the synapses. The arrays are copies and could be modified.
+                None if the file is empty.
+        """
+        path = os.path.abspath(path)
+        mtime, size = _file_key(path)
+        with self._lock:
+            entry = self.entries.get(path, None)
+
+        if entry is not None and entry[0] == mtime and entry[1] == size:
+            pre, post, resolution = entry[2:]
+        else:
+            synapses = Synapses.from_file(path)
+            if synapses is None:
+                return None
+            pre, post = synapses.pre, synapses.post
+            resolution = None if synapses.resolution is None else \
+                np.asarray(synapses.resolution, dtype=np.float64)
+            with self._lock:
+                self.entries[path] = (mtime, size, pre.copy(),
+                    None if post is None else post.copy(), resolution)
+                self.modified = True
+            return synapses
+
+        return Synapses(pre.copy(), post=None if post is None else post.copy(),
+            resolution=resolution)
+
+    def save(self):
+        """write the catalog if there is any new entry.
+        The file is replaced atomically, so the concurrent readers will
+        always get a complete catalog.
+        """
+        if self.path is None or not self.modified:
+            return
+        with self._lock:
+            paths = sorted(self.entries.keys())
+            entries = [self.entries[path] for path in paths]
+            self.modified = False
+
+        pre_list = [entry[2] for entry in entries]
+        post_list = [entry[3] for entry in entries]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path,
+            paths=np.asarray(paths, dtype=str),
+            mtimes=np.asarray([entry[0] for entry in entries], dtype=np.int64),
+            sizes=np.asarray([entry[1] for entry in entries], dtype=np.int64),
+            has_post=np.asarray([post is not None for post in post_list], dtype=bool),
+            pre_indptr=_indptr(pre_list),
+            pre=_concatenate(pre_list, 3, np.int64),
+            post_indptr=_indptr(post_list),
+            post=_concatenate(post_list, 4, np.int64),
+            resolutions=np.asarray([np.full((3,), np.nan) if entry[4] is None \
+                else entry[4] for entry in entries], dtype=np.float64).reshape(-1, 3),
+        )
+        os.replace(tmp_path, self.path)
+
+
+def sample_metadata(sample, class_stats: bool = False) -> dict:
+    """the metadata of a loaded sample to construct it lazily.
+
+    Args:
+        sample (AbstractSample): the loaded sample.
+        class_stats (bool, optional): compute the class weights of the block
+            class index. It reads the whole label if it was not cached.
+            Defaults to False.
+
+    Returns:
+        dict: the sampling weight, length and class weights.
+    """
+    sampling_weight = sample.sampling_weight
+    class_weights = None
+    if class_stats:
+        block_class_index = getattr(sample, 'block_class_index', None)
+        if block_class_index is not None:
+            class_weights = [block_class_index.class_weight(k) \
+                for k in range(block_class_index.num_classes)]
+    return {
+        'sampling_weight': None if sampling_weight is None else float(sampling_weight),
+        'length': int(len(sample)),
+        'class_weights': class_weights,
+    }
+
+
+def _candidate_blocks(sample) -> np.ndarray:
+    """the candidate blocks of a sample drawing patches in the blocks inside mask."""
+    if not hasattr(sample, 'candidate_block_bounding_boxes') or \
+            getattr(sample, 'mask_coverage_threshold', None) is not None:
+        return None
+    return sample.candidate_block_bounding_boxes.array.astype(np.int64)
+
+
+def _with_candidate_blocks(loader, candidate_blocks: np.ndarray):
+    sample = loader()
+    # skip searching the blocks inside the mask
+    sample.candidate_block_bounding_boxes = BoundingBoxes.from_array(
+        candidate_blocks.copy())
+    return sample
+
+
+class SampleCatalog(object):
+    def __init__(self, configs: dict, entries: dict, 
+            candidate_blocks: dict = None, key: str = ''):
+        """A compiled catalog of sample configurations and metadata.
+        The datasets construct lazy samples from it without parsing the
+        sample config files or opening any volume. 
+        The volumes are only opened when the sample is first drawn.
+
+        Args:
+            configs (dict): sample name -> the sample config node.
+            entries (dict): sample name -> the metadata from sample_metadata.
+            candidate_blocks (dict, optional): sample name -> the candidate block 
+                bounding boxes with shape of (N, 6). Defaults to None.
+            key (str, optional): the options used to compute the metadata.
+                A different key means that the catalog is stale. Defaults to ''.
+        """
+        assert set(configs.keys()) == set(entries.keys())
+        self.configs = configs
+        self.entries = entries
+        if candidate_blocks is None:
+            candidate_blocks = {}
+        self.candidate_blocks = candidate_blocks
+        self.key = key
+
+    @classmethod
+    def compile(cls, loaders: dict, key: str = '', class_stats: bool = False,
+            num_threads: int = None):
+        """load every sample once and record its metadata.
+
+        Args:
+            loaders (dict): sample name -> (config node, function to construct the sample).
+            key (str, optional): the options used to compute the metadata. Defaults to ''.
+            class_stats (bool, optional): record the class weights. Defaults to False.
+            num_threads (int, optional): the number of samples loaded concurrently.
+                Defaults to None, the number of CPUs.
+        """
+        if num_threads is None:
+            num_threads = os.cpu_count()
+
+        def compile_sample(name: str):
+            start = time()
+            sample = loaders[name][1]()
+            entry = sample_metadata(sample, class_stats=class_stats)
+            candidate_blocks = _candidate_blocks(sample)
+            print(f'compiled sample {name} in {time() - start:.1f} seconds.')
+            return entry, candidate_blocks
+
+        names = sorted(loaders.keys())
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+            results = list(executor.map(compile_sample, names))
+
+        configs = {name: loaders[name][0] for name in names}
+        entries = {name: result[0] for name, result in zip(names, results)}
+        candidate_blocks = {name: result[1] for name, result in zip(names, results) \
+            if result[1] is not None}
+        return cls(configs, entries, candidate_blocks=candidate_blocks, key=key)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            names = [str(name) for name in data['candidate_names']]
+            indptr = data['candidate_indptr']
+            blocks = data['candidate_blocks']
+        candidate_blocks = {name: blocks[indptr[idx] : indptr[idx+1]] \
+            for idx, name in enumerate(names)}
+        return cls(meta['configs'], meta['entries'],
+            candidate_blocks=candidate_blocks, key=meta['key'])
+
+    def save(self, path: str):
+        """write the catalog. The file is replaced atomically."""
+        names = sorted(self.candidate_blocks.keys())
+        blocks = [self.candidate_blocks[name] for name in names]
+        meta = {'configs': self.configs, 'entries': self.entries, 'key': self.key}
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path,
+            meta=np.asarray(json.dumps(meta)),
+            candidate_names=np.asarray(names, dtype=str),
+            candidate_indptr=_indptr(blocks),
+            candidate_blocks=_concatenate(blocks, 6, np.int64),
+        )
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name: str):
+        return name in self.entries
+
+    @property
+    def sample_configs(self) -> CfgNode:
+        return CfgNode(self.configs)
+
+    def lazy_sample(self, name: str, loader) -> LazySample:
+        """a sample loaded on first use with the recorded metadata.
+
+        Args:
+            name (str): the sample name.
+            loader (callable): construct the sample.
+
+        Returns:
+            LazySample: the sample. 
+        """
+        assert name in self.entries, f'sample {name} is not in the catalog.'
+        entry = self.entries[name]
+        candidate_blocks = self.candidate_blocks.get(name, None)
+        if candidate_blocks is not None:
+            loader = partial(_with_candidate_blocks, loader, candidate_blocks)
+        return LazySample(loader,
+            sampling_weight=entry['sampling_weight'],
+            length=entry['length'],
+            class_weights=entry['class_weights'])
+
+
+@click.command()
+@click.option('--config-file', '-c',
+    type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True, resolve_path=True),
+    required=True, help='the training configuration file.'
+)
+@click.option('--output-path', '-o',
+    type=click.Path(dir_okay=False, file_okay=True, writable=True, resolve_path=True),
+    required=True, help='the catalog file. It should be set as train.sample_catalog.'
+)
+@click.option('--num-threads', '-t',
+    type=click.INT, default=None, 
+    help='the number of samples loaded concurrently. Defaults to the number of CPUs.'
+)
+def main(config_file: str, output_path: str, num_threads: int):
+    from neutorch.data.dataset import load_cfg, compile_sample_catalog
+
+    cfg = load_cfg(config_file)
+    start = time()
+    catalog = compile_sample_catalog(cfg, num_threads=num_threads)
+    catalog.save(output_path)
+    print(f'compiled {len(catalog)} samples to {output_path} in {time() - start:.1f} seconds.')
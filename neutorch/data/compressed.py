@@ -0,0 +1,323 @@
+import threading
+import zlib
+from collections import OrderedDict
+from functools import cached_property
+from itertools import product
+from time import time
+
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.buffer import get_buffer_pool
+
+
+DEFAULT_BLOCK_SIZE = (64, 64, 64)
+# number of decoded blocks kept in RAM
+DEFAULT_CACHE_SIZE = 64
+# zlib level 1 is fast and good enough for the block sizes
+ZLIB_LEVEL = 1
+
+
+def _bit_width(num: int) -> int:
+    """the number of bits to store a local label index."""
+    if num <= 1:
+        return 0
+    for bits in (1, 2, 4, 8, 16, 32):
+        if num <= 2 ** bits:
+            return bits
+    raise ValueError(f'too many labels in a block: {num}')
+
+
+def pack_bits(values: np.ndarray, bits: int) -> bytes:
+    """pack small unsigned integers into bytes.
+
+    Args:
+        values (np.ndarray): the integers smaller than 2**bits.
+        bits (int): 1, 2, 4, 8, 16 or 32.
+
+    Returns:
+        bytes: the packed bytes.
+    """
+    values = values.ravel()
+    if bits >= 8:
+        return values.astype(f'<u{bits//8}').tobytes()
+    per_byte = 8 // bits
+    padded = np.zeros((-(-values.size // per_byte) * per_byte,), dtype=np.uint8)
+    padded[:values.size] = values
+    padded = padded.reshape(-1, per_byte)
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    return np.bitwise_or.reduce(padded << shifts, axis=1).astype(np.uint8).tobytes()
+
+
+def unpack_bits(data: bytes, bits: int, num: int) -> np.ndarray:
+    """the inverse of pack_bits.
+
+    Args:
+        data (bytes): the packed bytes.
+        bits (int): 1, 2, 4, 8, 16 or 32.
+        num (int): the number of integers.
+
+    Returns:
+        np.ndarray: the integers.
+    """
+    if bits >= 8:
+        return np.frombuffer(data, dtype=f'<u{bits//8}', count=num)
+    packed = np.frombuffer(data, dtype=np.uint8)
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    values = (packed[:, np.newaxis] >> shifts) & np.uint8(2 ** bits - 1)
+    return values.ravel()[:num]
+
+
+class CompressedChunk(object):
+    def __init__(self, blocks: list, shape: tuple, dtype: np.dtype,
+            block_size: tuple = DEFAULT_BLOCK_SIZE,
+            voxel_offset: Cartesian = None,
+            voxel_size: Cartesian = None,
+            layer_type: str = None,
+            cache_size: int = DEFAULT_CACHE_SIZE):
+        """A chunk stored as independently compressed blocks in RAM.
+        The segmentation blocks are relabeled to local indices and bit packed.
+        The other blocks are compressed with zlib.
+        A cutout only decompresses the overlapping blocks.
+        It could be used as an image or label of samples.
+
+        Args:
+            blocks (list): the encoded blocks in C order of the block grid.
+            shape (tuple): the shape of the whole chunk.
+            dtype (np.dtype): the data type of the whole chunk.
+            block_size (tuple, optional): the block size. Defaults to DEFAULT_BLOCK_SIZE.
+            voxel_offset (Cartesian, optional): the global offset. Defaults to None.
+            voxel_size (Cartesian, optional): the voxel size. Defaults to None.
+            layer_type (str, optional): the layer type of chunk. Defaults to None.
+            cache_size (int, optional): the number of decoded blocks to cache.
+                Defaults to DEFAULT_CACHE_SIZE.
+        """
+        assert len(shape) >= 3
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.block_size = Cartesian.from_collection(block_size)
+        self.grid_shape = tuple(-(-s // b) for s, b in zip(
+            self.shape[-3:], self.block_size))
+        assert len(blocks) == np.prod(self.grid_shape)
+        self.blocks = blocks
+
+        if voxel_offset is None:
+            voxel_offset = Cartesian(0, 0, 0)
+        self.voxel_offset = Cartesian.from_collection(voxel_offset)
+        if voxel_size is not None:
+            voxel_size = Cartesian.from_collection(voxel_size)
+        self.voxel_size = voxel_size
+        self.layer_type = layer_type
+
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_chunk(cls, chunk: Chunk,
+            block_size: tuple = DEFAULT_BLOCK_SIZE,
+            is_segmentation: bool = None,
+            cache_size: int = DEFAULT_CACHE_SIZE):
+        """compress a chunk.
+
+        Args:
+            chunk (Chunk): the chunk to compress.
+            block_size (tuple, optional): the block size. Defaults to DEFAULT_BLOCK_SIZE.
+            is_segmentation (bool, optional): encode the blocks as segmentation or not.
+                Defaults to None, integer arrays except uint8 are segmentation.
+            cache_size (int, optional): the number of decoded blocks to cache.
+                Defaults to DEFAULT_CACHE_SIZE.
+        """
+        arr = chunk.array
+        if is_segmentation is None:
+            is_segmentation = np.issubdtype(arr.dtype, np.integer) and \
+                arr.dtype != np.uint8
+        block_size = Cartesian.from_collection(block_size)
+        grid_shape = tuple(-(-s // b) for s, b in zip(arr.shape[-3:], block_size))
+
+        blocks = []
+        for gz, gy, gx in product(*[range(g) for g in grid_shape]):
+            slices = tuple(slice(i * b, (i + 1) * b) for i, b in zip(
+                (gz, gy, gx), block_size))
+            block = arr[(Ellipsis, *slices)]
+            if is_segmentation:
+                blocks.append(cls._encode_segmentation(block))
+            else:
+                blocks.append(cls._encode_bytes(block))
+
+        return cls(blocks, arr.shape, arr.dtype, block_size=block_size,
+            voxel_offset=chunk.voxel_offset, voxel_size=chunk.voxel_size,
+            layer_type=chunk.layer_type, cache_size=cache_size)
+
+    @staticmethod
+    def _encode_segmentation(block: np.ndarray):
+        labels, indices = np.unique(block, return_inverse=True)
+        bits = _bit_width(len(labels))
+        if bits == 0:
+            # constant block
+            return ('constant', block.shape, labels[0])
+        data = zlib.compress(pack_bits(indices, bits), ZLIB_LEVEL)
+        return ('segmentation', block.shape, labels, bits, data)
+
+    @staticmethod
+    def _encode_bytes(block: np.ndarray):
+        data = zlib.compress(np.ascontiguousarray(block).tobytes(), ZLIB_LEVEL)
+        return ('bytes', block.shape, data)
+
+    def _decode(self, block_index: int) -> np.ndarray:
+        encoded = self.blocks[block_index]
+        kind, shape = encoded[:2]
+        if kind == 'constant':
+            # a read only view without allocation
+            return np.broadcast_to(encoded[2], shape)
+        elif kind == 'segmentation':
+            labels, bits, data = encoded[2:]
+            indices = unpack_bits(zlib.decompress(data), bits, int(np.prod(shape)))
+            return labels[indices].reshape(shape)
+        elif kind == 'bytes':
+            return np.frombuffer(zlib.decompress(encoded[2]),
+                dtype=self.dtype).reshape(shape)
+        else:
+            raise ValueError(f'unknown block encoding: {kind}')
+
+    def decode_block(self, block_index: int) -> np.ndarray:
+        """the decoded block with the cache. The block should not be modified."""
+        with self._lock:
+            block = self._cache.get(block_index, None)
+            if block is not None:
+                self._cache.move_to_end(block_index)
+                return block
+
+        block = self._decode(block_index)
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[block_index] = block
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return block
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def bbox(self) -> BoundingBox:
+        return BoundingBox.from_delta(self.voxel_offset, self.shape[-3:])
+
+    @property
+    def bounding_box(self) -> BoundingBox:
+        return self.bbox
+
+    @property
+    def start(self) -> Cartesian:
+        return self.bbox.start
+
+    @property
+    def stop(self) -> Cartesian:
+        return self.bbox.stop
+
+    @cached_property
+    def encoded_nbytes(self) -> int:
+        """the number of bytes of compressed blocks."""
+        nbytes = 0
+        for encoded in self.blocks:
+            if encoded[0] == 'constant':
+                nbytes += encoded[2].nbytes
+            elif encoded[0] == 'segmentation':
+                nbytes += encoded[2].nbytes + len(encoded[4])
+            else:
+                nbytes += len(encoded[2])
+        return nbytes
+
+    @property
+    def nbytes(self) -> int:
+        """the number of bytes in RAM, including the cached decoded blocks."""
+        with self._lock:
+            # the constant blocks are broadcasted views without allocation
+            cached = sum(block.nbytes for block in self._cache.values() \
+                if 0 not in block.strides)
+        return self.encoded_nbytes + cached
+
+    @property
+    def array(self) -> np.ndarray:
+        """decompress the whole chunk."""
+        return self.cutout(self.bbox).array
+
+    def cutout(self, bbox: BoundingBox) -> Chunk:
+        """cutout a region of interest and only decompress the overlapping blocks.
+        The array is acquired from the buffer pool.
+
+        Args:
+            bbox (BoundingBox): the global bounding box inside the chunk.
+
+        Returns:
+            Chunk: the cutout.
+        """
+        start = np.asarray(bbox.start, dtype=np.int64) - np.asarray(self.voxel_offset)
+        stop = np.asarray(bbox.stop, dtype=np.int64) - np.asarray(self.voxel_offset)
+        assert np.all(start >= 0) and np.all(stop <= self.shape[-3:]), \
+            f'cutout {bbox} is outside of chunk {self.bbox}'
+
+        shape = (*self.shape[:-3], *(stop - start))
+        # the 5D buffer makes the expanded patch owned by the buffer pool
+        buf = get_buffer_pool().acquire(
+            (1,) * max(5 - len(shape), 0) + shape, self.dtype)
+        arr = buf.reshape(shape)
+
+        block_size = np.asarray(self.block_size)
+        block_start = start // block_size
+        block_stop = -(-stop // block_size)
+        for grid_index in product(*[range(b0, b1) for b0, b1 in zip(
+                block_start, block_stop)]):
+            grid_index = np.asarray(grid_index)
+            block = self.decode_block(int(np.ravel_multi_index(
+                grid_index, self.grid_shape)))
+            block_offset = grid_index * block_size
+            # the intersection in chunk coordinate
+            inter_start = np.maximum(start, block_offset)
+            inter_stop = np.minimum(stop, block_offset + block.shape[-3:])
+            src = tuple(slice(b, e) for b, e in zip(
+                inter_start - block_offset, inter_stop - block_offset))
+            dst = tuple(slice(b, e) for b, e in zip(
+                inter_start - start, inter_stop - start))
+            arr[(Ellipsis, *dst)] = block[(Ellipsis, *src)]
+
+        return Chunk(arr, voxel_offset=bbox.start, voxel_size=self.voxel_size,
+            layer_type=self.layer_type)
+
+
+if __name__ == '__main__':
+    np.random.seed(0)
+    seg = np.zeros((256, 256, 256), dtype=np.uint64)
+    for _ in range(200):
+        z, y, x = np.random.randint(0, 224, size=3)
+        seg[z:z+32, y:y+32, x:x+32] = np.random.randint(1, 2**40)
+    image = np.random.randint(0, 255, size=seg.shape, dtype=np.uint8)
+    image = np.sort(image, axis=-1)
+
+    for name, arr in (('segmentation', seg), ('image', image)):
+        start = time()
+        compressed = CompressedChunk.from_chunk(Chunk(arr))
+        elapsed = time() - start
+        print(f'{name}: {arr.nbytes / 1e6:.1f} MB -> {compressed.nbytes / 1e6:.1f} MB in {elapsed:.2f} s')
+        assert np.array_equal(compressed.array, arr)
+
+        bbox = BoundingBox.from_delta(Cartesian(64, 32, 17), Cartesian(128, 128, 128))
+        start = time()
+        for _ in range(10):
+            patch = compressed.cutout(bbox)
+            assert np.array_equal(patch.array, arr[bbox.slices])
+            get_buffer_pool().release(patch.array)
+        print(f'cutout a patch of 128^3 in {(time()-start)/10:.3f} s')
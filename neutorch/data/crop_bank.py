@@ -0,0 +1,156 @@
+import os
+from typing import List
+
+import click
+import numpy as np
+
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.points import PointGridIndex
+
+
+IMAGE_FILE_NAME = 'images.npy'
+TABLE_FILE_NAME = 'table.npz'
+
+
+class CropBank(object):
+    def __init__(self, images: np.ndarray, offsets: np.ndarray,
+            point_indptr: np.ndarray, points: np.ndarray):
+        """A bank of fixed size image crops centered on synapses.
+        All the crops are stored in one contiguous array,
+        so it could be memory mapped and every crop is one read.
+
+        Args:
+            images (np.ndarray): image crops with shape of (N, V, Z, Y, X).
+                V is the number of image versions.
+            offsets (np.ndarray): the global start coordinate of every crop, (N, 3).
+            point_indptr (np.ndarray): the points inside crop i are
+                points[point_indptr[i] : point_indptr[i+1]].
+            points (np.ndarray): the annotated points relative to the crop start, (M, 3).
+        """
+        assert images.ndim == 5
+        assert offsets.shape == (images.shape[0], 3)
+        assert point_indptr.shape == (images.shape[0] + 1,)
+        assert points.ndim == 2 and points.shape[1] == 3
+        self.images = images
+        self.offsets = offsets
+        self.point_indptr = point_indptr
+        self.points = points
+
+    @classmethod
+    def from_dir(cls, path: str):
+        """open a crop bank with memory mapping.
+
+        Args:
+            path (str): the directory of crop bank.
+        """
+        images = np.load(os.path.join(path, IMAGE_FILE_NAME), mmap_mode='r')
+        with np.load(os.path.join(path, TABLE_FILE_NAME)) as table:
+            return cls(images, table['offsets'],
+                table['point_indptr'], table['points'])
+
+    @classmethod
+    def build(cls, path: str, images: list, centers: np.ndarray,
+            crop_size: Cartesian, points: np.ndarray = None):
+        """extract a crop around every center from the image chunks or volumes.
+
+        Args:
+            path (str): the output directory.
+            images (list): image chunks or volumes. Every version is stored in a channel.
+            centers (np.ndarray): the global center coordinates of crops, (N, 3).
+            crop_size (Cartesian): the crop size. It should include the margin for augmentation.
+            points (np.ndarray, optional): the global coordinates of annotated points.
+                Defaults to None, the centers are used.
+        """
+        if points is None:
+            points = centers
+        centers = np.asarray(centers, dtype=np.int64)
+        crop_size = Cartesian.from_collection(crop_size)
+        offsets = centers - np.asarray(crop_size // 2, dtype=np.int64)
+        point_index = PointGridIndex(np.asarray(points, dtype=np.int64))
+
+        os.makedirs(path, exist_ok=True)
+        image_path = os.path.join(path, IMAGE_FILE_NAME)
+        # write to a temporary file and rename it after finishing,
+        # so a partial crop bank will never be used.
+        tmp_path = f'{image_path}.{os.getpid()}.tmp'
+        arr = np.lib.format.open_memmap(tmp_path, mode='w+',
+            dtype=images[0].dtype,
+            shape=(len(centers), len(images), *(int(s) for s in crop_size)))
+
+        point_indptr = np.zeros((len(centers) + 1,), dtype=np.int64)
+        crop_points = []
+        for idx, offset in enumerate(offsets):
+            bbox = BoundingBox.from_delta(Cartesian(*offset), crop_size)
+            for version, image in enumerate(images):
+                crop = image.cutout(bbox)
+                arr[idx, version, ...] = crop.array.reshape(crop.shape[-3:])
+            local_points = point_index.query(offset, offset + np.asarray(crop_size)) - offset
+            crop_points.append(local_points)
+            point_indptr[idx+1] = point_indptr[idx] + len(local_points)
+        arr.flush()
+        del arr
+        os.replace(tmp_path, image_path)
+
+        crop_points = np.concatenate(crop_points, axis=0) if len(crop_points) > 0 \
+            else np.zeros((0, 3), dtype=np.int64)
+        np.savez(os.path.join(path, TABLE_FILE_NAME),
+            offsets=offsets, point_indptr=point_indptr,
+            points=crop_points.astype(np.int32))
+        return cls.from_dir(path)
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    @property
+    def version_num(self):
+        return self.images.shape[1]
+
+    @property
+    def crop_size(self):
+        return Cartesian.from_collection(self.images.shape[-3:])
+
+    def points_in_crop(self, index: int) -> np.ndarray:
+        """the annotated points relative to the crop start."""
+        return self.points[self.point_indptr[index] : self.point_indptr[index+1]]
+
+
+@click.command()
+@click.option('--synapse-path', '-s',
+    type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True, resolve_path=True),
+    required=True, help='synapses file with voxel coordinates.'
+)
+@click.option('--image-path', '-i',
+    type=str, multiple=True, required=True,
+    help='image chunk or volume path. Use multiple times for several image versions.'
+)
+@click.option('--output-dir', '-o',
+    type=click.Path(file_okay=False, dir_okay=True, writable=True, resolve_path=True),
+    required=True, help='the directory of crop bank. The synapse datasets look for ' \
+        '<crop_bank>/<sample name>/<synapse file name without extension>.'
+)
+@click.option('--crop-size', '-c',
+    type=click.INT, nargs=3, default=(160, 160, 160),
+    help='crop size including the margin for augmentation. z,y,x'
+)
+@click.option('--target', '-t',
+    type=click.Choice(['pre', 'post']), default='pre',
+    help='annotate presynapses or postsynapses in the crops.'
+)
+def main(synapse_path: str, image_path: List[str], output_dir: str,
+        crop_size: tuple, target: str):
+    from chunkflow.lib.synapses import Synapses
+    from chunkflow.volume import load_chunk_or_volume
+
+    synapses = Synapses.from_file(synapse_path)
+    if target == 'pre':
+        points = synapses.pre
+    else:
+        assert synapses.post is not None, 'no post synapse in the file.'
+        synapses.remove_synapses_without_post()
+        points = synapses.post_coordinates
+
+    images = [load_chunk_or_volume(path) for path in image_path]
+    crop_bank = CropBank.build(output_dir, images, synapses.pre,
+        Cartesian.from_collection(crop_size), points=points)
+    print(f'extracted {len(crop_bank)} crops with {len(crop_bank.points)} {target} synapses to {output_dir}')
@@ -1,17 +1,43 @@
+import os
+import json
 import math
-import random
-from functools import cached_property
+from functools import cached_property, partial
+from typing import List
 
 import numpy as np
 import torch
 from chunkflow.lib.cartesian_coordinate import Cartesian
 from yacs.config import CfgNode
 
-from neutorch.data.sample import *
-from neutorch.data.transform import *
+from neutorch.data.rng import random
+from neutorch.data.buffer import get_buffer_pool
+from neutorch.data.catalog import SampleCatalog
+from neutorch.data.patch import Patch
+from neutorch.data.residency import LazySample, SampleResidency
+from neutorch.data.stratified import AliasTable
+from neutorch.data.sample import AbstractSample, Sample, SampleWithMask, \
+    SampleWithPointAnnotation, SemanticSample, OrganelleSample, \
+    AffinityMapSample, AffinityMapSampleWithMask, SelfSupervisedSample, \
+    NeuropilMaskSample
+
+__all__ = [
+    'DEFAULT_PATCH_SIZE', 'SAMPLE_CLASSES',
+    'get_iter_range', 'load_cfg', 'load_sample_configs', 'sample_class_from_name',
+    'sample_catalog_from_config', 'dataset_class_from_config', 
+    'compile_sample_catalog', 'worker_init_fn', 'path_to_dataset_name', 'to_tensor',
+    'DatasetBase', 'SemanticDataset', 'OrganelleDataset', 'VolumeWithMask',
+    'AffinityMapDataset', 'BoundaryAugmentationDataset',
+]
 
 DEFAULT_PATCH_SIZE = Cartesian(128, 128, 128)
 
+# the sample types could be used in the sample configuration
+SAMPLE_CLASSES = {sample_class.__name__: sample_class for sample_class in (
+    Sample, SampleWithMask, SampleWithPointAnnotation, SemanticSample,
+    OrganelleSample, AffinityMapSample, AffinityMapSampleWithMask,
+    SelfSupervisedSample, NeuropilMaskSample,
+)}
+
 def get_iter_range(sample_num: int) -> tuple[int, int]:
     # multiprocess data loading 
     worker_info = torch.utils.data.get_worker_info()
@@ -38,6 +64,84 @@ def load_cfg(cfg_file: str, freeze: bool = True):
         cfg.freeze()
     return cfg
 
+def load_sample_configs(sample_config_paths: list) -> CfgNode:
+    """merge the sample configuration files.
+    The sample directories are relative to their configuration file.
+
+    Args:
+        sample_config_paths (list): the sample configuration files.
+
+    Returns:
+        CfgNode: sample name -> sample config node.
+    """
+    sample_configs = CfgNode()
+    for sample_config_path in sample_config_paths:
+        sample_cfg_node = load_cfg(sample_config_path, freeze=False)
+        sample_config_dir = os.path.dirname(os.path.abspath(sample_config_path))
+        for sample_node in sample_cfg_node.values():
+            sample_node.dir = os.path.join(sample_config_dir, sample_node.dir)
+
+        sample_configs.update(sample_cfg_node)
+    return sample_configs
+
+def sample_class_from_name(name: str):
+    assert name in SAMPLE_CLASSES, f'unknown sample type: {name}'
+    return SAMPLE_CLASSES[name]
+
+def _sample_catalog_key(cfg: CfgNode) -> str:
+    """the options changing the sampling weights of samples."""
+    return json.dumps({
+        'patch_size': [int(x) for x in cfg.train.patch_size],
+        'mip': cfg.train.get('mip', None),
+        'affinity_offsets': 'affinity_offsets' in cfg.train,
+    })
+
+def sample_catalog_from_config(cfg: CfgNode) -> SampleCatalog:
+    """the compiled sample catalog or None if it is not configured."""
+    path = cfg.train.get('sample_catalog', None)
+    if path is None:
+        return None
+    catalog = SampleCatalog.load(path)
+    assert catalog.key == _sample_catalog_key(cfg), \
+        f'the sample catalog {path} was compiled with other options, please compile it again.'
+    return catalog
+
+def dataset_class_from_config(cfg: CfgNode):
+    """the sample configuration files are used by the affinity map dataset,
+    and the sample config nodes are used by the volume with mask dataset."""
+    if isinstance(cfg.samples, (list, tuple)):
+        return AffinityMapDataset
+    else:
+        return VolumeWithMask
+
+def compile_sample_catalog(cfg: CfgNode, num_threads: int = None) -> SampleCatalog:
+    """load all the samples of every mode once and compile the catalog.
+
+    Args:
+        cfg (CfgNode): the training configuration.
+        num_threads (int, optional): the number of samples loaded concurrently.
+            Defaults to None, the number of CPUs.
+
+    Returns:
+        SampleCatalog: the catalog.
+    """
+    dataset_class = dataset_class_from_config(cfg)
+    sample_configs = dataset_class.sample_configs_from_config(cfg)
+    sample_names = set()
+    for names in cfg.dataset.values():
+        if isinstance(names, (list, tuple)):
+            sample_names.update(names)
+
+    loaders = {}
+    for sample_name in sample_names:
+        sample_node = sample_configs[sample_name]
+        loaders[sample_name] = (sample_node, 
+            dataset_class.sample_loader(cfg, sample_node))
+    # the class weights are only used to draw patches by class
+    class_stats = cfg.train.get('class_fractions', None) is not None
+    return SampleCatalog.compile(loaders, key=_sample_catalog_key(cfg),
+        class_stats=class_stats, num_threads=num_threads)
+
 def worker_init_fn(worker_id: int):
     worker_info = torch.utils.data.get_worker_info()
     
@@ -65,23 +169,64 @@ def to_tensor(arr):
             arr = arr.astype(np.int32)
         elif np.issubdtype(arr.dtype, np.uint64):
             arr = arr.astype(np.int64)
-        arr = torch.tensor(arr)
+        elif not arr.flags.c_contiguous:
+            # negative strides are not supported by pytorch
+            arr = np.ascontiguousarray(arr)
+        elif not arr.flags.writeable:
+            # the read only view of sample could not be shared with tensor
+            arr = arr.copy()
+        # share the memory with the array without copy
+        arr = torch.from_numpy(arr)
     if torch.cuda.is_available():
         arr = arr.cuda()
     return arr
 
+def _class_fractions_from_config(cfg: CfgNode):
+    """the class fractions configured as a list of [class, fraction] pairs."""
+    class_fractions = cfg.train.get('class_fractions', None)
+    if class_fractions is None:
+        return None
+    return {int(k): float(v) for k, v in class_fractions}
+
+def _shares_memory(tensor: torch.Tensor, arr: np.ndarray):
+    return tensor.device.type == 'cpu' and \
+        tensor.data_ptr() == arr.ctypes.data
 
 class DatasetBase(torch.utils.data.Dataset):
     def __init__(self,
             samples: List[AbstractSample], 
+            memory_budget: int = None,
+            class_fractions: dict = None,
         ):
         """
         Parameters:
-            patch_size (int or tuple): the patch size we are going to provide.
+            samples (List[AbstractSample]): the samples. 
+            memory_budget (int): the maximum number of bytes of loaded lazy samples. 
+                The least recently sampled ones are evicted if it is exceeded.
+                Defaults to None, the lazy samples are never evicted.
+            class_fractions (dict): map a class to the minimum fraction of patches
+                containing it. For example, {1: 0.3} makes at least 30% of patches
+                contain class 1. The patches are drawn from the blocks containing
+                the class in the samples with a block class index.
+                Defaults to None, the patches are sampled uniformly.
         """
         super().__init__()
         self.samples = samples
 
+        if class_fractions is not None:
+            class_fractions = {int(k): float(v) for k, v in dict(class_fractions).items()}
+            assert sum(class_fractions.values()) <= 1.
+        self.class_fractions = class_fractions
+        self._class_sample_tables = {}
+
+        if memory_budget is None:
+            self.residency = None
+        else:
+            self.residency = SampleResidency(memory_budget)
+            for sample in samples:
+                if isinstance(sample, LazySample):
+                    sample.residency = self.residency
+
 
     @cached_property
     def sample_num(self):
@@ -107,8 +252,48 @@ class DatasetBase(torch.utils.data.Dataset):
                 sample_weights[idx] = average_weight 
         return sample_weights
 
+    def _class_sample_table(self, class_index: int):
+        """the alias table of samples weighted by the patch centers 
+        in the blocks containing a class."""
+        if class_index not in self._class_sample_tables:
+            weights = np.zeros((self.sample_num,), dtype=np.float64)
+            for idx, sample in enumerate(self.samples):
+                # the lazy samples from catalog are not loaded to build the table
+                class_weights = getattr(sample, 'class_weights', None)
+                if class_weights is not None:
+                    if class_index < len(class_weights):
+                        weights[idx] = class_weights[class_index]
+                    continue
+                block_class_index = getattr(sample, 'block_class_index', None)
+                if block_class_index is not None and \
+                        class_index < block_class_index.num_classes:
+                    weights[idx] = block_class_index.class_weight(class_index)
+            assert weights.sum() > 0, f'no sample contains class {class_index}.'
+            self._class_sample_tables[class_index] = AliasTable(weights)
+        return self._class_sample_tables[class_index]
+
     @property
-    def random_patch(self):
+    def random_class(self):
+        """draw a class following the class fractions. 
+        None means sampling uniformly."""
+        if self.class_fractions is None:
+            return None
+        r = random.random()
+        for class_index, fraction in self.class_fractions.items():
+            if r < fraction:
+                return class_index
+            r -= fraction
+        return None
+
+    def draw_patch(self) -> Patch:
+        """draw a random augmented patch from a random sample."""
+        class_index = self.random_class
+        if class_index is not None:
+            sample_index = self._class_sample_table(class_index).sample()
+            sample = self.samples[sample_index]
+            center = sample.block_class_index.random_center(class_index)
+            return sample.augmented_patch_from_center(center)
+
          # only sample one subject, so replacement option could be ignored
         sample_index = random.choices(
             range(0, self.sample_num),
@@ -116,7 +301,11 @@ class DatasetBase(torch.utils.data.Dataset):
             k=1,
         )[0]
         sample = self.samples[sample_index]
-        patch = sample.random_patch
+        return sample.random_patch
+
+    @property
+    def random_patch(self):
+        patch = self.draw_patch()
         # patch.to_tensor()
         return patch.image, patch.label
     
@@ -133,18 +322,31 @@ class DatasetBase(torch.utils.data.Dataset):
         Args:
             index (int): index of the patch
         """
-        image_chunk, label_chunk = self.random_patch
-        image = to_tensor(image_chunk.array)
-        label = to_tensor(label_chunk.array)
-
-        assert image.ndim == 5
-
-        return image, label
+        patch = self.draw_patch()
+        chunks = [patch.image, patch.label]
+        if patch.has_context:
+            chunks.append(patch.context)
+
+        # the tensor was copied to GPU or converted to another data type.
+        # the buffers could be reused right now.
+        # otherwise, they will be released after collating the batch.
+        buffer_pool = get_buffer_pool()
+        tensors = []
+        for chunk in chunks:
+            tensor = to_tensor(chunk.array)
+            if not _shares_memory(tensor, chunk.array):
+                buffer_pool.release(chunk.array)
+            tensors.append(tensor)
+
+        assert tensors[0].ndim == 5
+
+        # the context tensor is appended if the patch has it
+        return tuple(tensors)
 
 class SemanticDataset(DatasetBase):
-    def __init__(self, samples: list):
+    def __init__(self, samples: list, class_fractions: dict = None):
             #patch_size: Cartesian = DEFAULT_PATCH_SIZE):
-        super().__init__(samples)
+        super().__init__(samples, class_fractions=class_fractions)
     
     @classmethod
     def from_config(cls, cfg: CfgNode, is_train: bool, **kwargs):
@@ -171,7 +373,8 @@ class SemanticDataset(DatasetBase):
                     **kwargs)
             samples.append(sample)
 
-        return cls( samples )
+        return cls( samples, 
+            class_fractions=_class_fractions_from_config(cfg) )
 
     
 
@@ -229,11 +432,20 @@ class OrganelleDataset(SemanticDataset):
 
     @cached_property
     def class_counts(self):
-        counts = np.zeros((self.num_classes,), dtype=np.int)
+        counts = np.zeros((self.num_classes,), dtype=np.int64)
         for sample in self.samples:
-            counts += sample.class_counts
+            sample_counts = sample.class_counts
+            if len(sample_counts) > len(counts):
+                counts = np.pad(counts, (0, len(sample_counts) - len(counts)))
+            counts[:len(sample_counts)] += sample_counts
 
         return counts
+
+    @cached_property
+    def foreground_fraction(self):
+        foreground_voxel_num = sum(sample.statistics['foreground_voxel_num'] 
+            for sample in self.samples)
+        return foreground_voxel_num / self.voxel_num
      
     def __next__(self):
         # get numpy arrays of image and label
@@ -253,6 +465,18 @@ class VolumeWithMask(DatasetBase):
     def __init__(self, samples: List[AbstractSample]):
         super().__init__(samples)
 
+    @staticmethod
+    def sample_configs_from_config(cfg: CfgNode) -> CfgNode:
+        return cfg.samples
+
+    @staticmethod
+    def sample_loader(cfg: CfgNode, sample_cfg: CfgNode):
+        """the function to construct a sample from its config node."""
+        output_patch_size = Cartesian.from_collection(
+            cfg.train.patch_size)
+        sample_class = sample_class_from_name(sample_cfg.type)
+        return partial(sample_class.from_config, sample_cfg, output_patch_size)
+
     @classmethod
     def from_config(cls, cfg: CfgNode, mode: str = 'training', **kwargs):
         """construct volume with mask dataset
@@ -261,19 +485,24 @@ class VolumeWithMask(DatasetBase):
             cfg (CfgNode): the configuration node
             mode (str, optional): ['training', 'validation', 'test']. Defaults to 'train'.
         """
-        output_patch_size = Cartesian.from_collection(
-            cfg.train.patch_size)
-        
         sample_names = cfg.dataset[mode]
 
         iter_start, iter_stop = get_iter_range(len(sample_names))
 
+        # the compiled catalog avoids opening any volume here
+        catalog = sample_catalog_from_config(cfg)
+        if catalog is None:
+            sample_configs = cls.sample_configs_from_config(cfg)
+        else:
+            sample_configs = catalog.sample_configs
+
         samples = []
         for sample_name in sample_names[iter_start : iter_stop]:
-            sample_cfg = cfg.samples[sample_name]
-            sample_class = eval(sample_cfg.type)
-            sample = sample_class.from_config(
-                sample_cfg, output_patch_size)
+            loader = cls.sample_loader(cfg, sample_configs[sample_name])
+            if catalog is None:
+                sample = loader()
+            else:
+                sample = catalog.lazy_sample(sample_name, loader)
             samples.append(sample)
         return cls(samples)
 
@@ -290,9 +519,47 @@ class VolumeWithMask(DatasetBase):
         # return 10
 
 class AffinityMapDataset(DatasetBase):
-    def __init__(self, samples: list):
-        super().__init__(samples)
+    def __init__(self, samples: list, memory_budget: int = None,
+            class_fractions: dict = None):
+        super().__init__(samples, memory_budget=memory_budget,
+            class_fractions=class_fractions)
     
+    @staticmethod
+    def sample_configs_from_config(cfg: CfgNode) -> CfgNode:
+        return load_sample_configs(cfg.samples)
+
+    @staticmethod
+    def sample_loader(cfg: CfgNode, sample_node: CfgNode):
+        """the function to construct a sample from its config node."""
+        output_patch_size = Cartesian.from_collection(cfg.train.patch_size)
+        # the affinity map with configured offsets is computed in the trainer
+        label_to_affinity = 'affinity_offsets' not in cfg.train
+        # cut out the affinity map from the precomputed one of the whole label
+        precomputed_affinity = label_to_affinity and \
+            cfg.train.get('precomputed_affinity', False)
+        # store the label and image chunks as compressed blocks
+        compress = cfg.train.get('compress_samples', False)
+        # read the image and label at a coarser mip level of the volumes
+        mip = cfg.train.get('mip', None)
+        # a larger context crop of every patch read from a coarser mip level
+        context_mip = cfg.train.get('context_mip', None)
+        context_patch_size = cfg.train.get('context_patch_size', None)
+        context_factor = cfg.model.get('context_factor', None)
+        if context_mip is not None:
+            assert context_patch_size is not None and context_factor is not None, \
+                'the context patch size and the context factor of model are required.'
+        return partial(AffinityMapSample.from_config_node,
+            sample_node, output_patch_size,
+            num_classes=cfg.model.out_channels,
+            label_to_affinity=label_to_affinity,
+            precomputed_affinity=precomputed_affinity,
+            compress=compress,
+            mip=mip,
+            context_mip=context_mip,
+            context_patch_size=context_patch_size,
+            context_factor=context_factor,
+        )
+
     @classmethod
     def from_config(cls, cfg: CfgNode, mode: str, **kwargs):
         """Construct a semantic dataset with chunk or volume
@@ -301,31 +568,47 @@ class AffinityMapDataset(DatasetBase):
             cfg (CfgNode): configuration in YAML file 
             mode (str): training mode or validation mode.
         """
-        output_patch_size = Cartesian.from_collection(cfg.train.patch_size)
         sample_names = cfg.dataset[mode]
 
-        sample_configs = CfgNode()
-        for sample_config_path in cfg.samples:
-            sample_cfg_node = load_cfg(sample_config_path, freeze=False)
-            sample_config_dir = os.path.dirname(sample_config_path)
-            for sample_node in sample_cfg_node.values():
-                sample_node.dir = os.path.join(sample_config_dir, sample_node.dir)
-
-            sample_configs.update(sample_cfg_node)
+        # the compiled catalog avoids parsing the sample configuration files
+        # and opening any volume here
+        catalog = sample_catalog_from_config(cfg)
+        if catalog is None:
+            sample_configs = cls.sample_configs_from_config(cfg)
+        else:
+            sample_configs = catalog.sample_configs
 
         sample_num = len(sample_names)
         iter_start, iter_stop = get_iter_range(sample_num)
 
+        # load the samples on first use and evict the least recently sampled 
+        # ones if the loaded samples are larger than the budget 
+        memory_budget = cfg.train.get('sample_memory_budget_gb', None)
+        if memory_budget is not None:
+            memory_budget = int(memory_budget * 1e9)
+
         samples = []
         for sample_name in sample_names[iter_start : iter_stop]:
             sample_node = sample_configs[sample_name]
-            sample = AffinityMapSample.from_config_node(
-                sample_node, output_patch_size,
-                num_classes=cfg.model.out_channels,
-            )
+            loader = cls.sample_loader(cfg, sample_node)
+            if catalog is not None:
+                sample = catalog.lazy_sample(sample_name, loader)
+            elif memory_budget is None:
+                sample = loader()
+            else:
+                # the dataset length and the sample weights are used before
+                # any patch is drawn, so they should be known without loading.
+                assert 'sampling_weight' in sample_node, \
+                    f'sample {sample_name} requires a sampling_weight to be loaded lazily, ' \
+                    'or compile a sample catalog with neutorch-catalog.'
+                sampling_weight = sample_node.sampling_weight
+                sample = LazySample(loader,
+                    sampling_weight=sampling_weight,
+                    length=sample_node.get('length', int(sampling_weight)))
             samples.append(sample)
 
-        return cls( samples )
+        return cls( samples, memory_budget=memory_budget,
+            class_fractions=_class_fractions_from_config(cfg) )
 
 
 class BoundaryAugmentationDataset(DatasetBase): 
@@ -346,7 +629,6 @@ class BoundaryAugmentationDataset(DatasetBase):
             sample = SelfSupervisedSample.from_explicit_paths(
                     paths,
                     output_patch_size=cfg.train.patch_size,
-                    num_classes=cfg.model.out_channels,
                     **kwargs)
             samples.append(sample)
 
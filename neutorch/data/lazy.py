@@ -0,0 +1,45 @@
+import threading
+from functools import cached_property
+
+
+# the attribute holding the lock of an object
+LOCK_ATTRIBUTE = '_lazy_lock'
+
+# guard the creation of the object locks
+_guard = threading.Lock()
+
+
+def object_lock(obj) -> threading.RLock:
+    """the reentrant lock to build the lazy attributes of an object.
+    It is created on first use and stored in the object.
+
+    Args:
+        obj: an object with `__dict__`.
+
+    Returns:
+        threading.RLock: the lock.
+    """
+    lock = obj.__dict__.get(LOCK_ATTRIBUTE, None)
+    if lock is None:
+        with _guard:
+            lock = obj.__dict__.setdefault(LOCK_ATTRIBUTE, threading.RLock())
+    return lock
+
+
+def drop_object_lock(state: dict) -> dict:
+    """remove the lock from the state of an object to pickle it."""
+    state.pop(LOCK_ATTRIBUTE, None)
+    return state
+
+
+class locked_cached_property(cached_property):
+    """A cached property computed only once if the object is shared by threads.
+    The threads wait for the one computing it rather than computing it again.
+    The lock is reentrant, so a locked property could use another one.
+    After it is computed, the value is read from the object without locking.
+    """
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with object_lock(instance):
+            return super().__get__(instance, owner)
@@ -0,0 +1,188 @@
+import queue
+import threading
+from itertools import count
+from time import time
+
+import torch
+
+from neutorch.data.patch import collate_batch
+from neutorch.data.rng import seed_thread
+
+
+# the number of batches prefetched by every thread
+DEFAULT_PREFETCH_FACTOR = 2
+# seconds to wait before checking the threads again
+POLL_INTERVAL = 0.1
+
+
+class _Failure(object):
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class ThreadDataLoader(object):
+    def __init__(self, dataset: torch.utils.data.Dataset,
+            batch_size: int = 1,
+            num_workers: int = 1,
+            prefetch_factor: int = DEFAULT_PREFETCH_FACTOR,
+            collate_fn = collate_batch,
+            seed: int = None):
+        """Load batches with a pool of threads sharing one dataset.
+        It is a replacement of the torch DataLoader for DatasetBase,
+        whose items are random patches regardless of the index.
+        Most of the patch cost, such as decompression, HDF5 reads and numpy
+        transforms, releases the GIL, so the threads run in parallel without
+        spawning processes, importing modules and copying the samples for
+        every worker.
+        The samples build their lazy attributes, such as the packed affinity 
+        map or the mask integral image, once under a per-sample lock, and keep 
+        the per-draw state in every thread, so they could be shared by threads.
+        The threads keep filling a bounded queue of batches until the loader
+        is closed, so every iterator continues from the prefetched batches.
+
+        Args:
+            dataset (torch.utils.data.Dataset): the dataset.
+            batch_size (int, optional): the number of patches in a batch. Defaults to 1.
+            num_workers (int, optional): the number of threads. Defaults to 1.
+            prefetch_factor (int, optional): the number of batches prefetched
+                by every thread. Defaults to DEFAULT_PREFETCH_FACTOR.
+            collate_fn (callable, optional): merge a list of items to a batch.
+                Defaults to collate_batch.
+            seed (int, optional): the random seed of the first thread.
+                The thread k is seeded with seed + k.
+                Defaults to None, the threads are seeded from the operating system.
+        """
+        assert batch_size > 0
+        assert num_workers > 0
+        assert prefetch_factor > 0
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.collate_fn = collate_fn
+        self.seed = seed
+
+        self._queue = queue.Queue(maxsize=num_workers * prefetch_factor)
+        self._stop = threading.Event()
+        self._threads = []
+        # the indices do not matter, but they are unique like a sampler
+        self._indices = count()
+        self._start_lock = threading.Lock()
+
+    def __len__(self):
+        """the number of batches of an epoch."""
+        return -(-len(self.dataset) // self.batch_size)
+
+    def _start(self):
+        with self._start_lock:
+            if len(self._threads) > 0:
+                return
+            # the tensors are copied to the same device with the main thread
+            device = torch.cuda.current_device() if torch.cuda.is_available() else None
+            for worker_id in range(self.num_workers):
+                seed = None if self.seed is None else self.seed + worker_id
+                thread = threading.Thread(target=self._work,
+                    args=(seed, device), daemon=True,
+                    name=f'neutorch-loader-{worker_id}')
+                thread.start()
+                self._threads.append(thread)
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _work(self, seed: int, device: int):
+        seed_thread(seed)
+        if device is not None:
+            torch.cuda.set_device(device)
+        while not self._stop.is_set():
+            try:
+                batch = self.collate_fn([self.dataset[next(self._indices)] \
+                    for _ in range(self.batch_size)])
+            except Exception as error:
+                # the error is raised in the main thread
+                self._put(_Failure(error))
+                return
+            if not self._put(batch):
+                return
+
+    def __next__(self):
+        self._start()
+        while True:
+            try:
+                item = self._queue.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                assert any(thread.is_alive() for thread in self._threads), \
+                    'all the data loading threads stopped.'
+        if isinstance(item, _Failure):
+            raise item.error
+        return item
+
+    def __iter__(self):
+        """an epoch of batches. The threads are shared by all the iterators."""
+        for _ in range(len(self)):
+            yield next(self)
+
+    def close(self):
+        """stop the threads and drop the prefetched batches."""
+        self._stop.set()
+        for thread in self._threads:
+            while thread.is_alive():
+                # unblock the threads waiting for a free slot
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                thread.join(timeout=POLL_INTERVAL)
+        self._threads = []
+
+    def __del__(self):
+        if hasattr(self, '_threads'):
+            self.close()
+
+
+if __name__ == '__main__':
+    import os
+    import numpy as np
+    from chunkflow.chunk import Chunk
+    from chunkflow.lib.cartesian_coordinate import Cartesian
+    from neutorch.data.dataset import DatasetBase
+    from neutorch.data.sample import Sample
+
+    np.random.seed(0)
+    image = np.random.randint(0, 255, size=(128, 512, 512), dtype=np.uint8)
+    label = (np.random.rand(*image.shape) > 0.5).astype(np.uint32)
+    dataset = DatasetBase([Sample([Chunk(image)], Chunk(label),
+        Cartesian(64, 128, 128))])
+    batch_size = 4
+    batch_num = 40
+
+    def throughput(dataloader):
+        batches = iter(dataloader)
+        # warm up and start the workers
+        next(batches)
+        start = time()
+        for _ in range(batch_num):
+            next(batches)
+        return batch_num / (time() - start)
+
+    for num_workers in sorted({1, 2, 4, os.cpu_count()}):
+        dataloader = ThreadDataLoader(dataset, batch_size=batch_size,
+            num_workers=num_workers, seed=0)
+        speed = throughput(dataloader)
+        dataloader.close()
+        print(f'{num_workers} threads: {speed:.2f} batches per second')
+
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+            num_workers=num_workers, collate_fn=collate_batch,
+            multiprocessing_context='spawn')
+        start = time()
+        speed = throughput(dataloader)
+        print(f'{num_workers} processes: {speed:.2f} batches per second, ' \
+            f'including {time() - start - batch_num / speed:.1f} seconds to start.')
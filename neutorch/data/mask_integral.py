@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.rng import random
+
+
+# number of tries to jitter a patch inside a mask voxel
+MAX_JITTER_TRIES = 8
+
+
+def _box_sums(table: np.ndarray, size: tuple) -> np.ndarray:
+    """the sums of all the boxes with a size from an integral image.
+
+    Args:
+        table (np.ndarray): the integral image with a leading zero plane in every axis.
+        size (tuple): the box size.
+
+    Returns:
+        np.ndarray: the sum of box starting from every position.
+    """
+    kz, ky, kx = size
+    return table[kz:, ky:, kx:] \
+        - table[:-kz, ky:, kx:] - table[kz:, :-ky, kx:] - table[kz:, ky:, :-kx] \
+        + table[:-kz, :-ky, kx:] + table[:-kz, ky:, :-kx] + table[kz:, :-ky, :-kx] \
+        - table[:-kz, :-ky, :-kx]
+
+
+class MaskIntegral(object):
+    def __init__(self, table: np.ndarray, voxel_offset: Cartesian, factor: Cartesian):
+        """A 3D integral image of a low resolution mask.
+        The number of mask voxels in any box is found with eight lookups.
+
+        Args:
+            table (np.ndarray): the integral image with shape of mask shape + 1.
+                table[z, y, x] is the number of nonzero mask voxels in [0:z, 0:y, 0:x].
+            voxel_offset (Cartesian): the voxel offset of mask.
+            factor (Cartesian): the mask voxel size divided by the patch voxel size.
+        """
+        assert table.ndim == 3
+        self.table = table
+        self.voxel_offset = Cartesian.from_collection(voxel_offset)
+        self.factor = Cartesian.from_collection(factor)
+        self._candidate_cache = {}
+
+    @classmethod
+    def from_mask(cls, mask: Chunk, factor: Cartesian):
+        """build the integral image from a mask chunk.
+
+        Args:
+            mask (Chunk): the low resolution mask. The nonzero voxels are inside the mask.
+            factor (Cartesian): the mask voxel size divided by the patch voxel size.
+        """
+        arr = mask.array[(0,) * (mask.ndim - 3)] > 0
+        dtype = np.int32 if arr.size < 2**31 else np.int64
+        table = np.zeros(tuple(s + 1 for s in arr.shape), dtype=dtype)
+        np.cumsum(arr, axis=0, dtype=dtype, out=table[1:, 1:, 1:])
+        np.cumsum(table[1:, 1:, 1:], axis=1, out=table[1:, 1:, 1:])
+        np.cumsum(table[1:, 1:, 1:], axis=2, out=table[1:, 1:, 1:])
+        return cls(table, mask.voxel_offset, factor)
+
+    @classmethod
+    def from_volume(cls, mask_volume, factor: Cartesian, path: str = None):
+        """load the whole mask volume and build the integral image.
+        The low resolution mask is normally small enough to be loaded in RAM.
+
+        Args:
+            mask_volume (Chunk | AbstractVolume): the mask.
+            factor (Cartesian): the mask voxel size divided by the patch voxel size.
+            path (str, optional): cache the integral image in this file. Defaults to None.
+        """
+        if path is not None and os.path.exists(path):
+            print(f'loading existing mask integral image: {path}')
+            with np.load(path) as data:
+                return cls(data['table'], data['voxel_offset'], factor)
+
+        if isinstance(mask_volume, Chunk):
+            mask = mask_volume
+        else:
+            mask = mask_volume.cutout(mask_volume.bounding_box)
+        integral = cls.from_mask(mask, factor)
+        if path is not None:
+            tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_path, table=integral.table,
+                voxel_offset=np.asarray(integral.voxel_offset))
+            os.replace(tmp_path, path)
+        return integral
+
+    @property
+    def shape(self):
+        return tuple(s - 1 for s in self.table.shape)
+
+    def count(self, start: tuple, stop: tuple) -> int:
+        """the number of nonzero mask voxels in a box of mask voxels.
+        The box is clipped by the mask.
+        """
+        start = np.clip(np.asarray(start) - np.asarray(self.voxel_offset), 0, self.shape)
+        stop = np.clip(np.asarray(stop) - np.asarray(self.voxel_offset), start, self.shape)
+        z0, y0, x0 = start
+        z1, y1, x1 = stop
+        t = self.table
+        return int(t[z1, y1, x1] - t[z0, y1, x1] - t[z1, y0, x1] - t[z1, y1, x0] \
+            + t[z0, y0, x1] + t[z0, y1, x0] + t[z1, y0, x0] - t[z0, y0, x0])
+
+    def _mask_box(self, bbox: BoundingBox):
+        """the box of mask voxels overlapping with a bounding box of patch voxels."""
+        factor = np.asarray(self.factor)
+        start = np.asarray(bbox.start) // factor
+        stop = -(-np.asarray(bbox.stop) // factor)
+        return start, stop
+
+    def coverage(self, bbox: BoundingBox) -> float:
+        """the fraction of a bounding box inside the mask.
+        The bounding box is in patch voxels and mapped to the overlapping mask voxels.
+
+        Args:
+            bbox (BoundingBox): the bounding box in patch voxels.
+
+        Returns:
+            float: the fraction in [0, 1].
+        """
+        start, stop = self._mask_box(bbox)
+        return self.count(start, stop) / float(np.prod(stop - start))
+
+    def candidate_starts(self, patch_size: Cartesian, threshold: float,
+            bbox: BoundingBox) -> np.ndarray:
+        """the mask voxels that patches could start from.
+        The patch aligned with the start of these mask voxels
+        has a coverage not less than the threshold.
+
+        Args:
+            patch_size (Cartesian): the patch size in patch voxels.
+            threshold (float): the minimum coverage.
+            bbox (BoundingBox): the region of patches in patch voxels.
+
+        Returns:
+            np.ndarray: the global coordinates of mask voxels with shape of (N, 3).
+        """
+        key = (tuple(patch_size), threshold, tuple(bbox.start), tuple(bbox.stop))
+        if key in self._candidate_cache:
+            return self._candidate_cache[key]
+
+        factor = np.asarray(self.factor)
+        # the mask box of a patch aligned with mask voxels
+        box_size = tuple(-(-np.asarray(patch_size) // factor))
+        sums = _box_sums(self.table, box_size)
+        candidates = np.argwhere(sums >= threshold * np.prod(box_size))
+        candidates += np.asarray(self.voxel_offset)
+
+        # the patches should be inside of the region
+        region_start = -(-np.asarray(bbox.start) // factor)
+        region_stop = (np.asarray(bbox.stop) - np.asarray(patch_size)) // factor + 1
+        inside = np.all((candidates >= region_start) & \
+            (candidates < region_stop), axis=1)
+        candidates = candidates[inside]
+        self._candidate_cache[key] = candidates
+        return candidates
+
+    def random_patch_bbox(self, patch_size: Cartesian, threshold: float,
+            bbox: BoundingBox) -> BoundingBox:
+        """a random patch with mask coverage above threshold.
+        A candidate mask voxel is drawn and the patch start is jittered inside it,
+        so the patches are not aligned with mask voxels or blocks.
+
+        Args:
+            patch_size (Cartesian): the patch size in patch voxels.
+            threshold (float): the minimum coverage.
+            bbox (BoundingBox): the region of patches in patch voxels.
+
+        Returns:
+            BoundingBox: the patch bounding box in patch voxels.
+        """
+        candidates = self.candidate_starts(patch_size, threshold, bbox)
+        assert len(candidates) > 0, \
+            f'no patch is covered by the mask with threshold {threshold}'
+        factor = np.asarray(self.factor)
+        candidate = candidates[random.randrange(len(candidates))]
+        # the jitter range inside the mask voxel and the region
+        low = np.maximum(candidate * factor, np.asarray(bbox.start))
+        high = np.minimum((candidate + 1) * factor,
+            np.asarray(bbox.stop) - np.asarray(patch_size) + 1)
+        for _ in range(MAX_JITTER_TRIES):
+            start = Cartesian(*(random.randrange(l, h) for l, h in zip(low, high)))
+            patch_bbox = BoundingBox.from_delta(start, patch_size)
+            if self.coverage(patch_bbox) >= threshold:
+                return patch_bbox
+        # the patch aligned with the candidate mask voxel satisfies the threshold
+        return BoundingBox.from_delta(Cartesian(*low), patch_size)
+
+    def patch_start_num(self, patch_size: Cartesian, threshold: float,
+            bbox: BoundingBox) -> int:
+        """the approximate number of patch starts above the threshold."""
+        candidates = self.candidate_starts(patch_size, threshold, bbox)
+        return len(candidates) * int(np.prod(self.factor))
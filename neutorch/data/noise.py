@@ -0,0 +1,278 @@
+import os
+import atexit
+from functools import cached_property
+
+import numpy as np
+import torch
+
+from neutorch.data.rng import random
+
+
+# the noise modes that could be represented by a unit gaussian field
+# the semantics follow skimage.util.random_noise
+SUPPORTED_NOISE_MODES = ('gaussian', 'speckle')
+DEFAULT_BANK_SIZE = 4
+# /dev/shm is a RAM backed file system in Linux.
+# all the data loading workers spawned by the same trainer could share it.
+SHARED_MEMORY_DIR = '/dev/shm'
+# the spawned workers inherit the shared bank paths from the trainer process
+NOISE_BANK_ENV = 'NEUTORCH_NOISE_BANKS'
+# the patches are larger before the shrinking transforms
+SHARED_MARGIN = 0.5
+
+
+class NoiseBank(object):
+    def __init__(self, volume_shape: tuple,
+            bank_size: int = DEFAULT_BANK_SIZE,
+            seed: int = None,
+            path: str = None):
+        """A bank of unit gaussian noise volumes.
+        The noise volumes are generated only once.
+        Every crop from the bank is randomly offset and flipped,
+        so we could get a lot of different noise fields without
+        random number generation for every patch.
+
+        Args:
+            volume_shape (tuple): the shape of each noise volume, z,y,x.
+            bank_size (int, optional): number of noise volumes. Defaults to DEFAULT_BANK_SIZE.
+            seed (int, optional): random seed of noise generation. Defaults to None.
+            path (str, optional): a bank file written by `share`.
+                It is memory mapped rather than generated. Defaults to None.
+        """
+        assert len(volume_shape) == 3
+        assert bank_size > 0
+        self.volume_shape = tuple(int(s) for s in volume_shape)
+        self.bank_size = bank_size
+        self.seed = seed
+        self.path = path
+
+    @classmethod
+    def from_path(cls, path: str):
+        """memory map a bank file written by another process."""
+        arr = np.load(path, mmap_mode='r')
+        assert arr.ndim == 4
+        bank = cls(arr.shape[1:], bank_size=arr.shape[0], path=path)
+        bank.array = arr
+        return bank
+
+    @cached_property
+    def shape(self):
+        return (self.bank_size, *self.volume_shape)
+
+    def _generate(self, out: np.ndarray):
+        rng = np.random.default_rng(self.seed)
+        for idx in range(self.bank_size):
+            rng.standard_normal(size=self.volume_shape,
+                dtype=np.float32, out=out[idx, ...])
+        return out
+
+    def share(self, directory: str = SHARED_MEMORY_DIR) -> str:
+        """write the bank to a file, so the spawned workers could map it.
+        The file is owned by this process and removed at exit.
+        It should be called in the trainer process before spawning workers.
+
+        Args:
+            directory (str, optional): the directory of the bank file. 
+                Defaults to SHARED_MEMORY_DIR.
+
+        Returns:
+            str: the file path.
+        """
+        if self.path is not None:
+            return self.path
+
+        shape_str = '_'.join(str(s) for s in self.shape)
+        path = os.path.join(directory,
+            f'neutorch_noise_bank_{os.getpid()}_{shape_str}.npy')
+        atexit.register(_remove_file, path)
+        try:
+            arr = np.lib.format.open_memmap(
+                path, mode='w+', dtype=np.float32, shape=self.shape)
+            self._generate(arr)
+            arr.flush()
+            del arr
+        except OSError:
+            _remove_file(path)
+            raise
+        self.path = path
+        self.array = np.load(path, mmap_mode='r')
+        return path
+
+    @cached_property
+    def array(self) -> np.ndarray:
+        if self.path is not None:
+            return np.load(self.path, mmap_mode='r')
+        arr = np.empty(self.shape, dtype=np.float32)
+        return self._generate(arr)
+
+    def crop(self, shape: tuple) -> np.ndarray:
+        """a random crop of unit gaussian noise
+
+        Args:
+            shape (tuple): the crop shape, z,y,x. It should not be larger than the volume shape.
+
+        Returns:
+            np.ndarray: a read only view of the noise bank.
+                The view could have negative strides.
+        """
+        assert len(shape) == 3
+        volume = self.array[random.randrange(self.bank_size)]
+
+        slices = []
+        for c, v in zip(shape, self.volume_shape):
+            assert c <= v, f'crop shape {shape} is larger than noise volume {self.volume_shape}'
+            start = random.randint(0, v - c)
+            if random.random() < 0.5:
+                slices.append(slice(start, start + c))
+            else:
+                # flip this axis
+                stop = start - 1 if start > 0 else None
+                slices.append(slice(start + c - 1, stop, -1))
+        return volume[tuple(slices)]
+
+    def add_noise(self, arr: np.ndarray, variance: float,
+            mode: str = 'gaussian'):
+        """add noise to the array in place.
+        The semantics are the same with `skimage.util.random_noise`.
+
+        Args:
+            arr (np.ndarray): float array with 3 to 5 dimensions. The last 3 axes are z,y,x.
+            variance (float): variance of the noise.
+            mode (str, optional): gaussian or speckle. Defaults to 'gaussian'.
+        """
+        if mode not in SUPPORTED_NOISE_MODES:
+            raise ValueError(f'only support noise mode of {SUPPORTED_NOISE_MODES}, but got {mode}')
+        assert np.issubdtype(arr.dtype, np.floating)
+        assert arr.ndim >= 3
+
+        # the noise is symmetric, so we can also flip the sign
+        std = np.sqrt(variance) * random.choice((-1., 1.))
+        # use a different noise field for each batch and channel
+        for index in np.ndindex(arr.shape[:-3]):
+            noise = self.crop(arr.shape[-3:]) * np.float32(std)
+            if mode == 'speckle':
+                noise *= arr[index]
+            arr[index] += noise
+        return arr
+
+
+def _remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# noise banks of current process
+_noise_banks = {}
+
+def _find_noise_bank(shape: tuple) -> NoiseBank:
+    for bank in _noise_banks.values():
+        if all(s <= v for s, v in zip(shape, bank.volume_shape)):
+            return bank
+
+    # the banks shared by the trainer process
+    for path in os.environ.get(NOISE_BANK_ENV, '').split(os.pathsep):
+        if len(path) > 0 and path not in _noise_banks and os.path.exists(path):
+            bank = NoiseBank.from_path(path)
+            _noise_banks[path] = bank
+            if all(s <= v for s, v in zip(shape, bank.volume_shape)):
+                return bank
+    return None
+
+def _noise_volume_shape(shape: tuple, margin: float) -> tuple:
+    return tuple(int(s + np.ceil(s * margin)) for s in shape)
+
+def get_noise_bank(shape: tuple, margin: float = 0.25) -> NoiseBank:
+    """get a noise bank that is large enough for the shape.
+    The bank shared by the trainer process is used if it is large enough.
+    Otherwise, the noise bank is created once per process and reused.
+
+    Args:
+        shape (tuple): the patch shape. Only the last three axes are used.
+        margin (float, optional): make the noise volume larger than the patch
+            to have random offsets. Defaults to 0.25.
+
+    Returns:
+        NoiseBank: the noise bank.
+    """
+    shape = tuple(shape[-3:])
+    bank = _find_noise_bank(shape)
+    if bank is not None:
+        return bank
+
+    volume_shape = _noise_volume_shape(shape, margin)
+    bank = NoiseBank(volume_shape)
+    _noise_banks[volume_shape] = bank
+    return bank
+
+def share_noise_bank(shape: tuple, margin: float = SHARED_MARGIN) -> NoiseBank:
+    """create a noise bank in shared memory for the data loader workers.
+    It should be called in the trainer process before spawning workers.
+    The workers find the file from an environment variable inherited from 
+    this process, and the file is removed when this process exits.
+
+    Args:
+        shape (tuple): the patch shape. Only the last three axes are used.
+        margin (float, optional): make the noise volume larger than the patch,
+            so the patches before shrinking transforms also fit. 
+            Defaults to SHARED_MARGIN.
+
+    Returns:
+        NoiseBank: the noise bank.
+    """
+    shape = tuple(shape[-3:])
+    bank = _find_noise_bank(shape)
+    if bank is not None and bank.path is not None:
+        return bank
+
+    volume_shape = _noise_volume_shape(shape, margin)
+    bank = NoiseBank(volume_shape)
+    if os.path.isdir(SHARED_MEMORY_DIR):
+        try:
+            bank.share()
+        except OSError as err:
+            print(f'failed to create noise bank in shared memory: {err}')
+    _noise_banks[volume_shape] = bank
+    if bank.path is not None:
+        paths = [p for p in os.environ.get(NOISE_BANK_ENV, '').split(os.pathsep) if p]
+        os.environ[NOISE_BANK_ENV] = os.pathsep.join(paths + [bank.path])
+    return bank
+
+
+def noisy_pairs(clean: torch.Tensor, max_variance: float,
+        mask_ratio: float = 0.):
+    """synthesize Noise2Noise style training pairs from a batch of clean patches.
+    The input and target get independent gaussian noise with the same variance,
+    which is drawn for every patch. A fraction of input voxels could be replaced 
+    by random values and the loss is only computed there, like Noise2Self.
+    All the patches are corrupted together on the device of the batch.
+
+    Args:
+        clean (torch.Tensor): the clean patches with shape of (N,C,Z,Y,X).
+            The uint8 patches are normalized to [0, 1].
+        max_variance (float): the maximum variance of noise.
+        mask_ratio (float, optional): the fraction of masked input voxels. 
+            Defaults to 0., no masking.
+
+    Returns:
+        tuple: the input, the target and the mask of voxels used in the loss.
+            The mask is None without masking.
+    """
+    assert max_variance >= 0.
+    assert 0. <= mask_ratio < 1.
+    if clean.dtype == torch.uint8:
+        clean = clean.float() / 255.
+
+    # the noise level of every patch
+    shape = (clean.shape[0],) + (1,) * (clean.ndim - 1)
+    std = torch.sqrt(torch.rand(shape, device=clean.device) * max_variance)
+    noisy = torch.addcmul(clean, torch.randn_like(clean), std)
+    target = torch.addcmul(clean, torch.randn_like(clean), std)
+
+    mask = None
+    if mask_ratio > 0.:
+        mask = torch.rand_like(clean) < mask_ratio
+        noisy = torch.where(mask, torch.rand_like(clean), noisy)
+        mask = mask.to(clean.dtype)
+    noisy.clamp_(0., 1.)
+    target.clamp_(0., 1.)
+    return noisy, target, mask
@@ -6,15 +6,26 @@ import torch
 from chunkflow.lib.cartesian_coordinate import Cartesian
 from chunkflow.chunk import Chunk
 
+from neutorch.data.buffer import get_buffer_pool
+
 
 class Patch(object):
     def __init__(self, image: Chunk, label: Chunk,
-            mask: Chunk = None):
+            mask: Chunk = None, affinity: Chunk = None,
+            context: Chunk = None):
         """A patch of volume containing both image and label
 
         Args:
             image (Chunk): image
             label (Chunk): label
+            mask (Chunk): mask
+            affinity (Chunk): precomputed nearest neighbor affinity map 
+                of the label with shape of (1,3,Z,Y,X).
+                The spatial transforms that could not keep it consistent
+                with the label will drop it.
+            context (Chunk): a larger image crop co-centered with the patch 
+                at a lower resolution with shape of (1,C,Z,Y,X). 
+                It is flipped and transposed with the patch but not shrinked.
         """
         assert image.shape[-3:] == label.shape[-3:], \
             f'image shape: {image.shape}, label shape: {label.shape}'
@@ -23,6 +34,9 @@ class Patch(object):
             mask.shape == label.shape
             assert mask.ndim == 3
             assert mask.voxel_offset == image.voxel_offset
+        if affinity is not None:
+            assert affinity.shape[-3:] == label.shape[-3:]
+            assert affinity.voxel_offset == label.voxel_offset
         
         image.array = self._expand_to_5d(image.array)
         label.array = self._expand_to_5d(label.array)
@@ -30,11 +44,21 @@ class Patch(object):
         self.image = image
         self.label = label
         self.mask = mask
+        self.affinity = affinity
+        self.context = context
 
     @cached_property
     def has_mask(self):
         return self.mask is not None
 
+    @property
+    def has_affinity(self):
+        return self.affinity is not None
+
+    @property
+    def has_context(self):
+        return self.context is not None
+
     def _expand_to_5d(self, arr: np.ndarray):
         if arr.ndim == 4:
             arr = np.expand_dims(arr, axis=0)
@@ -51,6 +75,8 @@ class Patch(object):
         self.label.shrink(size)
         if self.has_mask:
             self.mask.shrink(size)
+        if self.has_affinity:
+            self.affinity.shrink(size)
             
     @property
     def shape(self):
@@ -75,11 +101,28 @@ class Patch(object):
             return arr
         self.image.array = _normalize(self.image.array)
         self.label.array = _normalize(self.label.array)
+        if self.has_context:
+            self.context.array = _normalize(self.context.array)
 
 
 
 def collate_batch(batch):
-    patch_list = []
-    for patch in batch:
-        patch_list.append(patch)
-    return patch
\ No newline at end of file
+    """concatenate the image and label tensors of patches along the batch axis.
+    The batch has a shape of (N,C,Z,Y,X) rather than the last patch only.
+    The patch buffers are released to the buffer pool after concatenation.
+    The concatenation always copies, so the batch never shares the released buffers.
+
+    Args:
+        batch (list): list of (image, label) tensor pairs 
+            or (image, label, context) tensor triples.
+
+    Returns:
+        tuple: the batched image, label and context tensors.
+    """
+    buffer_pool = get_buffer_pool()
+    collated = []
+    for tensors in zip(*batch):
+        collated.append(torch.cat(tensors, dim=0))
+        for tensor in tensors:
+            buffer_pool.release(tensor)
+    return tuple(collated)
\ No newline at end of file
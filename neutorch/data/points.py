@@ -0,0 +1,146 @@
+from functools import cached_property
+
+import numpy as np
+
+
+DEFAULT_CELL_SIZE = (64, 64, 64)
+
+
+class PointGridIndex(object):
+    def __init__(self, points: np.ndarray,
+            cell_size: tuple = DEFAULT_CELL_SIZE):
+        """Spatial grid index of points.
+        The points are sorted by the grid cell containing them,
+        so the points inside a box are found by looking up
+        only the cells overlapping with the box.
+
+        Args:
+            points (np.ndarray): point coordinates with shape of (N, 3) and zyx order.
+            cell_size (tuple, optional): size of grid cell. Defaults to DEFAULT_CELL_SIZE.
+        """
+        assert points.ndim == 2
+        assert points.shape[1] == 3
+        self.cell_size = np.asarray(cell_size, dtype=np.int64)
+        assert np.all(self.cell_size > 0)
+
+        points = np.asarray(points)
+        cells = np.floor_divide(points, self.cell_size).astype(np.int64)
+        self.cell_start = cells.min(axis=0) if len(points) > 0 \
+            else np.zeros((3,), dtype=np.int64)
+        cells -= self.cell_start
+        self.grid_shape = tuple(int(x) for x in cells.max(axis=0) + 1) \
+            if len(points) > 0 else (1, 1, 1)
+
+        keys = np.ravel_multi_index(cells.T, self.grid_shape)
+        order = np.argsort(keys, kind='stable')
+        self.points = points[order]
+        # the original index of sorted points
+        self.point_indices = order
+        self.keys, self.key_starts, self.key_counts = np.unique(
+            keys[order], return_index=True, return_counts=True)
+
+    def __len__(self):
+        return self.points.shape[0]
+
+    @cached_property
+    def nbytes(self):
+        return self.points.nbytes + self.point_indices.nbytes + \
+            self.keys.nbytes + self.key_starts.nbytes + self.key_counts.nbytes
+
+    def query(self, start: tuple, stop: tuple,
+            return_indices: bool = False) -> np.ndarray:
+        """find the points inside a box.
+
+        Args:
+            start (tuple): the start of box, inclusive.
+            stop (tuple): the stop of box, exclusive.
+            return_indices (bool, optional): return the indices of points
+                in the original array rather than coordinates. Defaults to False.
+
+        Returns:
+            np.ndarray: point coordinates with shape of (M, 3) or point indices with shape of (M,).
+        """
+        start = np.asarray(start, dtype=np.int64)
+        stop = np.asarray(stop, dtype=np.int64)
+        empty = np.zeros((0,), dtype=np.int64) if return_indices else self.points[:0]
+        if len(self) == 0 or np.any(stop <= start):
+            return empty
+
+        # the overlapping cells
+        cell_start = np.maximum(start // self.cell_size - self.cell_start, 0)
+        cell_stop = np.minimum(
+            (stop - 1) // self.cell_size - self.cell_start + 1, self.grid_shape)
+        if np.any(cell_stop <= cell_start):
+            return empty
+        grid = np.meshgrid(
+            *[np.arange(c0, c1) for c0, c1 in zip(cell_start, cell_stop)],
+            indexing='ij')
+        keys = np.ravel_multi_index([g.ravel() for g in grid], self.grid_shape)
+
+        # find the nonempty cells
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        positions = positions[found]
+        positions = positions[self.keys[positions] == keys[found]]
+        if len(positions) == 0:
+            return empty
+        candidates = np.concatenate([
+            np.arange(s, s + c) for s, c in zip(
+                self.key_starts[positions], self.key_counts[positions])])
+
+        points = self.points[candidates]
+        inside = np.all((points >= start) & (points < stop), axis=1)
+        if return_indices:
+            return self.point_indices[candidates[inside]]
+        else:
+            return points[inside]
+
+
+def paint_cubes(arr: np.ndarray, points: np.ndarray,
+        expand_distance: int, value: float):
+    """paint a cube around every point in the array.
+    The cube of a point p covers [p-expand_distance, p+expand_distance).
+    All the cubes are painted with one indexing operation,
+    and the voxels outside of array are ignored.
+
+    Args:
+        arr (np.ndarray): the array to paint. The last three axes are z,y,x.
+        points (np.ndarray): point coordinates in the array with shape of (N, 3).
+        expand_distance (int): the half size of cube.
+        value (float): the voxel value of cubes.
+    """
+    if len(points) == 0:
+        return arr
+    assert expand_distance > 0
+    offsets = np.arange(-expand_distance, expand_distance)
+    offsets = np.stack(np.meshgrid(offsets, offsets, offsets, indexing='ij'),
+        axis=-1).reshape(-1, 3)
+    coordinates = (np.asarray(points, dtype=np.int64)[:, np.newaxis, :] + \
+        offsets[np.newaxis, :, :]).reshape(-1, 3)
+    shape = np.asarray(arr.shape[-3:])
+    inside = np.all((coordinates >= 0) & (coordinates < shape), axis=1)
+    coordinates = coordinates[inside]
+    arr[..., coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]] = value
+    return arr
+
+
+def group_to_csr(groups: np.ndarray, group_num: int) -> tuple:
+    """compressed sparse row layout of grouped items.
+    The items of group i are `indices[indptr[i] : indptr[i+1]]`.
+
+    Args:
+        groups (np.ndarray): the group id of every item.
+        group_num (int): number of groups.
+
+    Returns:
+        tuple: the indptr with shape of (group_num+1,) and item indices sorted by group.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    assert groups.ndim == 1
+    if len(groups) > 0:
+        assert groups.min() >= 0
+        assert groups.max() < group_num
+    indices = np.argsort(groups, kind='stable')
+    indptr = np.zeros((group_num + 1,), dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=group_num), out=indptr[1:])
+    return indptr, indices
@@ -0,0 +1,227 @@
+import threading
+from collections import OrderedDict
+from functools import cached_property
+from typing import Callable
+
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from chunkflow.volume import AbstractVolume
+
+from neutorch.data.sample import AbstractSample
+
+
+def resident_nbytes(obj, depth: int = 2) -> int:
+    """the number of bytes of arrays held in RAM by an object.
+    The memory mapped arrays and volumes are not counted.
+    The objects reporting their own size with a `nbytes` attribute,
+    such as a compressed chunk or a point index, are not visited.
+
+    Args:
+        obj: an array, chunk, list, dict or an object with attributes.
+        depth (int, optional): the depth of nested attributes to visit. Defaults to 2.
+
+    Returns:
+        int: number of bytes.
+    """
+    if isinstance(obj, np.memmap):
+        return 0
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, Chunk):
+        return resident_nbytes(obj.array, depth=depth)
+    elif isinstance(obj, AbstractVolume):
+        return 0
+    elif isinstance(getattr(type(obj), 'nbytes', None), (property, cached_property)):
+        return int(obj.nbytes)
+    elif depth <= 0:
+        return 0
+    elif isinstance(obj, (list, tuple)):
+        return sum(resident_nbytes(x, depth=depth-1) for x in obj)
+    elif isinstance(obj, dict):
+        # the values are copied since the lazy attributes could be
+        # added by other threads while we are counting.
+        return sum(resident_nbytes(x, depth=depth-1) for x in list(obj.values()))
+    elif hasattr(obj, '__dict__'):
+        return resident_nbytes(vars(obj), depth=depth)
+    else:
+        return 0
+
+
+class SampleResidency(object):
+    def __init__(self, memory_budget: int):
+        """Track the memory of loaded samples in a dataset.
+        If the total memory exceeds the budget,
+        the least recently sampled ones are evicted.
+
+        Args:
+            memory_budget (int): the maximum number of bytes of loaded samples.
+        """
+        assert memory_budget > 0
+        self.memory_budget = memory_budget
+        # lazy sample -> number of bytes, the least recently used one is the first
+        self.resident = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(self.resident.values())
+
+    def touch(self, sample: 'LazySample'):
+        """mark a sample as recently used and evict others if it is over budget.
+        The touched sample is never evicted, even if it is larger than the budget.
+        The size of sample is measured once after loading rather than every touch.
+
+        Args:
+            sample (LazySample): the loaded sample.
+        """
+        with self._lock:
+            if sample not in self.resident:
+                if not sample.is_loaded:
+                    # evicted by another thread after it was drawn, 
+                    # it is added again when it is loaded.
+                    return
+                self.resident[sample] = sample.nbytes
+            self.resident.move_to_end(sample)
+
+            total = sum(self.resident.values())
+            while total > self.memory_budget and len(self.resident) > 1:
+                evicted, nbytes = self.resident.popitem(last=False)
+                evicted.evict()
+                total -= nbytes
+
+    def resize(self, sample: 'LazySample'):
+        """measure a resident sample again, for example after
+        its lazily computed indices are built."""
+        with self._lock:
+            if sample in self.resident:
+                self.resident[sample] = sample.nbytes
+
+    def discard(self, sample: 'LazySample'):
+        with self._lock:
+            self.resident.pop(sample, None)
+
+
+class LazySample(AbstractSample):
+    def __init__(self, loader: Callable[[], AbstractSample],
+            sampling_weight: float = None,
+            residency: SampleResidency = None,
+            length: int = None,
+            class_weights: list = None):
+        """A sample loaded on first use.
+        The sampling weight and length are kept after the data is evicted,
+        so the sampling distribution of dataset does not change.
+
+        Args:
+            loader (Callable[[], AbstractSample]): construct the sample.
+            sampling_weight (float, optional): the weight to sample.
+                Defaults to None, the sample is loaded to compute it.
+            residency (SampleResidency, optional): the memory budget of dataset.
+                Defaults to None, the sample will not be evicted.
+            length (int, optional): the number of patches. 
+                Defaults to None, the sample is loaded to compute it.
+            class_weights (list, optional): the weight to sample every class.
+                Defaults to None, the block class index of sample is used.
+        """
+        # the output patch size is only known after loading
+        self.loader = loader
+        self.residency = residency
+        self._sample = None
+        self._sampling_weight = sampling_weight
+        self._len = length
+        self.class_weights = class_weights
+        # a patch is drawn after the sample is loaded
+        self._drawn = False
+        self._load_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state['_load_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._load_lock = threading.Lock()
+
+    # the samples are hashed by identity in the residency
+    __hash__ = object.__hash__
+
+    @property
+    def is_loaded(self):
+        return self._sample is not None
+
+    @property
+    def sample(self) -> AbstractSample:
+        sample = self._sample
+        if sample is None:
+            with self._load_lock:
+                if self._sample is None:
+                    self._drawn = False
+                    self._sample = self.loader()
+                    if self._sampling_weight is None:
+                        self._sampling_weight = self._sample.sampling_weight
+                    if self._len is None:
+                        self._len = len(self._sample)
+                sample = self._sample
+        if self.residency is not None:
+            self.residency.touch(self)
+        return sample
+
+    @property
+    def nbytes(self):
+        return resident_nbytes(self._sample)
+
+    def evict(self):
+        """release the loaded data. It will be loaded again in next use."""
+        self._sample = None
+
+    @property
+    def output_patch_size(self):
+        return self.sample.output_patch_size
+
+    @property
+    def patch_size_before_transform(self):
+        return self.sample.patch_size_before_transform
+
+    def _resize_after_first_draw(self):
+        # the lazily computed indices of sample, such as the packed affinity map,
+        # are built in the first draw after loading
+        if not self._drawn:
+            self._drawn = True
+            if self.residency is not None:
+                self.residency.resize(self)
+
+    @property
+    def random_patch(self):
+        patch = self.sample.random_patch
+        self._resize_after_first_draw()
+        return patch
+
+    @property
+    def block_class_index(self):
+        return getattr(self.sample, 'block_class_index', None)
+
+    def augmented_patch_from_center(self, center):
+        patch = self.sample.augmented_patch_from_center(center)
+        self._resize_after_first_draw()
+        return patch
+
+    @property
+    def sampling_weight(self):
+        if self._sampling_weight is None:
+            self.sample
+        return self._sampling_weight
+
+    def __len__(self):
+        if self._len is None:
+            self.sample
+        return self._len
@@ -0,0 +1,44 @@
+import random as _random
+import threading
+
+import numpy as np
+
+
+class _ThreadGenerators(threading.local):
+    # the threads without their own generators use the global ones.
+    # the data loader worker processes seed the global ones.
+    python = None
+    numpy = None
+
+
+_generators = _ThreadGenerators()
+
+
+class _PythonRandom(object):
+    """the random module of current thread."""
+    def __getattr__(self, name: str):
+        generator = _generators.python
+        return getattr(_random if generator is None else generator, name)
+
+
+class _NumpyRandom(object):
+    """the numpy random module of current thread."""
+    def __getattr__(self, name: str):
+        generator = _generators.numpy
+        return getattr(np.random if generator is None else generator, name)
+
+
+# the patches are drawn with these generators, 
+# so every data loading thread could have its own random sequence.
+random = _PythonRandom()
+np_random = _NumpyRandom()
+
+
+def seed_thread(seed: int = None):
+    """use independent generators in current thread.
+
+    Args:
+        seed (int, optional): the seed. Defaults to None, seeded from the operating system.
+    """
+    _generators.python = _random.Random(seed)
+    _generators.numpy = np.random.RandomState(seed)
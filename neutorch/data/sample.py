@@ -1,10 +1,8 @@
 from __future__ import annotations
 import os
 from abc import ABC, abstractmethod 
-import random
 from typing import List, Union
-from functools import cached_property
-from copy import deepcopy
+import threading
 
 import numpy as np
 from yacs.config import CfgNode
@@ -16,14 +14,128 @@ from chunkflow.lib.synapses import Synapses
 from chunkflow.volume import PrecomputedVolume, AbstractVolume, \
     get_candidate_block_bounding_boxes_with_different_voxel_size
 
+from neutorch.data.rng import random
 from neutorch.data.patch import Patch
+from neutorch.data.buffer import get_buffer_pool
+from neutorch.data.lazy import locked_cached_property, drop_object_lock
+from neutorch.data.affinity import PackedAffinityMap
+from neutorch.data.points import PointGridIndex, paint_cubes, group_to_csr
+from neutorch.data.crop_bank import CropBank
+from neutorch.data.compressed import CompressedChunk
+from neutorch.data.statistics import load_or_compute_statistics, \
+    load_or_compute, block_class_histograms
+from neutorch.data.mask_integral import MaskIntegral
+from neutorch.data.stratified import BlockClassIndex, DEFAULT_BLOCK_SIZE as \
+    DEFAULT_CLASS_BLOCK_SIZE
 # from .patch_bounding_box_generator import PatchBoundingBoxGeneratorInChunk, PatchBoundingBoxGeneratorInsideMask
-from neutorch.data.transform import *
+from neutorch.data.transform import AdjustBrightness, AdjustContrast, \
+    CompactSegmentation, Compose, DropSection, Flip, Gamma, GaussianBlur2D, \
+    Label2AffinityMap, MaskBox, MissAlignment, Noise, NormalizeTo01, OneOf, \
+    Transpose
+
+__all__ = [
+    'DEFAULT_PATCH_SIZE', 'DEFAULT_NUM_CLASSES',
+    'load_at_mip', 'check_voxel_sizes', 'cutout_with_padding', 'context_factor_of',
+    'AbstractSample', 'Sample', 'SampleWithMask', 'SampleWithPointAnnotation',
+    'CropBankSample', 'PostSynapseReference', 'SemanticSample', 'OrganelleSample',
+    'AffinityMapSample', 'AffinityMapSampleWithMask', 'SelfSupervisedSample',
+    'NeuropilMaskSample',
+]
 
 DEFAULT_PATCH_SIZE = Cartesian(128, 128, 128)
 DEFAULT_NUM_CLASSES = 1
 
 
+def load_at_mip(path: str, mip: int = None, **kwargs):
+    """load a chunk or volume at a mip level of the stored pyramid.
+    The coarser mip is read directly from the storage without downsampling.
+
+    Args:
+        path (str): the chunk or volume path.
+        mip (int, optional): the mip level. Defaults to None, the default level of the volume.
+    """
+    if mip is None:
+        return load_chunk_or_volume(path, **kwargs)
+    if path.endswith('.h5') or path.endswith('.npy') or \
+            path.endswith('.tif') or path.endswith('.tiff') or path.endswith('.png'):
+        assert mip == 0, f'no stored mip levels in the chunk file: {path}'
+        return load_chunk_or_volume(path, **kwargs)
+    return load_chunk_or_volume(path, mip=mip, **kwargs)
+
+
+def check_voxel_sizes(images: list, label: Chunk | AbstractVolume = None, 
+        mask: Chunk | AbstractVolume = None):
+    """the images and label should have the same voxel size 
+    and the mask voxel size should be a multiple of it.
+    The voxel sizes that are not known are not checked.
+    """
+    voxel_size = images[0].voxel_size
+    if voxel_size is None:
+        return
+    for image in images[1:]:
+        assert image.voxel_size is None or image.voxel_size == voxel_size, \
+            f'image voxel size {image.voxel_size} is different from {voxel_size}'
+    if label is not None and label.voxel_size is not None:
+        assert label.voxel_size == voxel_size, \
+            f'label voxel size {label.voxel_size} is different from image voxel size {voxel_size}'
+    if mask is not None and mask.voxel_size is not None:
+        assert mask.voxel_size % voxel_size == Cartesian(0, 0, 0), \
+            f'mask voxel size {mask.voxel_size} should be a multiple of image voxel size {voxel_size}'
+
+
+def cutout_with_padding(volume: Chunk | AbstractVolume, 
+        bbox: BoundingBox) -> Chunk:
+    """cutout a bounding box that could be partially outside of the volume.
+    The region outside of the volume is filled with zeros.
+    The array is acquired from the buffer pool.
+
+    Args:
+        volume (Chunk | AbstractVolume): the chunk or volume.
+        bbox (BoundingBox): the global bounding box.
+
+    Returns:
+        Chunk: the cutout with 5 dimensions.
+    """
+    shape = (*volume.shape[:-3], *bbox.shape)
+    shape = (1,) * max(5 - len(shape), 0) + shape
+    buffer_pool = get_buffer_pool()
+    arr = buffer_pool.acquire(shape, volume.dtype)
+
+    inter = bbox.intersection(volume.bbox)
+    if inter.start == bbox.start and inter.stop == bbox.stop:
+        np.copyto(arr, volume.cutout(bbox).array.reshape(shape))
+    else:
+        arr.fill(0)
+        if all(e > b for b, e in zip(inter.start, inter.stop)):
+            start = inter.start - bbox.start
+            stop = inter.stop - bbox.start
+            inside = volume.cutout(inter).array
+            arr[..., start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = \
+                inside.reshape((*shape[:2], *inside.shape[-3:]))
+    return Chunk(arr, voxel_offset=bbox.start, voxel_size=volume.voxel_size)
+
+
+def context_factor_of(images: list, context_images: list) -> Cartesian:
+    """the context voxel size divided by the image voxel size."""
+    voxel_size = images[0].voxel_size
+    context_voxel_size = context_images[0].voxel_size
+    assert voxel_size is not None and context_voxel_size is not None, \
+        'the voxel sizes are required to find the context factor.'
+    assert context_voxel_size % voxel_size == Cartesian(0, 0, 0), \
+        f'context voxel size {context_voxel_size} should be a multiple of image voxel size {voxel_size}'
+    return context_voxel_size // voxel_size
+
+
+def _compress_chunk(chunk: Chunk | AbstractVolume):
+    """compress the chunk in RAM. The volumes are not loaded in RAM and kept."""
+    if isinstance(chunk, Chunk):
+        compressed = CompressedChunk.from_chunk(chunk)
+        print(f'compressed chunk {chunk.bbox} from {chunk.array.nbytes / 1e6 :.1f} MB to {compressed.nbytes / 1e6 :.1f} MB.')
+        return compressed
+    else:
+        return chunk
+
+
 class AbstractSample(ABC):
     def __init__(self, output_patch_size: Cartesian, 
             is_train: bool = True):
@@ -38,6 +150,11 @@ class AbstractSample(ABC):
         self.output_patch_size = output_patch_size
         self.is_train = is_train
 
+    def __getstate__(self):
+        # the lazy attributes are built under a lock when the sample is
+        # shared by data loading threads. The lock is not copied to processes.
+        return drop_object_lock(self.__dict__.copy())
+
     @property
     @abstractmethod
     def random_patch(self):
@@ -59,7 +176,7 @@ class AbstractSample(ABC):
         """
         return 64
 
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -81,7 +198,7 @@ class AbstractSample(ABC):
             # MissAlignment(),
         ])
 
-    @cached_property
+    @locked_cached_property
     def patch_size_before_transform(self):
         return self.output_patch_size + \
             self.transform.shrink_size[:3] + \
@@ -160,6 +277,8 @@ class Sample(AbstractSample):
         
         self.images = images
         self.label = label
+        # the files of label and images if they are loaded from files
+        self.source_paths = None
         
         assert isinstance(self.output_patch_size, Cartesian)
         # for ps, ls in zip(self.output_patch_size, label.shape[-3:]):
@@ -193,23 +312,27 @@ class Sample(AbstractSample):
     #         data = json.load(jf)
     #     return cls.from_dict(data, patch_size=patch_size)
 
-    def load_images(image_paths: List[str]):
+    @staticmethod
+    def load_images(image_paths: List[str], mip: int = None):
         images = []
         for image_path in image_paths:
-            image_vol = load_chunk_or_volume(image_path)
+            image_vol = load_at_mip(image_path, mip=mip)
             images.append(image_vol)
         return images 
     
     @classmethod
     def from_config(cls, cfg: CfgNode, output_patch_size: Cartesian):
-        images = cls.load_images(cfg.images)
+        # read the image and label at a coarser mip level if configured
+        mip = cfg.get('mip', None)
+        images = cls.load_images(cfg.images, mip=mip)
         if 'label' in cfg:
             if cfg.label == 'self':
                 label = None
             else:
-                label = load_chunk_or_volume(cfg.label)
+                label = load_at_mip(cfg.label, mip=mip)
         else:
             label = None
+        check_voxel_sizes(images, label)
 
         return cls(images, label, output_patch_size)
 
@@ -237,17 +360,80 @@ class Sample(AbstractSample):
         patch_num = np.prod(self.center_stop - self.center_start + 1)
         return patch_num
 
-    def patch_from_center(self, center: Cartesian):
+    def label_patch_from_bbox(self, bbox: BoundingBox, image_patch: Chunk):
+        """the label patch in the bounding box.
+
+        Args:
+            bbox (BoundingBox): the global bounding box of patch.
+            image_patch (Chunk): the image patch in the bounding box.
+
+        Returns:
+            Chunk: the label patch. It is None in the self supervised mode.
+        """
+        if self.label is None:
+            return None
+        else:
+            return self.label.cutout(bbox)
+
+    @property
+    def is_self_supervised(self):
+        """the image is also the label."""
+        return self.label is None
+
+    def patch_from_cutouts(self, image_patch: Chunk, label_patch: Chunk = None,
+            shared: bool = False) -> Patch:
+        """make the patch from the cutouts with 5D arrays of buffer pool.
+        In the self supervised mode, the clean label is the image cutout 
+        without copy and only the image is copied for the corruptions.
+
+        Args:
+            image_patch (Chunk): the image cutout.
+            label_patch (Chunk, optional): the label cutout. 
+                Defaults to None, the image is used as label.
+            shared (bool, optional): the cutouts are views of the sample rather than 
+                new arrays. The label view is read only and will be copied 
+                before a transform writes to it. Defaults to False.
+        """
+        # if we do not copy here, the augmentation will change our 
+        # image and label sample!
+        # the copy is written to a preallocated buffer.
+        # the patches created in preallocated buffers are not copied.
+        buffer_pool = get_buffer_pool()
+        if label_patch is None:
+            label_patch = Chunk(self._expand_to_5d(image_patch.array),
+                voxel_offset=image_patch.voxel_offset,
+                voxel_size=image_patch.voxel_size)
+            if shared:
+                label_patch.array.flags.writeable = False
+            image_patch.array = buffer_pool.copy(label_patch.array)
+        else:
+            image_patch.array = buffer_pool.ascontiguousarray(
+                self._expand_to_5d(image_patch.array))
+            label_patch.array = buffer_pool.ascontiguousarray(
+                self._expand_to_5d(label_patch.array))
+
+        assert image_patch.ndim == 5
+        assert label_patch.ndim == 5
+        return Patch(image_patch, label_patch)
+
+    def patch_from_center(self, center: Cartesian, image_index: int = None):
+        """the patch centered at a position relative to the image start.
+
+        Args:
+            center (Cartesian): the patch center.
+            image_index (int, optional): the image to cut out the patch. 
+                Defaults to None, a random image is used.
+        """
         start = center - self.patch_size_before_transform // 2
         bbox = BoundingBox.from_delta(start, self.patch_size_before_transform)
         
-        image = random.choice(self.images)
+        if image_index is None:
+            image = random.choice(self.images)
+        else:
+            image = self.images[image_index]
         bbox += image.bbox.start
         image_patch = image.cutout(bbox)
-        if self.label is None:
-            label_patch = deepcopy(image_patch)
-        else:
-            label_patch = self.label.cutout(bbox)
+        label_patch = self.label_patch_from_bbox(bbox, image_patch)
         
         if image_patch.shape[-3:] != self.patch_size_before_transform.tuple:
             print(f'center: {center}, start: {start}, bbox: {bbox}')
@@ -256,19 +442,15 @@ class Sample(AbstractSample):
         assert image_patch.shape[-1] == image_patch.shape[-2], f'image patch shape: {image_patch.shape}'
         assert image_patch.shape[-3:] == self.patch_size_before_transform.tuple, \
             f'image patch shape: {image_patch.shape}, patch size before transform: {self.patch_size_before_transform}'
-        # if we do not copy here, the augmentation will change our 
-        # image and label sample!
-        image_patch.array = self._expand_to_5d(image_patch.array).copy()
-        label_patch.array = self._expand_to_5d(label_patch.array).copy()
-
-        assert image_patch.ndim == 5
-        assert label_patch.ndim == 5
-
-        return Patch(image_patch, label_patch)
+        return self.patch_from_cutouts(image_patch, label_patch, 
+            shared=isinstance(image, Chunk))
     
     @property
     def random_patch(self):
-        patch = self.patch_from_center(self.random_patch_center)
+        return self.augmented_patch_from_center(self.random_patch_center)
+
+    def augmented_patch_from_center(self, center: Cartesian):
+        patch = self.patch_from_center(center)
 
         # print(f'computed patch size before transform: {self.patch_size_before_transform}')
         # print(f'transforms: {self.transform}') 
@@ -281,8 +463,49 @@ class Sample(AbstractSample):
             f'get patch shape: {patch.shape}, expected patch size {self.output_patch_size}'
         assert patch.ndim == 5
         return patch
+
+    # the number of classes in the block class index. 
+    # The default is background and foreground.
+    block_class_num = 2
+
+    def label_to_class(self, arr: np.ndarray) -> np.ndarray:
+        """the classes of label array used in the block class index."""
+        return arr > 0
+
+    def block_class_counts(self, block_size: Cartesian) -> np.ndarray:
+        """the class voxel numbers of blocks. 
+        It is persisted next to the label file if the label is loaded from a file.
+
+        Returns:
+            np.ndarray: the counts with shape of (grid z, grid y, grid x, block_class_num).
+        """
+        compute = lambda: {'class_counts': block_class_histograms(
+            self.label, block_size, self.block_class_num, 
+            label_to_class=self.label_to_class)}
+        key = f'{tuple(block_size)}:{self.block_class_num}:{type(self).__name__}'
+        return load_or_compute(self.source_paths, '.blocks.npz', compute, 
+            key=key)['class_counts']
+
+    def _block_class_index(self, counts: np.ndarray) -> BlockClassIndex:
+        # the flip and transpose could move the shrinked margin to any side,
+        # so only the region inside the maximum margin is always kept.
+        margin = max(self.transform.shrink_size)
+        size = np.asarray(self.patch_size_before_transform)
+        return BlockClassIndex(counts, DEFAULT_CLASS_BLOCK_SIZE,
+            self.center_start, self.center_stop,
+            patch_start=margin - size // 2,
+            patch_stop=size - size // 2 - margin)
+
+    @locked_cached_property
+    def block_class_index(self) -> BlockClassIndex:
+        """the index to draw patches containing a class.
+        It is None if the sample could not be sampled by class."""
+        if self.label is None:
+            return None
+        return self._block_class_index(
+            self.block_class_counts(DEFAULT_CLASS_BLOCK_SIZE))
     
-    @cached_property
+    @locked_cached_property
     def sampling_weight(self):
         """voxel number of label"""
         weight = int(np.product(tuple(e-b for b, e in zip(
@@ -304,6 +527,8 @@ class SampleWithMask(Sample):
             forbbiden_distance_to_boundary: tuple = None,
             patches_in_block: int = 32,
             candidate_bounding_boxes_path: str = './candidate_bounding_boxes.npy',
+            mask_coverage_threshold: float = None,
+            mask_integral_path: str = None,
             ) -> None:
         """Image sample with ground truth annotations
 
@@ -322,43 +547,98 @@ class SampleWithMask(Sample):
                 direction is defined separately. 
             patches_in_block (int): sample a number of patches in a block.
             candidate_bounding_boxes_path (str): 
+            mask_coverage_threshold (float): sample patches at any position 
+                with a fraction inside the mask not less than this threshold.
+                The fraction is looked up from an integral image of the mask. 
+                Defaults to None, the patches are sampled in the blocks inside the mask.
+            mask_integral_path (str): cache the integral image of mask in this file.
         """
         super().__init__(
             images, label, output_patch_size=output_patch_size, 
             forbbiden_distance_to_boundary=forbbiden_distance_to_boundary)
         assert patches_in_block > 0
         self.mask = mask
-        self.patch_number = 0
         self.patches_in_block = patches_in_block
-        self.image_block = None
-        self.label_block = None
         self.candidate_bounding_boxes_path = candidate_bounding_boxes_path
+        if mask_coverage_threshold is not None:
+            assert 0. < mask_coverage_threshold <= 1.
+        self.mask_coverage_threshold = mask_coverage_threshold
+        self.mask_integral_path = mask_integral_path
 
     @classmethod
     def from_config(cls, config: CfgNode, 
             output_patch_size: Cartesian) -> SampleWithMask:
         
-        images = cls.load_images(config.images)
-        label_vol = load_chunk_or_volume(config.label)
+        # the mask is kept at its own mip level
+        mip = config.get('mip', None)
+        images = cls.load_images(config.images, mip=mip)
+        if config.get('label', 'self') == 'self':
+            # self supervised
+            label_vol = None
+        else:
+            label_vol = load_at_mip(config.label, mip=mip)
         mask_vol = load_chunk_or_volume(config.mask)
-        return cls(images, label_vol, output_patch_size, mask_vol)
+        check_voxel_sizes(images, label_vol, mask_vol)
+        return cls(images, label_vol, output_patch_size, mask_vol,
+            mask_coverage_threshold=config.get('mask_coverage_threshold', None),
+            mask_integral_path=config.get('mask_integral_path', None))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_blocks', None)
+        return state
+
+    @property
+    def block_class_index(self):
+        # the patches are sampled inside the blocks of mask
+        return None
+
+    @locked_cached_property
+    def _blocks(self) -> threading.local:
+        """the block pair and the number of patches drawn from it 
+        in every data loading thread."""
+        return threading.local()
 
-    @cached_property
+    @locked_cached_property
     def voxel_size_factors(self) -> Cartesian:
         return self.mask.voxel_size // self.images[0].voxel_size 
 
-    @cached_property
+    @property
+    def reference_volume(self):
+        """the label or the image of self supervised sample."""
+        return self.images[0] if self.is_self_supervised else self.label
+
+    @locked_cached_property
     def candidate_block_bounding_boxes(self) -> BoundingBoxes:
         if os.path.exists(self.candidate_bounding_boxes_path):
             print(f'loading existing nonzero bounding boxes file: {self.candidate_bounding_boxes_path}')
             bboxes = BoundingBoxes.from_file(self.candidate_bounding_boxes_path)
         else:
             bboxes = get_candidate_block_bounding_boxes_with_different_voxel_size(
-                self.mask, self.label.voxel_size, self.label.block_size
+                self.mask, self.reference_volume.voxel_size, 
+                self.reference_volume.block_size
             )
             bboxes.to_file(self.candidate_bounding_boxes_path)
         return bboxes 
 
+    @locked_cached_property
+    def mask_integral(self) -> MaskIntegral:
+        return MaskIntegral.from_volume(self.mask, self.voxel_size_factors,
+            path=self.mask_integral_path)
+
+    @property
+    def random_patch_inside_mask(self):
+        bbox = self.mask_integral.random_patch_bbox(
+            self.patch_size_before_transform, self.mask_coverage_threshold,
+            self.images[0].bounding_box)
+        image = random.choice(self.images)
+        image_patch = image.cutout(bbox)
+        label_patch = self.label_patch_from_bbox(bbox, image_patch)
+        patch = self.patch_from_cutouts(image_patch, label_patch,
+            shared=isinstance(image, Chunk))
+        self.transform(patch)
+        return patch
+
     @property
     def random_block_pair(self) -> BoundingBox:
         image_volume = random.choice(self.images)
@@ -368,34 +648,58 @@ class SampleWithMask(Sample):
         # with all nonzero mask!
         image_block_bbox = random.choice(self.candidate_block_bounding_boxes)
         image_block = image_volume.cutout(image_block_bbox)
-        label_block = self.label.cutout(image_block_bbox)
-        assert image_block.shape[-3:] == label_block.shape[-3:]
+        if self.is_self_supervised:
+            label_block = None
+        else:
+            label_block = self.label.cutout(image_block_bbox)
+            assert image_block.shape[-3:] == label_block.shape[-3:]
         return (image_block, label_block)
 
     @property
     def random_patch(self):
-        if self.patch_number % self.patches_in_block == 0:
-            self.image_block, self.label_block = self.random_block_pair
-        start_stop = self.image_block.stop - self.patch_size_before_transform
-        start_bbox = BoundingBox(self.image_block.start, start_stop)
+        if self.mask_coverage_threshold is not None:
+            return self.random_patch_inside_mask
+
+        # the threads sharing this sample draw from their own blocks
+        blocks = self._blocks
+        patch_number = getattr(blocks, 'patch_number', 0)
+        if patch_number % self.patches_in_block == 0:
+            blocks.image_block, blocks.label_block = self.random_block_pair
+        blocks.patch_number = patch_number + 1
+        image_block, label_block = blocks.image_block, blocks.label_block
+
+        start_stop = image_block.stop - self.patch_size_before_transform
+        start_bbox = BoundingBox(image_block.start, start_stop)
         start = start_bbox.random_coordinate
         patch_bbox = BoundingBox.from_delta(start, self.patch_size_before_transform)
-        image_patch = self.image_block.cutout(patch_bbox)
-        label_patch = self.label_block.cutout(patch_bbox)
-        patch = Patch(image_patch, label_patch)
+        image_patch = image_block.cutout(patch_bbox)
+        if label_block is None:
+            label_patch = None
+        else:
+            label_patch = label_block.cutout(patch_bbox)
+        # the patches are views of the block, which is reused for several patches
+        patch = self.patch_from_cutouts(image_patch, label_patch, shared=True)
         self.transform(patch)
         return patch
 
-    @cached_property
+    @locked_cached_property
     def sampling_weight(self) -> int:
+        if self.mask_coverage_threshold is not None:
+            return self.mask_integral.patch_start_num(
+                self.patch_size_before_transform, self.mask_coverage_threshold,
+                self.images[0].bounding_box)
+
         block_num = len(self.candidate_block_bounding_boxes)
-        block_size = self.label.block_size * self.voxel_size_factors
+        block_size = self.reference_volume.block_size * self.voxel_size_factors
         return np.product(block_size) * block_num
 
     def __len__(self):
+        if self.mask_coverage_threshold is not None:
+            return self.sampling_weight
+
         # return int(1e100)
         patch_num = len(self.candidate_block_bounding_boxes) * \
-            np.prod(self.label.block_size - self.patch_size_before_transform + 1)
+            np.prod(self.reference_volume.block_size - self.patch_size_before_transform + 1)
         print(f'total patch number: {patch_num}')
         return patch_num
 
@@ -405,23 +709,30 @@ class SampleWithPointAnnotation(Sample):
             images: List[Chunk], 
             annotation_points: np.ndarray,
             output_patch_size: Cartesian, 
-            forbbiden_distance_to_boundary: tuple = None) -> None:
+            forbbiden_distance_to_boundary: tuple = None,
+            expand_distance: int = 2) -> None:
         """Image sample with ground truth annotations
+        The points are kept in a grid index and only the points
+        inside a patch are rasterized when the patch is sampled.
 
         Args:
             image (np.ndarray): image normalized to 0-1
             annotation_points (np.ndarray): point annotations with zyx order.
+                The coordinates are relative to the first image chunk.
             output_patch_size (Cartesian): output patch size
             forbbiden_distance_to_boundary (tuple, optional): sample patches far away 
                 from sample boundary. Defaults to None.
+            expand_distance (int): expand the point annotation to a cube. 
+                This will help to got more positive voxels.
+                The expansion should be small enough to ensure that all the voxels are inside T-bar.
         """
 
         assert annotation_points.shape[1] == 3
         self.annotation_points = annotation_points
-        label = np.zeros_like(images[0].array, dtype=np.float32)
-        label = self._points_to_label(label)
+        self.point_index = PointGridIndex(annotation_points)
+        self.expand_distance = expand_distance
         super().__init__(
-            images, label, 
+            images, None, 
             output_patch_size = output_patch_size,
             forbbiden_distance_to_boundary=forbbiden_distance_to_boundary
         )
@@ -431,32 +742,114 @@ class SampleWithPointAnnotation(Sample):
         """use number of annotated points as weight to sample volume."""
         return int(self.annotation_points.shape[0])
 
-    def _points_to_label(self, label: np.ndarray,
-            expand_distance: int = 2) -> tuple:
-        """transform point annotation to volumes
-
-        Args:
-            expand_distance (int): expand the point annotation to a cube. 
-                This will help to got more positive voxels.
-                The expansion should be small enough to ensure that all the voxels are inside T-bar.
+    def block_class_counts(self, block_size: Cartesian) -> np.ndarray:
+        """the blocks containing points are counted as class 1."""
+        block_size = np.asarray(block_size)
+        grid_shape = tuple(-(-np.asarray(self.images[0].shape[-3:]) // block_size))
+        counts = np.zeros(grid_shape + (2,), dtype=np.int64)
+        counts[..., 0] = np.prod(block_size)
+        blocks = self.annotation_points // block_size
+        inside = np.all((blocks >= 0) & (blocks < grid_shape), axis=1)
+        blocks = blocks[inside]
+        np.add.at(counts[..., 1], tuple(blocks.T), 1)
+        return counts
+
+    @locked_cached_property
+    def block_class_index(self) -> BlockClassIndex:
+        return self._block_class_index(
+            self.block_class_counts(DEFAULT_CLASS_BLOCK_SIZE))
+
+    def label_patch_from_bbox(self, bbox: BoundingBox, image_patch: Chunk):
+        """transform point annotation to label patch
 
         Returns:
-            bin_presyn: binary label of annotated position.
+            Chunk: label patch of annotated position.
         """
-        # assert synapses['resolution'] == [8, 8, 8]
-        # label = np.zeros_like(image, dtype=np.float32)
+        # the point coordinates are relative to the first image
+        start = np.asarray(bbox.start - self.images[0].voxel_offset)
+        shape = self._expand_to_5d(image_patch.array).shape
         # adjust label to 0.05-0.95 for better regularization
         # the effect might be similar with Focal loss!
-        label += 0.05
-        for idx in range(self.annotation_points.shape[0]):
-            coordinate = self.annotation_points[idx, :]
-            label[...,
-                coordinate[0]-expand_distance : coordinate[0]+expand_distance,
-                coordinate[1]-expand_distance : coordinate[1]+expand_distance,
-                coordinate[2]-expand_distance : coordinate[2]+expand_distance,
-            ] = 0.95
-        assert np.any(label > 0.5)
-        return label
+        label = get_buffer_pool().acquire(shape, np.float32)
+        label.fill(0.05)
+        # the cubes of points outside of patch could also cover the patch
+        points = self.point_index.query(
+            start - self.expand_distance, 
+            start + np.asarray(shape[-3:]) + self.expand_distance,
+        )
+        paint_cubes(label, points - start, self.expand_distance, 0.95)
+        return Chunk(label, voxel_offset=image_patch.voxel_offset,
+            voxel_size=image_patch.voxel_size)
+
+
+class CropBankSample(AbstractSample):
+    def __init__(self, crop_bank: CropBank,
+            output_patch_size: Cartesian,
+            expand_distance: int = 2,
+            is_train: bool = True,
+            transform: Compose = None) -> None:
+        """serve synapse centered patches from a memory mapped crop bank.
+        The patch position is randomly jittered inside the crop and 
+        all the annotated points inside the patch are painted.
+
+        Args:
+            crop_bank (CropBank): the crop bank.
+            output_patch_size (Cartesian): output patch size.
+            expand_distance (int, optional): expand the point annotation to a cube. Defaults to 2.
+            is_train (bool, optional): train mode or validation mode. Defaults to True.
+            transform (Compose, optional): the augmentation, normally the one of dataset, 
+                so the patch size before transform matches the crops. 
+                Defaults to None, the default transform of samples.
+        """
+        super().__init__(output_patch_size=output_patch_size, is_train=is_train)
+        if transform is not None:
+            self.transform = transform
+        self.crop_bank = crop_bank
+        self.expand_distance = expand_distance
+        for c, p in zip(crop_bank.crop_size, self.patch_size_before_transform):
+            assert c >= p, f'crop size {crop_bank.crop_size} is smaller than patch size {self.patch_size_before_transform}'
+
+    @classmethod
+    def from_dir(cls, path: str, output_patch_size: Cartesian, **kwargs):
+        return cls(CropBank.from_dir(path), output_patch_size, **kwargs)
+
+    @property
+    def sampling_weight(self):
+        """use number of crops as weight to sample volume."""
+        return len(self.crop_bank)
+
+    def __len__(self):
+        return len(self.crop_bank)
+
+    @property
+    def random_patch(self):
+        index = random.randrange(len(self.crop_bank))
+        version = random.randrange(self.crop_bank.version_num)
+        patch_size = self.patch_size_before_transform
+        start = tuple(random.randint(0, c - p) for c, p in zip(
+            self.crop_bank.crop_size, patch_size))
+        slices = tuple(slice(s, s + p) for s, p in zip(start, patch_size))
+        
+        buffer_pool = get_buffer_pool()
+        # read the crop from memory map directly to the buffer
+        image = buffer_pool.copy(
+            self.crop_bank.images[(index, version, *slices)][np.newaxis, np.newaxis, ...])
+        label = buffer_pool.acquire(image.shape, np.float32)
+        label.fill(0.05)
+        points = self.crop_bank.points_in_crop(index) - np.asarray(start)
+        paint_cubes(label, points, self.expand_distance, 0.95)
+
+        voxel_offset = Cartesian.from_collection(
+            self.crop_bank.offsets[index] + np.asarray(start))
+        patch = Patch(
+            Chunk(image, voxel_offset=voxel_offset),
+            Chunk(label, voxel_offset=voxel_offset),
+        )
+        if self.is_train:
+            self.transform(patch)
+        assert patch.shape[-3:] == self.output_patch_size, \
+            f'get patch shape: {patch.shape}, expected patch size {self.output_patch_size}'
+        return patch
 
 
 class PostSynapseReference(AbstractSample):
@@ -467,6 +860,10 @@ class PostSynapseReference(AbstractSample):
             point_expand: int = 2,
         ):
         """Ground Truth for post synapses
+        The connectivity is kept in compressed sparse row arrays and 
+        the post synapses are kept in a grid index, so all the post synapses
+        inside a patch are painted together, including the ones of neighboring
+        presynapses.
 
         Args:
             synapses (Synapses): including both presynapses and postsynapses
@@ -478,16 +875,25 @@ class PostSynapseReference(AbstractSample):
 
         self.images = images
         self.synapses = synapses
-        self.pre_index2post_indices = synapses.pre_index2post_indices
         self.point_expand = point_expand
 
+        # the post synapses of presynapse i are
+        # post_indices[post_indptr[i] : post_indptr[i+1]]
+        self.post_indptr, self.post_indices = group_to_csr(
+            synapses.post[:, 0], synapses.pre_num)
+        self.pre_indices_with_post = np.nonzero(np.diff(self.post_indptr) > 0)[0]
+        assert len(self.pre_indices_with_post) > 0
+        self.post_index = PointGridIndex(synapses.post_coordinates)
+
+    def post_indices_of_pre(self, pre_index: int) -> np.ndarray:
+        """the indices of post synapses connected to a presynapse."""
+        return self.post_indices[
+            self.post_indptr[pre_index] : self.post_indptr[pre_index+1]]
+
     @property
     def random_patch(self):
-        pre_index = random.randrange(0, self.synapses.pre_num)
+        pre_index = random.choice(self.pre_indices_with_post)
         pre = self.synapses.pre[pre_index, :]
-        
-        post_indices = self.pre_index2post_indices[pre_index]
-        assert len(post_indices) > 0
 
         bbox = BoundingBox.from_center(
             Cartesian(*pre), 
@@ -497,10 +903,14 @@ class PostSynapseReference(AbstractSample):
         image = random.choice(self.images)
         
         # Note that image is 4D array, the first dimension size is 1
+        # the cutout is a view of the image chunk
         image = image.cutout(bbox)
         assert image.dtype == np.uint8
-        image = image.astype(np.float32)
-        image /= 255.
+        buffer_pool = get_buffer_pool()
+        image_array = buffer_pool.acquire(image.shape, np.float32)
+        np.divide(image.array, np.float32(255.), out=image_array, dtype=np.float32)
+        image = Chunk(image_array, voxel_offset=image.voxel_offset,
+            voxel_size=image.voxel_size)
         # pre_label = np.zeros_like(image)
         # pre_label[
             
@@ -514,19 +924,17 @@ class PostSynapseReference(AbstractSample):
         # pre_label = np.expand_dims(pre_label, axis=0)
         # image = np.concatenate((image, pre_label), axis=0)
 
-        label = np.zeros(image.shape, dtype=np.float32)
-        label = Chunk(label, voxel_offset=image.voxel_offset)
-        label += 0.05
-        for post_index in post_indices:
-            assert post_index < self.synapses.post_num
-            coord = self.synapses.post_coordinates[post_index, :]
-            coord = coord - label.voxel_offset
-            label[...,
-                coord[0] - self.point_expand : coord[0] + self.point_expand,
-                coord[1] - self.point_expand : coord[1] + self.point_expand,
-                coord[2] - self.point_expand : coord[2] + self.point_expand,
-            ] = 0.95
-        assert np.any(label > 0.5)
+        label = buffer_pool.acquire(image.shape, np.float32)
+        label.fill(0.05)
+        start = np.asarray(image.voxel_offset)
+        posts = self.post_index.query(
+            start - self.point_expand,
+            start + np.asarray(image.shape[-3:]) + self.point_expand,
+        )
+        paint_cubes(label, posts - start, self.point_expand, 0.95)
+        label = Chunk(label, voxel_offset=image.voxel_offset,
+            voxel_size=image.voxel_size)
+        assert np.any(label.array > 0.5)
 
         return Patch(image, label)
 
@@ -545,6 +953,13 @@ class SemanticSample(Sample):
         # number of classes
         self.num_classes = num_classes
 
+    @property
+    def block_class_num(self):
+        return max(self.num_classes, 2)
+
+    def label_to_class(self, arr: np.ndarray) -> np.ndarray:
+        return arr
+
     @classmethod
     def from_explicit_path(cls, 
             image_paths: list, label_path: str, 
@@ -560,7 +975,9 @@ class SemanticSample(Sample):
             image = load_chunk_or_volume(image_path, **kwargs)
             images.append(image)
             # print(f'image path: {image_path} with size {image.shape}')
-        return cls(images, label, output_patch_size, num_classes=num_classes)
+        sample = cls(images, label, output_patch_size, num_classes=num_classes)
+        sample.source_paths = [label_path, *image_paths]
+        return sample
 
     @classmethod
     def from_label_path(cls, label_path: str, 
@@ -587,15 +1004,29 @@ class SemanticSample(Sample):
         return cls.from_explicit_path(
             image_paths, label_path, output_patch_size, num_classes=num_classes)
 
-    @cached_property
+    @locked_cached_property
+    def statistics(self) -> dict:
+        """the class histogram, foreground voxel number and intensity histogram.
+        They are persisted next to the label file and reused if the files are not changed."""
+        return load_or_compute_statistics(self.label, self.images[0],
+            paths=self.source_paths)
+
+    @locked_cached_property
     def voxel_num(self):
-        return len(self.label)
+        return self.statistics['voxel_num']
 
-    @cached_property
+    @locked_cached_property
+    def foreground_fraction(self):
+        return self.statistics['foreground_voxel_num'] / self.voxel_num
+
+    @locked_cached_property
     def class_counts(self):
-        return np.bincount(self.label.flatten(), minlength=self.num_classes)
+        counts = self.statistics['class_counts']
+        if len(counts) < self.num_classes:
+            counts = np.pad(counts, (0, self.num_classes - len(counts)))
+        return counts
     
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -627,18 +1058,77 @@ class OrganelleSample(SemanticSample):
             forbbiden_distance_to_boundary: tuple = None,
             skip_classes: list = None,
             selected_classes: list = None) -> None:
+        """sample for organelle semantic segmentation.
+        The label is not modified. The classes are remapped in every label patch 
+        with a lookup table, so the samples could share the same label.
+
+        Args:
+            skip_classes (list, optional): the label values larger than every 
+                skipped class are decreased by one. Defaults to None.
+            selected_classes (list, optional): only keep these classes 
+                as a binary label after skipping classes. Defaults to None.
+        """
         super().__init__(images, label, output_patch_size, 
             num_classes=num_classes, 
             forbbiden_distance_to_boundary=forbbiden_distance_to_boundary)
 
-        if skip_classes is not None:
-            for class_idx in skip_classes:
-                self.label.array[self.label.array>class_idx] -= 1
-        
-        if selected_classes is not None:
-            self.label.array = np.isin(self.label.array, selected_classes)
+        self.skip_classes = skip_classes
+        self.selected_classes = selected_classes
+        self._label_lut = None
+
+    @property
+    def remaps_label(self):
+        return self.skip_classes is not None or self.selected_classes is not None
+
+    def label_lut(self, max_label: int) -> np.ndarray:
+        """the lookup table from original label to the remapped one.
+        It is extended if a larger label value appears.
+
+        Args:
+            max_label (int): the maximum label value to cover.
+        """
+        lut = self._label_lut
+        if lut is None or len(lut) <= max_label:
+            lut = np.arange(max_label + 1, dtype=self.label.dtype)
+            if self.skip_classes is not None:
+                for class_idx in self.skip_classes:
+                    lut[lut>class_idx] -= 1
+            if self.selected_classes is not None:
+                lut = np.isin(lut, self.selected_classes)
+            self._label_lut = lut
+        return lut
+
+    def label_to_class(self, arr: np.ndarray) -> np.ndarray:
+        if not self.remaps_label:
+            return arr
+        return self.label_lut(int(arr.max()))[arr]
+
+    def label_patch_from_bbox(self, bbox: BoundingBox, image_patch: Chunk):
+        label_patch = super().label_patch_from_bbox(bbox, image_patch)
+        if not self.remaps_label:
+            return label_patch
+
+        arr = label_patch.array
+        lut = self.label_lut(int(arr.max()))
+        # write to a new buffer, the original label is shared and not modified.
+        buffer_pool = get_buffer_pool()
+        buf = buffer_pool.acquire(
+            (1,) * max(5 - arr.ndim, 0) + arr.shape, lut.dtype)
+        np.take(lut, arr, out=buf.reshape(arr.shape))
+        buffer_pool.release(arr)
+        label_patch.array = buf.reshape(arr.shape)
+        return label_patch
+
+    @locked_cached_property
+    def class_counts(self):
+        counts = self.statistics['class_counts']
+        if not self.remaps_label:
+            return super().class_counts
+        lut = self.label_lut(len(counts) - 1)
+        return np.bincount(lut.astype(np.int64), weights=counts,
+            minlength=self.num_classes).astype(np.int64)
     
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -667,7 +1157,55 @@ class AffinityMapSample(SemanticSample):
             label: Union[np.ndarray, Chunk], 
             output_patch_size: Cartesian, 
             forbbiden_distance_to_boundary: tuple = None,
-            num_classes: int = 3) -> None:
+            num_classes: int = 3,
+            label_to_affinity: bool = True,
+            precomputed_affinity: bool = False,
+            context_images: List[Chunk | AbstractVolume] = None,
+            context_patch_size: Cartesian = None,
+            context_factor: Cartesian = None) -> None:
+        """sample for affinity map training
+
+        Args:
+            label_to_affinity (bool, optional): transform the label to nearest 
+                neighbor affinity map in the data loading worker. Otherwise, a compact 
+                segmentation is provided and the affinity map should be computed 
+                in the trainer. Defaults to True.
+            precomputed_affinity (bool, optional): compute the affinity map of the 
+                whole label chunk once and cut out patches from it. The contacts
+                are removed from the label in place before augmentation, so the 
+                contacts created by MissAlignment are not removed. Defaults to False.
+            context_images (List[Chunk | AbstractVolume], optional): the images 
+                at a lower resolution. Every patch comes with a larger context crop 
+                co-centered with it from the same image. Defaults to None.
+            context_patch_size (Cartesian, optional): the size of context crop 
+                in context voxels. Defaults to None.
+            context_factor (Cartesian, optional): the context voxel size divided by
+                the image voxel size. Defaults to None, computed from the voxel sizes.
+        """
+        if context_images is not None:
+            assert len(context_images) == len(images)
+            assert context_patch_size is not None
+            context_patch_size = Cartesian.from_collection(context_patch_size)
+            if images[0].voxel_size is not None and \
+                    context_images[0].voxel_size is not None:
+                factor = context_factor_of(images, context_images)
+                assert context_factor is None or \
+                    Cartesian.from_collection(context_factor) == factor, \
+                    f'the context factor {context_factor} is not the voxel size ratio {factor}'
+                context_factor = factor
+            assert context_factor is not None
+            context_factor = Cartesian.from_collection(context_factor)
+        self.context_images = context_images
+        self.context_patch_size = context_patch_size
+        self.context_factor = context_factor
+
+        if precomputed_affinity:
+            assert label_to_affinity
+            assert isinstance(label, Chunk), \
+                'only support precomputed affinity map for label chunk.'
+        # the transform is used to compute patch size in the construction
+        self.label_to_affinity = label_to_affinity
+        self.precomputed_affinity = precomputed_affinity
         super().__init__(
             images, label, output_patch_size, 
             num_classes=num_classes,
@@ -690,7 +1228,9 @@ class AffinityMapSample(SemanticSample):
             image = load_chunk_or_volume(image_path, **kwargs)
             images.append(image)
             # print(f'image path: {image_path} with size {image.shape}')
-        return cls(images, label, output_patch_size, num_classes=num_classes)
+        sample = cls(images, label, output_patch_size, num_classes=num_classes)
+        sample.source_paths = [label_path, *image_paths]
+        return sample
     
     @classmethod
     def from_explicit_dict(cls, 
@@ -707,25 +1247,135 @@ class AffinityMapSample(SemanticSample):
             cfg: CfgNode,
             output_patch_size: Cartesian,
             num_classes: int=3,
+            label_to_affinity: bool = True,
+            precomputed_affinity: bool = False,
+            compress: bool = False,
+            mip: int = None,
+            context_mip: int = None,
+            context_patch_size: Cartesian = None,
+            context_factor: Cartesian = None,
             **kwargs,
         ):
+        """construct a sample from the configuration node of sample.
+
+        Args:
+            compress (bool, optional): store the label and image chunks as 
+                compressed blocks in RAM. Defaults to False.
+            mip (int, optional): read the image and label at this mip level.
+                The mip in the sample configuration takes precedence. 
+                Defaults to None, the default level of volumes.
+            context_mip (int, optional): read the context crops of patches 
+                from the images at this coarser mip level. 
+                The context_mip in the sample configuration takes precedence.
+                Defaults to None, no context crop.
+            context_patch_size (Cartesian, optional): the size of context crop.
+                Defaults to None.
+            context_factor (Cartesian, optional): the expected context voxel size 
+                divided by the image voxel size. Defaults to None.
+        """
+        assert not (compress and precomputed_affinity), \
+            'the precomputed affinity map requires a raw label chunk.'
+        mip = cfg.get('mip', mip)
         label_path = os.path.join(cfg.dir, cfg.label)
-        label = load_chunk_or_volume(label_path, **kwargs)
+        label = load_at_mip(label_path, mip=mip, **kwargs)
 
         images = []
         for image_fname in cfg.images:
             image_path = os.path.join(cfg.dir, image_fname)
-            image = load_chunk_or_volume(image_path, **kwargs)
+            image = load_at_mip(image_path, mip=mip, **kwargs)
             assert image.shape[-3:] == label.shape[-3:], \
                 f'image shape: {image.shape}, label shape: {label.shape}, file name: {image_path}'
             assert image.voxel_offset == label.voxel_offset, \
                 f'image voxel offset: {image.voxel_offset}, label voxel offset: {label.voxel_offset}, file name: {image_path}'
             images.append(image)
+        check_voxel_sizes(images, label)
+
+        context_mip = cfg.get('context_mip', context_mip)
+        if context_mip is None:
+            context_images = None
+        else:
+            context_images = [load_at_mip(os.path.join(cfg.dir, image_fname), 
+                mip=context_mip, **kwargs) for image_fname in cfg.images]
+
+        if compress:
+            label = _compress_chunk(label)
+            images = [_compress_chunk(image) for image in images]
+
+        sample = cls(images, label, output_patch_size, num_classes=num_classes,
+            label_to_affinity=label_to_affinity,
+            precomputed_affinity=precomputed_affinity,
+            context_images=context_images,
+            context_patch_size=context_patch_size,
+            context_factor=context_factor)
+        sample.source_paths = [label_path, *[os.path.join(cfg.dir, image_fname) 
+            for image_fname in cfg.images]]
+        return sample
+
+    # the label is a segmentation rather than classes
+    block_class_num = Sample.block_class_num
+    label_to_class = Sample.label_to_class
+
+    @locked_cached_property
+    def packed_affinity(self):
+        """the bit packed affinity map of the whole label.
+        It is computed lazily, so every data loading worker computes it once.
+        The contacts are removed from copies of label blocks and kept as a 
+        bit mask, so the label of sample is not modified."""
+        seg = self.label.array[(0,) * (self.label.ndim - 3)]
+        packed_affinity = PackedAffinityMap.from_segmentation(seg, 
+            remove_contact=True)
+        print(f'precomputed affinity map of label {self.label.bbox} with {packed_affinity.nbytes / 1e6 :.1f} MB.')
+        return packed_affinity
 
-        return cls(images, label, output_patch_size, num_classes=num_classes)
+    @property
+    def has_context(self):
+        return self.context_images is not None
+
+    def context_patch(self, image_index: int, bbox: BoundingBox) -> Chunk:
+        """the context crop co-centered with a patch.
+
+        Args:
+            image_index (int): the image of patch.
+            bbox (BoundingBox): the global bounding box of patch.
+
+        Returns:
+            Chunk: the context crop. The region outside of the image is zero.
+        """
+        center = bbox.start + bbox.shape // 2
+        context_center = center // self.context_factor
+        context_bbox = BoundingBox.from_delta(
+            context_center - self.context_patch_size // 2, 
+            self.context_patch_size)
+        return cutout_with_padding(self.context_images[image_index], context_bbox)
+
+    def patch_from_center(self, center: Cartesian, image_index: int = None):
+        if image_index is None and self.has_context:
+            # the context crop is from the same image
+            image_index = random.randrange(len(self.images))
+
+        if not self.precomputed_affinity:
+            patch = super().patch_from_center(center, image_index=image_index)
+        else:
+            packed_affinity = self.packed_affinity
+            patch = super().patch_from_center(center, image_index=image_index)
+            start = patch.label.voxel_offset - self.label.voxel_offset
+            affinity = packed_affinity.cutout(start, patch.label.shape[-3:])
+            # the label patch is a copy. Remove the contacts in it, so the
+            # transforms updating the affinity map from the label are consistent.
+            patch.label.array[..., packed_affinity.contact_cutout(
+                start, patch.label.shape[-3:])] = 0
+            patch.affinity = Chunk(
+                np.expand_dims(affinity, axis=0),
+                voxel_offset=patch.label.voxel_offset,
+                voxel_size=patch.label.voxel_size,
+            )
+
+        if self.has_context:
+            patch.context = self.context_patch(image_index, patch.image.bbox)
+        return patch
 
 
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -743,7 +1393,8 @@ class AffinityMapSample(SemanticSample):
             Flip(),
             Transpose(),
             MissAlignment(),
-            Label2AffinityMap(probability=1.),
+            Label2AffinityMap(probability=1.) if self.label_to_affinity \
+                else CompactSegmentation(probability=1.),
         ])
 
 
@@ -751,7 +1402,7 @@ class AffinityMapSampleWithMask(SampleWithMask):
     def __init__(self, images: List[PrecomputedVolume], label: Union[Chunk, PrecomputedVolume], output_patch_size: Cartesian, mask: Chunk | PrecomputedVolume, forbbiden_distance_to_boundary: tuple = None, patches_in_block: int = 8, candidate_bounding_boxes_path: str = './candidate_bounding_boxes.npy') -> None:
         super().__init__(images, label, output_patch_size, mask, forbbiden_distance_to_boundary, patches_in_block, candidate_bounding_boxes_path)
     
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -772,14 +1423,17 @@ class AffinityMapSampleWithMask(SampleWithMask):
             Label2AffinityMap(probability=1.),
         ])
 
-class SelfSupervisedSample(SampleWithMask):
+class SelfSupervisedSample(Sample):
     def __init__(self, 
             images: List[Chunk], 
-            label: Union[np.ndarray, Chunk], 
             output_patch_size: Cartesian,
-            normalize: bool = False, 
             forbbiden_distance_to_boundary: tuple = None) -> None:
-        super().__init__(images, label, output_patch_size, forbbiden_distance_to_boundary)
+        """the image is both the input and the clean target.
+        The target is a view of the image cutout 
+        and the corruptions are only applied to a copy of it.
+        """
+        super().__init__(images, None, output_patch_size, 
+            forbbiden_distance_to_boundary=forbbiden_distance_to_boundary)
 
     @classmethod
     def from_explicit_paths(cls, 
@@ -791,21 +1445,21 @@ class SelfSupervisedSample(SampleWithMask):
         Note that the first image will be used a reference or ground truth.
 
         Args:
-            image_paths (list): _description_
-            output_patch_size (Cartesian): _description_
+            image_paths (list): the image paths. Only one image is supported.
+            output_patch_size (Cartesian): the output patch size.
 
         Returns:
-            _type_: _description_
+            SelfSupervisedSample: the sample.
         """
         assert len(image_paths) == 1
         image = load_chunk_or_volume(image_paths[0], **kwargs)
-            # print(f'image path: {image_path} with size {image.shape}')
-        return cls([image], image, output_patch_size)
+        return cls([image], output_patch_size)
 
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
-            NormalizeTo01(probability=1.),
+            # the clean target is normalized to a new buffer
+            NormalizeTo01(probability=1., normalize_label=True),
             AdjustContrast(),
             AdjustBrightness(),
             Gamma(),
@@ -856,7 +1510,7 @@ class NeuropilMaskSample(Sample):
     #def random_patch_center(self):
     #    """biased to mask boundary"""
     
-    @cached_property
+    @locked_cached_property
     def transform(self):
         return Compose([
             NormalizeTo01(probability=1.),
@@ -0,0 +1,235 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+
+# number of z sections to read and count in one task
+DEFAULT_SLAB_THICKNESS = 16
+# the bins of intensity histogram
+INTENSITY_BIN_NUM = 256
+STATISTICS_FILE_SUFFIX = '.statistics.npz'
+
+
+def _slab_bounding_boxes(bbox: BoundingBox, thickness: int):
+    for z in range(bbox.start[0], bbox.stop[0], thickness):
+        start = Cartesian(z, bbox.start[1], bbox.start[2])
+        stop = Cartesian(min(z + thickness, bbox.stop[0]), bbox.stop[1], bbox.stop[2])
+        yield BoundingBox(start, stop)
+
+
+def _slab_array(data, bbox: BoundingBox) -> np.ndarray:
+    """the array of a slab without copying the chunk."""
+    if isinstance(data, Chunk):
+        start = bbox.start - data.voxel_offset
+        stop = bbox.stop - data.voxel_offset
+        return data.array[..., start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    else:
+        # compressed chunk or volume
+        return data.cutout(bbox).array
+
+
+def _map_slabs(data, func, num_threads: int, thickness: int):
+    bboxes = list(_slab_bounding_boxes(data.bbox, thickness))
+    task = lambda bbox: func(_slab_array(data, bbox))
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        return list(executor.map(task, bboxes))
+
+
+def _sum_bincounts(counts: list, minlength: int = 0) -> np.ndarray:
+    length = max([minlength] + [len(c) for c in counts])
+    total = np.zeros((length,), dtype=np.int64)
+    for c in counts:
+        total[:len(c)] += c
+    return total
+
+
+def label_histogram(label, num_threads: int = None,
+        thickness: int = DEFAULT_SLAB_THICKNESS) -> np.ndarray:
+    """the voxel number of every label value.
+    The label is counted slab by slab in a thread pool,
+    so the whole volume is never flattened or copied.
+
+    Args:
+        label (Chunk | CompressedChunk | AbstractVolume): the label with nonnegative integers.
+        num_threads (int, optional): the number of threads. Defaults to None, the number of CPUs.
+        thickness (int, optional): the number of sections of a slab. Defaults to DEFAULT_SLAB_THICKNESS.
+
+    Returns:
+        np.ndarray: the histogram.
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    # only one slab is converted for the unsigned 64 bit label
+    counts = _map_slabs(label, 
+        lambda arr: np.bincount(arr.ravel().astype(np.intp, copy=False)),
+        num_threads, thickness)
+    return _sum_bincounts(counts)
+
+
+def intensity_histogram(image, num_threads: int = None,
+        thickness: int = DEFAULT_SLAB_THICKNESS) -> np.ndarray:
+    """the intensity histogram with INTENSITY_BIN_NUM bins.
+    The integer images use one bin for every value in [0, 256).
+    The float images are expected to be normalized to [0, 1].
+
+    Args:
+        image (Chunk | CompressedChunk | AbstractVolume): the image.
+        num_threads (int, optional): the number of threads. Defaults to None, the number of CPUs.
+        thickness (int, optional): the number of sections of a slab. Defaults to DEFAULT_SLAB_THICKNESS.
+
+    Returns:
+        np.ndarray: the histogram.
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    if np.issubdtype(image.dtype, np.integer):
+        assert image.dtype.itemsize == 1, 'only support 8 bit integer image.'
+        func = lambda arr: np.bincount(arr.ravel().view(np.uint8),
+            minlength=INTENSITY_BIN_NUM)
+    else:
+        func = lambda arr: np.histogram(arr, bins=INTENSITY_BIN_NUM, range=(0., 1.))[0]
+    counts = _map_slabs(image, func, num_threads, thickness)
+    return _sum_bincounts(counts, minlength=INTENSITY_BIN_NUM)
+
+
+def file_signature(paths: list) -> str:
+    """the signature of files with path, modification time and size.
+    A modified file will get a new signature.
+    """
+    hasher = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        hasher.update(f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+    return hasher.hexdigest()
+
+
+def compute_statistics(label, image, num_threads: int = None) -> dict:
+    """the statistics of a sample.
+
+    Args:
+        label (Chunk | CompressedChunk | AbstractVolume): the label.
+        image (Chunk | CompressedChunk | AbstractVolume): the image.
+        num_threads (int, optional): the number of threads. Defaults to None, the number of CPUs.
+
+    Returns:
+        dict: class_counts, voxel_num, foreground_voxel_num and intensity_histogram.
+    """
+    class_counts = label_histogram(label, num_threads=num_threads)
+    voxel_num = int(class_counts.sum())
+    return {
+        'class_counts': class_counts,
+        'voxel_num': voxel_num,
+        'foreground_voxel_num': voxel_num - int(class_counts[0]),
+        'intensity_histogram': intensity_histogram(image, num_threads=num_threads),
+    }
+
+
+def load_or_compute(paths: list, suffix: str, compute, key: str = '') -> dict:
+    """load the arrays persisted next to the first file
+    or compute and persist them if the files changed.
+
+    Args:
+        paths (list): the source files. The result is saved next to the first one.
+            None or missing files disable the persistence.
+        suffix (str): the suffix of saved file name.
+        compute (callable): compute a dict of arrays.
+        key (str, optional): the parameters of computation. 
+            A different key invalidates the saved result. Defaults to ''.
+
+    Returns:
+        dict: the arrays.
+    """
+    if paths is None or not all(os.path.isfile(path) for path in paths):
+        return compute()
+
+    signature = file_signature(paths) + key
+    result_path = paths[0] + suffix
+    if os.path.exists(result_path):
+        try:
+            with np.load(result_path) as data:
+                if str(data['signature']) == signature:
+                    return {name: data[name] for name in data.files if name != 'signature'}
+        except (OSError, KeyError, ValueError) as err:
+            print(f'ignore the broken file {result_path}: {err}')
+
+    start = time()
+    result = compute()
+    print(f'computed {result_path} in {time() - start:.1f} seconds.')
+    try:
+        # write to a temporary file and rename it,
+        # so the concurrent readers will never get a partial file.
+        tmp_path = f'{result_path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, signature=signature, **result)
+        os.replace(tmp_path, result_path)
+    except OSError as err:
+        print(f'failed to save {result_path}: {err}')
+    return result
+
+
+def load_or_compute_statistics(label, image, paths: list = None,
+        num_threads: int = None) -> dict:
+    """load the statistics persisted next to the label file
+    or compute and persist them if the files changed.
+
+    Args:
+        label (Chunk | CompressedChunk | AbstractVolume): the label.
+        image (Chunk | CompressedChunk | AbstractVolume): the image.
+        paths (list, optional): the label path followed by the image paths.
+            Defaults to None, the statistics are computed without persistence.
+        num_threads (int, optional): the number of threads. Defaults to None, the number of CPUs.
+
+    Returns:
+        dict: the statistics.
+    """
+    statistics = load_or_compute(paths, STATISTICS_FILE_SUFFIX,
+        lambda: compute_statistics(label, image, num_threads=num_threads))
+    statistics['voxel_num'] = int(statistics['voxel_num'])
+    statistics['foreground_voxel_num'] = int(statistics['foreground_voxel_num'])
+    return statistics
+
+
+def block_class_histograms(label, block_size: Cartesian, num_classes: int,
+        label_to_class = None, num_threads: int = None) -> np.ndarray:
+    """the class histogram of every block.
+    Every thread counts a slab of blocks, so the whole volume is never copied.
+
+    Args:
+        label (Chunk | CompressedChunk | AbstractVolume): the label.
+        block_size (Cartesian): the block size. The last blocks could be smaller.
+        num_classes (int): the number of classes.
+        label_to_class (callable, optional): map a label array to class array.
+            Defaults to None, the label values are the classes.
+        num_threads (int, optional): the number of threads. Defaults to None, the number of CPUs.
+
+    Returns:
+        np.ndarray: the voxel numbers with shape of (grid z, grid y, grid x, num_classes).
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count()
+    block_size = Cartesian.from_collection(block_size)
+    grid_shape = tuple(-(-s // b) for s, b in zip(label.shape[-3:], block_size))
+
+    def count_slab(arr: np.ndarray):
+        arr = arr[(0,) * (arr.ndim - 3)]
+        if label_to_class is not None:
+            arr = label_to_class(arr)
+        counts = np.zeros(grid_shape[1:] + (num_classes,), dtype=np.int64)
+        for gy in range(grid_shape[1]):
+            for gx in range(grid_shape[2]):
+                block = arr[:, gy*block_size[1] : (gy+1)*block_size[1],
+                    gx*block_size[2] : (gx+1)*block_size[2]]
+                block_counts = np.bincount(
+                    block.ravel().astype(np.intp, copy=False), minlength=num_classes)
+                assert len(block_counts) == num_classes, \
+                    f'label value is larger than the number of classes: {num_classes}'
+                counts[gy, gx, :] = block_counts
+        return counts
+
+    counts = _map_slabs(label, count_slab, num_threads, block_size[0])
+    return np.stack(counts, axis=0)
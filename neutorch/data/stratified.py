@@ -0,0 +1,130 @@
+import numpy as np
+
+from chunkflow.lib.cartesian_coordinate import Cartesian
+
+from neutorch.data.rng import random
+
+
+DEFAULT_BLOCK_SIZE = Cartesian(32, 32, 32)
+
+
+class AliasTable(object):
+    def __init__(self, weights: np.ndarray):
+        """Sample an index with probability proportional to its weight in O(1).
+        This is the alias method of Vose.
+
+        Args:
+            weights (np.ndarray): the nonnegative weights. At least one should be positive.
+        """
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        assert np.all(weights >= 0)
+        total = weights.sum()
+        assert total > 0, 'all the weights are zero.'
+        num = len(weights)
+
+        scaled = weights * (num / total)
+        self.prob = np.ones((num,), dtype=np.float64)
+        self.alias = np.arange(num, dtype=np.int64)
+        small = list(np.flatnonzero(scaled < 1.))
+        large = list(np.flatnonzero(scaled >= 1.))
+        while len(small) > 0 and len(large) > 0:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            if scaled[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+        # the remaining ones are 1 with numerical error
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self) -> int:
+        index = random.randrange(len(self.prob))
+        if random.random() < self.prob[index]:
+            return index
+        else:
+            return int(self.alias[index])
+
+
+class BlockClassIndex(object):
+    def __init__(self, class_counts: np.ndarray, block_size: Cartesian,
+            center_start: Cartesian, center_stop: Cartesian,
+            patch_start: Cartesian, patch_stop: Cartesian):
+        """An index of the classes in blocks of a sample.
+        For every block, the patch centers are the ones whose patch covers the whole block,
+        so the patches drawn for a class contain it.
+        If no valid patch covers the block, for example the block is close to the 
+        sample boundary, the patches overlapping with the block are used.
+
+        Args:
+            class_counts (np.ndarray): the class voxel numbers of blocks
+                with shape of (grid z, grid y, grid x, num_classes).
+            block_size (Cartesian): the block size.
+            center_start (Cartesian): the start of patch centers, inclusive.
+            center_stop (Cartesian): the stop of patch centers, exclusive.
+            patch_start (Cartesian): the start of the patch region always kept 
+                after transform relative to the center. It is normally negative.
+            patch_stop (Cartesian): the stop of the patch region relative to the center.
+        """
+        assert class_counts.ndim == 4
+        self.class_counts = class_counts
+        self.block_size = Cartesian.from_collection(block_size)
+        self.center_start = np.asarray(center_start, dtype=np.int64)
+        self.center_stop = np.asarray(center_stop, dtype=np.int64)
+
+        grid_shape = class_counts.shape[:3]
+        block_size = np.asarray(self.block_size)
+        starts = []
+        stops = []
+        for axis in range(3):
+            block_start = np.arange(grid_shape[axis]) * block_size[axis]
+            block_stop = block_start + block_size[axis]
+            # the centers of patches covering the block
+            start = np.maximum(block_stop - patch_stop[axis], self.center_start[axis])
+            stop = np.minimum(block_start - patch_start[axis] + 1, self.center_stop[axis])
+            # the centers of patches overlapping with the block
+            overlap_start = np.maximum(block_start - patch_stop[axis] + 1, self.center_start[axis])
+            overlap_stop = np.minimum(block_stop - patch_start[axis], self.center_stop[axis])
+            covered = stop > start
+            starts.append(np.where(covered, start, overlap_start))
+            stops.append(np.where(covered, stop, overlap_stop))
+        self.starts = np.stack(np.meshgrid(*starts, indexing='ij'), axis=-1).reshape(-1, 3)
+        self.stops = np.stack(np.meshgrid(*stops, indexing='ij'), axis=-1).reshape(-1, 3)
+        # the number of patch centers of every block.
+        # the centers covering several blocks are counted several times.
+        self.center_nums = np.prod(np.maximum(self.stops - self.starts, 0), axis=-1)
+        self._alias_tables = {}
+
+    @property
+    def num_classes(self):
+        return self.class_counts.shape[-1]
+
+    def class_weight(self, class_index: int) -> int:
+        """the number of patch centers of the blocks containing a class."""
+        return int(self.center_nums[self._contains(class_index)].sum())
+
+    def _contains(self, class_index: int) -> np.ndarray:
+        return self.class_counts[..., class_index].ravel() > 0
+
+    def random_center(self, class_index: int = None) -> Cartesian:
+        """draw a block containing a class and a patch center of it.
+
+        Args:
+            class_index (int, optional): the class. Defaults to None, all the blocks are used.
+
+        Returns:
+            Cartesian: the patch center.
+        """
+        if class_index not in self._alias_tables:
+            weights = self.center_nums.copy()
+            if class_index is not None:
+                weights[~self._contains(class_index)] = 0
+            self._alias_tables[class_index] = AliasTable(weights)
+        block_index = self._alias_tables[class_index].sample()
+        start = self.starts[block_index]
+        stop = self.stops[block_index]
+        return Cartesian(*(random.randrange(b, e) for b, e in zip(start, stop)))
@@ -1,191 +1,290 @@
 import os
 import math
-import random
 from typing import Union
-from time import time, sleep
+from time import time
 
 import numpy as np
-import h5py
 
 from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+from chunkflow.volume import load_chunk_or_volume, AbstractVolume
 
-import torch
-import toml
+from neutorch.data.rng import random
+from neutorch.data.patch import Patch
+from neutorch.data.buffer import get_buffer_pool
+from neutorch.data.lazy import locked_cached_property
+from neutorch.data.sample import AbstractSample
+from neutorch.data.dataset import DatasetBase
+from neutorch.data.transform import Compose, Flip, Transpose
 
-from neutorch.data.sample import ReferenceVolume
-from neutorch.data.transform import *
 
+# the electron microscopy images are normally anisotropic in z
+DEFAULT_FACTOR = Cartesian(4, 1, 1)
+DOWNSAMPLING_KERNELS = ('box', 'gaussian')
+# the same with scipy.ndimage.gaussian_filter
+DEFAULT_TRUNCATE = 4.
 
-def image_reader(path: str):
-    with h5py.File(path, 'r') as file:
-        img = np.asarray(file['main'])
-    # the last one is affine transformation matrix in torchio image type
-    return img, None
 
+def downsampling_kernel(factor: int, kernel: str = 'box',
+        truncate: float = DEFAULT_TRUNCATE):
+    """the taps and weights to compute a low resolution voxel along an axis.
+    The tap positions are relative to the start of high resolution voxels
+    covered by the low resolution voxel.
 
-class Dataset(torch.utils.data.Dataset):
-    def __init__(self, config_file: str, 
+    Args:
+        factor (int): the downsampling factor of this axis.
+        kernel (str, optional): box or gaussian. Defaults to 'box'.
+        truncate (float, optional): truncate the gaussian kernel at
+            this many standard deviations. Defaults to DEFAULT_TRUNCATE.
+
+    Returns:
+        tuple: the tap positions and the normalized weights.
+    """
+    assert factor >= 1
+    assert kernel in DOWNSAMPLING_KERNELS, f'unsupported kernel: {kernel}'
+    if kernel == 'box' or factor == 1:
+        taps = np.arange(factor)
+        weights = np.ones((factor,), dtype=np.float64)
+    else:
+        # the same anti-aliasing sigma with skimage.transform.rescale
+        sigma = (factor - 1) / 2.
+        center = (factor - 1) / 2.
+        radius = truncate * sigma
+        taps = np.arange(math.floor(center - radius), math.ceil(center + radius) + 1)
+        weights = np.exp(-0.5 * ((taps - center) / sigma) ** 2)
+    return taps, weights / weights.sum()
+
+
+def _downsample_axis(arr: np.ndarray, factor: int, axis: int, kernel: str):
+    taps, weights = downsampling_kernel(factor, kernel=kernel)
+    size = arr.shape[axis] // factor
+    pad = (max(-int(taps[0]), 0), max(int(taps[-1]) - factor + 1, 0))
+    if pad != (0, 0):
+        pad_width = [(0, 0)] * arr.ndim
+        pad_width[axis] = pad
+        # the scipy reflect mode is the numpy symmetric mode
+        arr = np.pad(arr, pad_width, mode='symmetric')
+
+    # only the kept voxels are computed with strided views
+    out = np.zeros(arr.shape[:axis] + (size,) + arr.shape[axis+1:], dtype=np.float32)
+    index = [slice(None)] * arr.ndim
+    for tap, weight in zip(taps, weights):
+        start = int(tap) + pad[0]
+        index[axis] = slice(start, start + size * factor, factor)
+        out += np.float32(weight) * arr[tuple(index)]
+    return out
+
+
+def downsample(arr: np.ndarray, factor: Cartesian, kernel: str = 'box') -> np.ndarray:
+    """downsample a 3D array with a separable kernel.
+    The axes with a factor of 1 are not touched.
+
+    Args:
+        arr (np.ndarray): the 3D array.
+        factor (Cartesian): the downsampling factor of z, y and x.
+        kernel (str, optional): box or gaussian. Defaults to 'box'.
+
+    Returns:
+        np.ndarray: the downsampled array with the same data type.
+    """
+    assert arr.ndim == 3
+    out = arr
+    for axis, f in enumerate(factor):
+        if f > 1:
+            out = _downsample_axis(out, f, axis, kernel)
+    if out is arr:
+        return arr.copy()
+    if np.issubdtype(arr.dtype, np.integer):
+        info = np.iinfo(arr.dtype)
+        np.rint(out, out=out)
+        np.clip(out, info.min, info.max, out=out)
+    return out.astype(arr.dtype)
+
+
+def upsample_nearest(arr: np.ndarray, factor: Cartesian,
+        out: np.ndarray = None) -> np.ndarray:
+    """repeat every voxel of a 3D array factor times in one pass.
+
+    Args:
+        arr (np.ndarray): the 3D array.
+        factor (Cartesian): the upsampling factor of z, y and x.
+        out (np.ndarray, optional): the output array. Defaults to None.
+
+    Returns:
+        np.ndarray: the upsampled array.
+    """
+    assert arr.ndim == 3
+    shape = tuple(s * f for s, f in zip(arr.shape, factor))
+    if out is None:
+        out = np.empty(shape, dtype=arr.dtype)
+    assert out.shape == shape
+    blocks = out.reshape(arr.shape[0], factor[0],
+        arr.shape[1], factor[1], arr.shape[2], factor[2])
+    blocks[...] = arr[:, np.newaxis, :, np.newaxis, :, np.newaxis]
+    return out
+
+
+class SuperResolutionSample(AbstractSample):
+    def __init__(self, image: Union[Chunk, AbstractVolume],
+            output_patch_size: Cartesian,
+            factor: Cartesian = DEFAULT_FACTOR,
+            kernel: str = 'box',
+            is_train: bool = True):
+        """Pairs of low and high resolution patches.
+        The high resolution patches are cut out from the image or volume and
+        the low resolution ones are derived from them with a downsampling kernel.
+        The low resolution patch is upsampled with the nearest neighbor to
+        have the same shape, so the model input and output are aligned.
+        The patches stay uint8 and should be normalized in the trainer.
+
+        Args:
+            image (Chunk | AbstractVolume): the high resolution image.
+                The volume is read patch by patch without loading in RAM.
+            output_patch_size (Cartesian): the patch size.
+                It should be divisible by the factor.
+            factor (Cartesian, optional): the downsampling factor of z, y and x.
+                Defaults to DEFAULT_FACTOR.
+            kernel (str, optional): box or gaussian. Defaults to 'box'.
+            is_train (bool, optional): augment the patches or not. Defaults to True.
+        """
+        super().__init__(output_patch_size, is_train=is_train)
+        factor = Cartesian.from_collection(factor)
+        assert kernel in DOWNSAMPLING_KERNELS, f'unsupported kernel: {kernel}'
+        for p, f in zip(self.output_patch_size, factor):
+            assert f >= 1 and p % f == 0, \
+                f'patch size {self.output_patch_size} should be divisible by the factor {factor}'
+        for s, p in zip(image.shape[-3:], self.output_patch_size):
+            assert s >= p, f'image shape {image.shape} is smaller than the patch size.'
+        self.image = image
+        self.factor = factor
+        self.kernel = kernel
+
+    @classmethod
+    def from_path(cls, path: str, output_patch_size: Cartesian, **kwargs):
+        image = load_chunk_or_volume(path)
+        assert image.dtype == np.uint8, \
+            f'only support uint8 image, but get {image.dtype} in {path}'
+        return cls(image, output_patch_size, **kwargs)
+
+    @locked_cached_property
+    def transform(self):
+        # the downsampling along z commutes with these transforms,
+        # and they keep the data type.
+        return Compose([
+            Flip(),
+            Transpose(),
+        ])
+
+    @locked_cached_property
+    def start_range(self) -> Cartesian:
+        """the number of patch starts in every axis."""
+        return Cartesian.from_collection(self.image.shape[-3:]) - \
+            self.patch_size_before_transform + 1
+
+    @property
+    def sampling_weight(self):
+        return int(np.prod(self.start_range))
+
+    def __len__(self):
+        return self.sampling_weight
+
+    def patch_from_bbox(self, bbox: BoundingBox) -> Patch:
+        """the low and high resolution patch pair in a bounding box.
+
+        Args:
+            bbox (BoundingBox): the global bounding box of high resolution patch.
+
+        Returns:
+            Patch: the low resolution image and high resolution label.
+        """
+        buffer_pool = get_buffer_pool()
+        shape = (1, 1, *bbox.shape)
+        target = self.image.cutout(bbox)
+        label = buffer_pool.acquire(shape, target.dtype)
+        np.copyto(label.reshape(target.shape), target.array)
+
+        low = downsample(label[0, 0], self.factor, kernel=self.kernel)
+        image = buffer_pool.acquire(shape, label.dtype)
+        upsample_nearest(low, self.factor, out=image[0, 0])
+
+        voxel_size = self.image.voxel_size
+        return Patch(
+            Chunk(image, voxel_offset=bbox.start, voxel_size=voxel_size),
+            Chunk(label, voxel_offset=bbox.start, voxel_size=voxel_size),
+        )
+
+    @property
+    def random_patch(self):
+        offset = Cartesian(*(random.randrange(r) for r in self.start_range))
+        bbox = BoundingBox.from_delta(self.image.bbox.start + offset,
+            self.patch_size_before_transform)
+        patch = self.patch_from_bbox(bbox)
+        if self.is_train:
+            self.transform(patch)
+        assert patch.shape[-3:] == self.output_patch_size, \
+            f'get patch shape: {patch.shape}, expected patch size {self.output_patch_size}'
+        return patch
+
+
+class SuperResolutionDataset(DatasetBase):
+    def __init__(self, samples: list):
+        super().__init__(samples)
+
+    @classmethod
+    def from_toml(cls, config_file: str, is_train: bool = True,
             training_split_ratio: float = 0.9,
-            patch_size: Union[int, tuple]=(64, 64, 64)):
+            patch_size: Union[int, tuple] = (64, 64, 64),
+            factor: Cartesian = DEFAULT_FACTOR,
+            kernel: str = 'box'):
         """
         Parameters:
             config_file (str): file_path to provide metadata of all the ground truth data.
+                the image of every entry is a uint8 chunk file or volume path.
+            is_train (bool): use the training split or the validation split.
             training_split_ratio (float): split the datasets to training and validation sets.
             patch_size (int or tuple): the patch size we are going to provide.
+            factor (Cartesian): the downsampling factor of z, y and x.
+            kernel (str): the downsampling kernel, box or gaussian.
         """
-        super().__init__()
         assert training_split_ratio > 0.5
         assert training_split_ratio < 1.
 
-        if isinstance(patch_size, int):
-            patch_size = (patch_size,) * 3
-
         config_file = os.path.expanduser(config_file)
         assert config_file.endswith('.toml'), "we use toml file as configuration format."
+        import toml
         with open(config_file, 'r') as file:
             meta = toml.load(file)
         config_dir = os.path.dirname(config_file)
 
-        self._prepare_transform()
-        assert isinstance(self.transform, Compose)
-
-        self.patch_size = patch_size
-        patch_size_before_transform = tuple(
-            p + s0 + s1 for p, s0, s1 in zip(
-                patch_size, 
-                self.transform.shrink_size[:3], 
-                self.transform.shrink_size[-3:]
-            )
-        )
-        
-        # load all the datasets
-        volumes = []
+        paths = []
         for gt in meta.values():
             image_path = gt['image']
-            assert image_path.endswith('.h5')
-            image_path = os.path.join(config_dir, image_path)
-
-            image = Chunk.from_h5(image_path)
-            image = image.astype(np.float32) / 255.
-            reference_sample = ReferenceVolume(
-                image,
-                image,
-                patch_size=patch_size_before_transform,
-            )
-            volumes.append(reference_sample)
-        
-        # shuffle the volume list and then split it to training and test
-        # random.shuffle(volumes)
-
-        # use the number of candidate patches as volume sampling weight
-        sample_weights = []
-        for volume in volumes:
-            sample_weights.append(volume.volume_sampling_weight)
-
-        self.training_sample_num = math.floor(len(volumes) * training_split_ratio)
-        self.validation_sample_num = len(volumes) - self.training_sample_num
-        self.training_samples = volumes[:self.training_sample_num]
-        self.validation_samples = volumes[-self.validation_sample_num:]
-        self.training_sample_weights = sample_weights[:self.training_sample_num]
-        self.validation_sample_weights = sample_weights[-self.validation_sample_num]
-        
-    @property
-    def random_training_patch(self):
-        # only sample one subject, so replacement option could be ignored
-        if self.training_sample_num == 1:
-            sample_index = 0
-        else:
-            sample_index = random.choices(
-                range(self.training_sample_num),
-                weights=self.training_sample_weights,
-                k=1,
-            )[0]
-        volume = self.training_samples[sample_index]
-        patch = volume.random_patch
-        self.transform(patch)
-        patch.apply_delayed_shrink_size()
-        print('patch shape: ', patch.shape)
-        assert patch.shape[-3:] == self.patch_size, f'patch shape: {patch.shape}'
-        return patch
+            if '://' not in image_path:
+                image_path = os.path.join(config_dir, image_path)
+            paths.append(image_path)
 
-    @property
-    def random_validation_patch(self):
-        if self.validation_sample_num == 1:
-            sample_index = 0
+        training_sample_num = max(math.floor(len(paths) * training_split_ratio), 1)
+        if is_train:
+            paths = paths[:training_sample_num]
         else:
-            sample_index = random.choices(
-                range(self.validation_sample_num),
-                weights=self.validation_sample_weights,
-                k=1,
-            )[0]
-        volume = self.validation_samples[sample_index]
-        patch = volume.random_patch
-        self.transform(patch)
-        patch.apply_delayed_shrink_size()
-        return patch
-           
-    @cached_property
-    def transform(self):
-        return Compose([
-            NormalizeTo01(),
-            AdjustBrightness(),
-            AdjustContrast(),
-            Gamma(),
-            OneOf([
-                Noise(),
-                GaussianBlur2D(),
-            ]),
-            MaskBox(),
-        ])
+            paths = paths[training_sample_num:]
+        assert len(paths) > 0
+
+        samples = [SuperResolutionSample.from_path(path, patch_size,
+            factor=factor, kernel=kernel, is_train=is_train) for path in paths]
+        return cls(samples)
 
 
 if __name__ == '__main__':
-    dataset = Dataset(
-        "~/Dropbox (Simons Foundation)/40_gt/tbar.toml",
-        max_sampling_distance=24,
-        training_split_ratio=0.99,
-    )
-
-    from torch.utils.tensorboard import SummaryWriter
-    from neutorch.model.io import log_tensor
-    writer = SummaryWriter(log_dir='/tmp/log')
-
-    import h5py
-    
-    model = torch.nn.Identity()
-    print('start generating random patches...')
-    for n in range(10000):
-        ping = time()
-        patch = dataset.random_training_patch
-        print(f'generating a patch takes {round(time()-ping, 3)} seconds.')
-        image = patch.image
-        target = patch.target
-        with h5py.File('/tmp/image.h5', 'w') as file:
-            file['main'] = image[0,0, ...]
-        with h5py.File('/tmp/target.h5', 'w') as file:
-            file['main'] = target[0,0, ...]
-
-        assert np.any(target > 0)
-        print('number of nonzero voxels: ', np.count_nonzero(target))
-        # assert np.count_nonzero(tbar) == 8
-        image = torch.from_numpy(image)
-        target = torch.from_numpy(target)
-        log_tensor(writer, 'train/image', image, n)
-        log_tensor(writer, 'train/target', target, n)
-
-        # # print(patch)
-        # logits = model(image)
-        # image = image[:, :, 32, :, :]
-        # tbar, _ = torch.max(tbar, dim=2, keepdim=False)
-        # slices = torch.cat((image, tbar))
-        # image_path = os.path.expanduser('~/Downloads/patches.png')
-        # print('save a batch of patches to ', image_path)
-        # torchvision.utils.save_image(
-        #     slices,
-        #     image_path,
-        #     nrow=8,
-        #     normalize=True,
-        #     scale_each=True,
-        # )
-        sleep(1)
+    high = np.random.randint(0, 255, size=(512, 512, 512), dtype=np.uint8)
+    sample = SuperResolutionSample(Chunk(high), Cartesian(64, 128, 128),
+        kernel='gaussian')
 
+    start = time()
+    for _ in range(10):
+        patch = sample.random_patch
+        assert patch.image.dtype == np.uint8
+        assert patch.image.shape == patch.label.shape
+        get_buffer_pool().release(patch.image.array)
+        get_buffer_pool().release(patch.label.array)
+    print(f'generating a patch pair takes {(time() - start) / 10:.3f} seconds.')
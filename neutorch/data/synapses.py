@@ -1,42 +1,115 @@
+import os
 from time import time, sleep
 from functools import cached_property
 from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 from chunkflow.lib.cartesian_coordinate import Cartesian, BoundingBox
-from chunkflow.lib.synapses import Synapses
-from chunkflow.volume import Volume
+from chunkflow.volume import PrecomputedVolume
 
 import torch
 
-from .transform import *
-from .base import DatasetBase, path_to_dataset_name
-from .sample import SampleWithPointAnnotation, PostSynapseReference
+from .transform import AdjustBrightness, AdjustContrast, Compose, Flip, \
+    Gamma, GaussianBlur2D, MaskBox, MissAlignment, Noise, NormalizeTo01, OneOf, \
+    Transpose
+from .dataset import DatasetBase, path_to_dataset_name
+from .sample import SampleWithPointAnnotation, PostSynapseReference, \
+    CropBankSample
+from .catalog import SynapseCatalog, DEFAULT_SYNAPSE_CATALOG_PATH
 
 
 class SynapsesDatasetBase(DatasetBase):
     def __init__(self, 
             sample_name_to_image_versions: dict,
-            patch_size: Union[int, tuple, Cartesian] = (128, 128, 128)):
-        super().__init__(patch_size)
+            patch_size: Union[int, tuple, Cartesian] = (128, 128, 128),
+            num_workers: int = None,
+            catalog_path: str = DEFAULT_SYNAPSE_CATALOG_PATH,
+            crop_bank_dir: str = None):
+        """
+        Parameters:
+            sample_name_to_image_versions (dict): map the sample or volume name to a list of versions the same dataset.
+            patch_size (int or tuple): the output patch size of samples.
+            num_workers (int): number of threads to construct samples. 
+                Defaults to None, the number of CPUs.
+            catalog_path (str): the cache of parsed synapse files. 
+                Use None to disable the cache.
+            crop_bank_dir (str): serve the patches from the crop banks built by 
+                neutorch-crop-bank rather than the volumes. The crop bank of a 
+                synapse file is in crop_bank_dir/<sample name>/<file name without extension>.
+                Defaults to None, the image volumes are cut out for every synapse file.
+        """
+        # the samples are constructed by the subclasses
+        super().__init__([])
+        if isinstance(patch_size, int):
+            patch_size = Cartesian(patch_size, patch_size, patch_size)
+        self.patch_size = Cartesian.from_collection(patch_size)
 
         self.sample_name_to_image_versions = sample_name_to_image_versions
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.synapse_catalog = SynapseCatalog(catalog_path)
+        self.crop_bank_dir = crop_bank_dir
 
         self.vols = {}
-        for dataset_name, dir_list in sample_name_to_image_versions.items():
-            vol_list = []
-            for dir_path in dir_list:
-                vol = Volume.from_cloudvolume_path(
-                    'file://' + dir_path,
-                    bounded = True,
-                    fill_missing = False,
-                    parallel=True,
-                )
-                vol_list.append(vol)
-            self.vols[dataset_name] = vol_list
-
-        self.samples = []
+        # the crops are read from the memory mapped crop banks without volumes
+        if crop_bank_dir is None:
+            for dataset_name, dir_list in sample_name_to_image_versions.items():
+                vol_list = []
+                for dir_path in dir_list:
+                    vol = PrecomputedVolume.from_cloudvolume_path(
+                        'file://' + dir_path,
+                        bounded = True,
+                        fill_missing = False,
+                        parallel=True,
+                    )
+                    vol_list.append(vol)
+                self.vols[dataset_name] = vol_list
+
+    @cached_property
+    def patch_size_before_transform(self) -> Cartesian:
+        return self.patch_size + \
+            self.transform.shrink_size[:3] + \
+            self.transform.shrink_size[-3:]
+
+    def construct_samples(self, syns_path_list: List[str], construct_sample):
+        """construct samples from synapse files with a thread pool.
+        The file parsing and volume cutout are mostly I/O, 
+        so threads work well and the samples do not need to be pickled.
+        The order of samples is the same with the file list.
+
+        Args:
+            syns_path_list (List[str]): the synapse file list.
+            construct_sample (callable): construct a sample from a file path.
+                It could return None to skip the file.
+                It is replaced by opening the crop bank if crop_bank_dir is set.
+        """
+        if self.crop_bank_dir is not None:
+            construct_sample = self.crop_bank_sample
+        with ThreadPoolExecutor(max_workers=max(self.num_workers, 1)) as executor:
+            samples = list(executor.map(construct_sample, syns_path_list))
+        # the catalog is updated if there is any new or modified file
+        self.synapse_catalog.save()
+        self.samples.extend(sample for sample in samples if sample is not None)
+
+    def crop_bank_path(self, syns_path: str) -> str:
+        """the crop bank directory of a synapse file."""
+        dataset_name = path_to_dataset_name(
+            syns_path,
+            self.sample_name_to_image_versions.keys()
+        )
+        assert dataset_name is not None, f'no sample name in {syns_path}'
+        file_name = os.path.splitext(os.path.basename(syns_path))[0]
+        return os.path.join(self.crop_bank_dir, dataset_name, file_name)
+
+    def crop_bank_sample(self, syns_path: str):
+        """open the crop bank of a synapse file without reading any volume."""
+        path = self.crop_bank_path(syns_path)
+        assert os.path.isdir(path), \
+            f'no crop bank of {syns_path} in {path}, build it with neutorch-crop-bank.'
+        # the patch size before transform of dataset matches the crop size
+        return CropBankSample.from_dir(path, self.patch_size,
+            transform=self.transform)
 
     def syns_path_to_images(self, syns_path: str, bbox: BoundingBox):
         images = []
@@ -55,39 +128,26 @@ class PreSynapsesDataset(SynapsesDatasetBase):
             syns_path_list: List[str],
             sample_name_to_image_versions: dict,
             patch_size: Union[int, tuple, Cartesian]=Cartesian(128, 128, 128),
+            crop_bank_dir: str = None,
         ):
         """
         Parameters:
             syns_path_list (List[str]): the synapses file list
             sample_name_to_image_versions (dict): map the sample or volume name to a list of versions the same dataset.
             patch_size (int or tuple): the patch size we are going to provide.
+            crop_bank_dir (str): the directory of crop banks with presynapses.
         """
 
-        if isinstance(patch_size, int):
-            patch_size = Cartesian(patch_size, patch_size, patch_size)
-        else:
-            patch_size = Cartesian.from_collection(patch_size)
-        super().__init__(sample_name_to_image_versions, patch_size=patch_size)
-        
-        
-        self._prepare_transform()
-        assert isinstance(self.transform, Compose)
-
-        self.patch_size = patch_size
-        patch_size_before_transform = tuple(
-            p + s0 + s1 for p, s0, s1 in zip(
-                patch_size, 
-                self.transform.shrink_size[:3], 
-                self.transform.shrink_size[-3:]
-            )
-        )
-        patch_size_before_transform = Cartesian.from_collection(patch_size_before_transform)
+        super().__init__(sample_name_to_image_versions, patch_size=patch_size,
+            crop_bank_dir=crop_bank_dir)
 
-        for syns_path in syns_path_list:
+        def construct_sample(syns_path: str):
             bbox = BoundingBox.from_string(syns_path)
             images = self.syns_path_to_images(syns_path, bbox)
             
-            synapses = Synapses.from_h5(syns_path)
+            synapses = self.synapse_catalog.load_synapses(syns_path)
+            if synapses is None:
+                return None
             synapses.remove_synapses_outside_bounding_box(bbox)
             
             pre = synapses.pre 
@@ -95,26 +155,27 @@ class PreSynapsesDataset(SynapsesDatasetBase):
             # print(f'max offset: {np.max(pre, axis=0)}')
             pre -= np.asarray(bbox.start, dtype=pre.dtype)
 
-            sample = SampleWithPointAnnotation(
+            return SampleWithPointAnnotation(
                 images,
                 annotation_points=pre,
-                patch_size=patch_size_before_transform,
+                output_patch_size=self.patch_size,
             )
-            self.samples.append(sample)
 
-        self.compute_sample_weights()
-        self.setup_iteration_range()
+        self.construct_samples(syns_path_list, construct_sample)
 
-    def _prepare_transform(self):
-        self.transform = Compose([
+    @cached_property
+    def transform(self):
+        return Compose([
             NormalizeTo01(probability=1.),
-            IntensityPerturbation(),
+            AdjustBrightness(),
+            AdjustContrast(),
+            Gamma(),
             OneOf([
                 Noise(),
                 GaussianBlur2D(),
             ]),
             MaskBox(),
-            Perspective2D(),
+            # Perspective2D(),
             # RotateScale(probability=1.),
             #DropSection(),
             Flip(),
@@ -128,6 +189,7 @@ class PostSynapsesDataset(SynapsesDatasetBase):
             syns_path_list: List[str],
             sample_name_to_image_versions: dict,
             patch_size: Cartesian = Cartesian(256, 256, 256), 
+            crop_bank_dir: str = None,
         ):
         """postsynapse dataset
 
@@ -135,17 +197,20 @@ class PostSynapsesDataset(SynapsesDatasetBase):
             syns_path_list (List[str]): the synapses file list
             sample_name_to_image_versions (dict): map the sample or volume name to a list of versions the same dataset.
             patch_size (Cartesian, optional): Defaults to Cartesian(256, 256, 256).
+            crop_bank_dir (str, optional): the directory of crop banks with postsynapses. 
+                Defaults to None.
 
         Raises:
             ValueError: [description]
         """
-        super().__init__(sample_name_to_image_versions, patch_size=patch_size)
+        super().__init__(sample_name_to_image_versions, patch_size=patch_size,
+            crop_bank_dir=crop_bank_dir)
 
-        for syns_path in syns_path_list:
-            synapses = Synapses.from_file(syns_path)
-            if synapses.post is None:
+        def construct_sample(syns_path: str):
+            synapses = self.synapse_catalog.load_synapses(syns_path)
+            if synapses is None or synapses.post is None:
                 print(f'skip synapses without post: {syns_path}')
-                continue
+                return None
             print(f'loaded {syns_path}')
             synapses.remove_synapses_without_post()
 
@@ -154,16 +219,12 @@ class PostSynapsesDataset(SynapsesDatasetBase):
             bbox = bbox.adjust(self.patch_size_before_transform // 2)
 
             images = self.syns_path_to_images(syns_path, bbox)
-            sample = PostSynapseReference(
+            return PostSynapseReference(
                 synapses, images,
-                patch_size=self.patch_size_before_transform
+                output_patch_size=self.patch_size,
             )
-            self.samples.append(sample)
 
-        # shuffle the volume list and then split it to training and test
-        # random.shuffle(volumes)
-        self.compute_sample_weights()
-        self.setup_iteration_range()
+        self.construct_samples(syns_path_list, construct_sample)
 
     @cached_property
     def transform(self):
@@ -177,7 +238,7 @@ class PostSynapsesDataset(SynapsesDatasetBase):
                 GaussianBlur2D(),
             ]),
             MaskBox(),
-            Perspective2D(),
+            # Perspective2D(),
             # RotateScale(probability=1.),
             #DropSection(),
             Flip(),
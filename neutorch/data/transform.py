@@ -1,31 +1,56 @@
-import random
 from abc import ABC, abstractmethod
 from functools import cached_property
 
 # import cv2
 import numpy as np
+import torch
+from torch.nn import functional as F
 from chunkflow.lib.cartesian_coordinate import Cartesian
-from scipy.ndimage.filters import gaussian_filter
 # from skimage.transform import swirl
-from skimage.util import random_noise
 
+from .rng import random, np_random
 from .patch import Patch
-
-try:
-    from reneu.lib.segmentation import seg_to_affs, remove_contact_xy
-except ImportError:
-    pass
+from .buffer import get_buffer_pool
+from .blur import gaussian_blur_2d, gaussian_blur_3d
+from .noise import get_noise_bank, SUPPORTED_NOISE_MODES
+from .affinity import seg_to_affs, remove_contact_xy, compact_labels, \
+    update_affinity_plane, NUM_AFFINITY_CHANNELS
 # from copy import deepcopy
 
 
 # from scipy.ndimage import affine_transform
 
+__all__ = [
+    'DEFAULT_PROBABILITY', 'DEFAULT_SHRINK_SIZE', 'make_writable', 'identity_grid',
+    'AbstractTransform', 'SpatialTransform', 'IntensityTransform', 'SectionTransform',
+    'OneOf', 'DropSection', 'MaskBox', 'NormalizeTo01', 'AdjustBrightness',
+    'AdjustContrast', 'Gamma', 'SectionBrightnessContrast', 'PartialMissingSection',
+    'SectionBlur', 'GaussianBlur2D', 'GaussianBlur3D', 'Noise', 'Flip', 'Transpose',
+    'MissAlignment', 'GridSampleTransform', 'AffineDeformation', 'ElasticDeformation',
+    'Label2AffinityMap', 'CompactSegmentation', 'Compose',
+]
+
 DEFAULT_PROBABILITY = .5
 DEFAULT_SHRINK_SIZE = (0, 0, 0, 0, 0, 0)
 # DEFAULT_SHRINK_SIZE = None
 
 
+def make_writable(chunk):
+    """copy a read only array of chunk to a buffer before writing to it in place.
+    The clean label of self supervised patches is a read only view of the sample."""
+    if not chunk.array.flags.writeable:
+        chunk.array = get_buffer_pool().copy(chunk.array)
+    return chunk
+
+
 class AbstractTransform(ABC):
+    # this transform keeps the precomputed affinity map of patch 
+    # consistent with the label or not.
+    preserves_affinity = True
+    # this transform keeps the context crop of patch co-centered 
+    # and in the same orientation with the image or not.
+    preserves_context = True
+
     def __init__(self, 
             probability: float = DEFAULT_PROBABILITY,
             validation: bool = False):
@@ -51,7 +76,12 @@ class AbstractTransform(ABC):
         return hasattr(self, 'invert')
 
     def __call__(self, patch: Patch):
+        assert not patch.has_context or self.preserves_context, \
+            f'{self.name} does not support the context crop of patch.'
         if random.random() < self.probability:
+            if patch.has_affinity and not self.preserves_affinity:
+                # the affinity map will be computed from the transformed label
+                patch.affinity = None
             patch = self.transform(patch)
             # for spatial transform, we need to correct the size
             # to make sure that the final patch size is correct
@@ -87,6 +117,11 @@ class AbstractTransform(ABC):
     
 class SpatialTransform(AbstractTransform):
     """Modify image voxel position and reinterprete."""
+    # the spatial transforms should transform the affinity map 
+    # and the context crop explicitly
+    preserves_affinity = False
+    preserves_context = False
+
     def __init__(self, probability: float = DEFAULT_PROBABILITY,
             validation: bool = False):
         super().__init__(probability=probability, validation=validation)
@@ -117,23 +152,42 @@ class IntensityTransform(AbstractTransform):
 
 
 class SectionTransform(AbstractTransform):
-    """change a random section only."""
-    def __init__(self, probability: float = DEFAULT_PROBABILITY ):
+    """change some random sections only."""
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            section_probability: float = 0.1):
+        """The parameters of all the sections are drawn as arrays
+        and applied with broadcasting, so the number of Python operations
+        do not depend on the number of sections.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            section_probability (float, optional): probability of each section to be changed.
+                At least one section will be changed. Defaults to 0.1.
+        """
         super().__init__(probability=probability)
+        assert section_probability > 0.
+        assert section_probability <= 1.
+        self.section_probability = section_probability
 
     def __str__(self) -> str:
         return 'SectionTransform'
 
     def transform(self, patch: Patch):
-        self.selected_axis = random.randrange(3)
-        self.selected_idx = random.randrange(
-            patch.image.shape[self.selected_axis]
-        )
-        patch = self.transform_section(patch)
+        section_num = patch.shape[-3]
+        selected = np_random.rand(section_num) < self.section_probability
+        if not np.any(selected):
+            selected[random.randrange(section_num)] = True
+        patch = self.transform_sections(patch, selected)
         return patch
     
     @abstractmethod
-    def transform_section(self, patch: Patch):
+    def transform_sections(self, patch: Patch, selected: np.ndarray):
+        """change the selected sections
+
+        Args:
+            patch (Patch): image and label
+            selected (np.ndarray): boolean array of sections to be changed.
+        """
         pass
 
 
@@ -163,11 +217,16 @@ class OneOf(AbstractTransform):
 
 
 class DropSection(SpatialTransform):
+    preserves_affinity = True
+    # a local change of patch, the context crop is still co-centered
+    preserves_context = True
+
     def __init__(self, probability: float = DEFAULT_PROBABILITY):
         super().__init__(probability=probability)
 
     def transform(self, patch: Patch):
         z = random.randrange(1, patch.shape[-3])
+        make_writable(patch.label)
         patch.image.array[..., z:-1, :, :] = patch.image[..., z+1:, :, :]
         patch.image.array = patch.image.array[..., :-1, :, :]
         
@@ -177,6 +236,13 @@ class DropSection(SpatialTransform):
         if patch.has_mask:
             patch.mask.array[..., z:-1, :, :] = patch.mask[..., z+1:, :, :]
             patch.mask.array = patch.mask.array[..., :-1, :, :]
+
+        if patch.has_affinity:
+            patch.affinity.array[..., z:-1, :, :] = patch.affinity[..., z+1:, :, :]
+            patch.affinity.array = patch.affinity.array[..., :-1, :, :]
+            if z < patch.affinity.shape[-3]:
+                # the section after the dropped one has a new z neighbor
+                update_affinity_plane(patch.affinity.array, patch.label.array, 0, z)
         return patch
 
     @cached_property
@@ -226,7 +292,7 @@ class MaskBox(IntensityTransform):
             # randint is inclusive
             start = tuple(random.randrange(1, t-b) for t, b in zip(patch.shape[-3:], box_size))
             if random.random() > 0.5:
-                box = np.random.rand(*box_size)
+                box = np_random.rand(*box_size)
             else:
                 box = np.ones(box_size, dtype = patch.image.dtype) * random.random()
             patch.image[
@@ -248,16 +314,24 @@ class NormalizeTo01(IntensityTransform):
 
     def transform(self, patch: Patch):
         if np.issubdtype(patch.image.dtype, np.uint8):
-            patch.image.array = patch.image.array.astype(np.float32)
-            patch.image.array = patch.image.array / 255.
+            patch.image.array = self._normalize(patch.image.array)
+        if patch.has_context and np.issubdtype(patch.context.dtype, np.uint8):
+            patch.context.array = self._normalize(patch.context.array)
 
         if self.normalize_label and np.issubdtype(
                 patch.label.dtype, np.uint8) :
-            patch.label.array = patch.label.array.astype(np.float32)
-            patch.label.array = patch.label.array / 255.
+            patch.label.array = self._normalize(patch.label.array)
 
         return patch
 
+    def _normalize(self, arr: np.ndarray):
+        # convert and scale with only one pass and no new allocation
+        buffer_pool = get_buffer_pool()
+        out = buffer_pool.acquire(arr.shape, np.float32)
+        np.divide(arr, np.float32(255.), out=out, dtype=np.float32)
+        buffer_pool.release(arr)
+        return out
+
 class AdjustBrightness(IntensityTransform):
     def __init__(self, probability: float = DEFAULT_PROBABILITY,
             min_factor: float = 0.05,
@@ -308,6 +382,117 @@ class Gamma(IntensityTransform):
         patch.image **= 2.** gamma
         return patch
 
+class SectionBrightnessContrast(SectionTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            section_probability: float = 0.1,
+            max_brightness: float = 0.1,
+            contrast_range: tuple = (0.7, 1.3)):
+        """jump of brightness and contrast in some sections
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            section_probability (float, optional): probability of each section to be changed. Defaults to 0.1.
+            max_brightness (float, optional): maximum brightness shift. Defaults to 0.1.
+            contrast_range (tuple, optional): range of contrast factor. Defaults to (0.7, 1.3).
+        """
+        super().__init__(probability=probability, 
+            section_probability=section_probability)
+        assert len(contrast_range) == 2
+        self.max_brightness = max_brightness
+        self.contrast_range = contrast_range
+
+    def __str__(self) -> str:
+        return 'SectionBrightnessContrast'
+
+    def transform_sections(self, patch: Patch, selected: np.ndarray):
+        section_num = selected.shape[0]
+        contrast = np_random.uniform(*self.contrast_range, size=section_num)
+        brightness = np_random.uniform(
+            -self.max_brightness, self.max_brightness, size=section_num)
+        contrast[~selected] = 1.
+        brightness[~selected] = 0.
+        
+        dtype = patch.image.dtype
+        contrast = contrast.astype(dtype).reshape(-1, 1, 1)
+        brightness = brightness.astype(dtype).reshape(-1, 1, 1)
+        # adjust the contrast around the mean intensity of each section
+        mean = patch.image.array.mean(axis=(-2, -1), keepdims=True)
+        # the unselected sections are multiplied by 1 and added by 0
+        patch.image.array *= contrast
+        patch.image.array += mean * (1. - contrast) + brightness
+        np.clip(patch.image.array, 0., 1., out=patch.image.array)
+        return patch
+
+
+class PartialMissingSection(SectionTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            section_probability: float = 0.05,
+            fill_value: float = 0.):
+        """part of some sections is missing.
+        The missing part is split by a random line in each section.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            section_probability (float, optional): probability of each section to be changed. Defaults to 0.05.
+            fill_value (float, optional): the value of missing region. Defaults to 0..
+        """
+        super().__init__(probability=probability, 
+            section_probability=section_probability)
+        self.fill_value = fill_value
+
+    def __str__(self) -> str:
+        return 'PartialMissingSection'
+
+    def transform_sections(self, patch: Patch, selected: np.ndarray):
+        section_num = selected.shape[0]
+        sy, sx = patch.shape[-2:]
+        # a random line crossing a random point in each section
+        angle = np_random.uniform(0., 2. * np.pi, size=(section_num, 1, 1))
+        py = np_random.uniform(0, sy, size=(section_num, 1, 1))
+        px = np_random.uniform(0, sx, size=(section_num, 1, 1))
+        y = np.arange(sy, dtype=np.float32).reshape(1, -1, 1)
+        x = np.arange(sx, dtype=np.float32).reshape(1, 1, -1)
+        missing = np.cos(angle) * (y - py) + np.sin(angle) * (x - px) > 0.
+        missing &= selected.reshape(-1, 1, 1)
+        np.copyto(patch.image.array, self.fill_value, where=missing)
+        return patch
+
+
+class SectionBlur(SectionTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            section_probability: float = 0.1,
+            max_sigma: float = 2.):
+        """blur some sections, such as out of focus.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            section_probability (float, optional): probability of each section to be changed. Defaults to 0.1.
+            max_sigma (float, optional): maximum sigma of gaussian blur. Defaults to 2..
+        """
+        super().__init__(probability=probability, 
+            section_probability=section_probability)
+        self.max_sigma = max_sigma
+
+    def __str__(self) -> str:
+        return 'SectionBlur'
+
+    def transform_sections(self, patch: Patch, selected: np.ndarray):
+        sigma = random.uniform(0.2, self.max_sigma)
+        # only blur the selected sections
+        sections = patch.image.array[..., selected, :, :]
+        patch.image.array[..., selected, :, :] = gaussian_blur_2d(
+            sections, sigma, output=_float_output(sections))
+        return patch
+
+
+def _float_output(arr: np.ndarray):
+    """blur in place if the array is already floating point."""
+    if np.issubdtype(arr.dtype, np.floating):
+        return arr
+    else:
+        return None
+
+
 class GaussianBlur2D(IntensityTransform):
     def __init__(self, probability: float=DEFAULT_PROBABILITY, 
             sigma: float = 1.5):
@@ -319,7 +504,9 @@ class GaussianBlur2D(IntensityTransform):
 
     def transform(self, patch: Patch):
         sigma = random.uniform(0.2, self.sigma)
-        gaussian_filter(patch.image.array, sigma=sigma, output=patch.image.array)
+        # only blur inside sections
+        patch.image.array = gaussian_blur_2d(
+            patch.image.array, sigma, output=_float_output(patch.image.array))
         return patch
 
 
@@ -334,14 +521,25 @@ class GaussianBlur3D(IntensityTransform):
 
     def transform(self, patch: Patch):
         sigma = tuple(random.uniform(0.2, s) for s in self.max_sigma)
-        gaussian_filter(patch.image.array, sigma=sigma, output=patch.image.array)
+        # only blur the spatial axes rather than batch and channel
+        patch.image.array = gaussian_blur_3d(
+            patch.image.array, sigma, output=_float_output(patch.image.array))
         return patch
 
 
 class Noise(IntensityTransform):
     def __init__(self, probability: float = DEFAULT_PROBABILITY,
             mode: str='gaussian', max_variance: float = 0.02):
+        """add random noise to the image.
+        The noise is cropped from a noise bank shared by the data loader workers.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            mode (str, optional): gaussian or speckle. the same with skimage.util.random_noise. Defaults to 'gaussian'.
+            max_variance (float, optional): maximum variance of the noise. Defaults to 0.02.
+        """
         super().__init__(probability=probability)
+        assert mode in SUPPORTED_NOISE_MODES, f'unsupported noise mode: {mode}'
         self.mode = mode  
         self.max_variance = max_variance
 
@@ -350,12 +548,16 @@ class Noise(IntensityTransform):
 
     def transform(self, patch: Patch):
         variance = random.uniform(0.01, self.max_variance)
-        random_noise(patch.image.array, mode=self.mode, var=variance)
+        noise_bank = get_noise_bank(patch.shape)
+        noise_bank.add_noise(patch.image.array, variance, mode=self.mode)
         np.clip(patch.image.array, 0., 1., out=patch.image.array)
         return patch
 
 
 class Flip(SpatialTransform):
+    preserves_affinity = True
+    preserves_context = True
+
     def __init__(self, probability: float = DEFAULT_PROBABILITY):
         super().__init__(probability=probability)
 
@@ -372,6 +574,22 @@ class Flip(SpatialTransform):
         patch.label.array = np.flip(patch.label.array, axis=axis5d)
         if patch.has_mask:
             patch.mask.array = np.flip(patch.mask.array, axis=axis5d)
+        if patch.has_context:
+            patch.context.array = np.flip(patch.context.array, axis=axis5d)
+        if patch.has_affinity:
+            affs = np.flip(patch.affinity.array, axis=axis5d)
+            for ax in axis:
+                # the affinity connects a voxel with the previous one.
+                # after flipping, the previous voxel is the next one,
+                # so the affinity of the flipped axis is moved by one voxel.
+                # the first voxel is not valid and will be cropped.
+                channel = affs[:, ax, ...]
+                current = [slice(None)] * channel.ndim
+                previous = [slice(None)] * channel.ndim
+                current[ax+1] = slice(1, None)
+                previous[ax+1] = slice(None, -1)
+                channel[tuple(current)] = channel[tuple(previous)]
+            patch.affinity.array = affs
 
         # shrink = list(patch.delayed_shrink_size)
         # for ax in axis:
@@ -382,6 +600,9 @@ class Flip(SpatialTransform):
 
 
 class Transpose(SpatialTransform):
+    preserves_affinity = True
+    preserves_context = True
+
     def __init__(self, probability: float = DEFAULT_PROBABILITY):
         super().__init__(probability=probability)
 
@@ -397,6 +618,14 @@ class Transpose(SpatialTransform):
         patch.label.array = np.transpose(patch.label.array, axis5d)
         if patch.has_mask:
             patch.mask.array = np.transpose(patch.mask.array, axis5d)
+        if patch.has_context:
+            patch.context.array = np.transpose(patch.context.array, axis5d)
+        if patch.has_affinity:
+            affs = np.transpose(patch.affinity.array, axis5d)
+            if axis[0] == 4:
+                # swap the y and x affinity channels
+                affs = affs[:, [0, 2, 1], ...]
+            patch.affinity.array = affs
 
         # shrink = list(patch.delayed_shrink_size)
         # for ax0, ax1 in enumerate(axis):
@@ -409,6 +638,10 @@ class Transpose(SpatialTransform):
 
     
 class MissAlignment(SpatialTransform):
+    preserves_affinity = True
+    # a local change of patch, the context crop is still co-centered
+    preserves_context = True
+
     def __init__(self, probability: float=DEFAULT_PROBABILITY,
             max_displacement: int=2):
         """move part of volume alone x axis
@@ -433,101 +666,40 @@ class MissAlignment(SpatialTransform):
         # random direction
         # no need to use random direction because we can combine with rotation and flipping
         # displacement *= random.choice([-1, 1])
-        sz, sy, sx = patch.shape[-3:]
-        if axis == 2:
-            # displacement at Z
-            zloc = random.randrange(1, sz)
-            patch.image.array[..., zloc:, 
-                self.max_displacement : sy-self.max_displacement,
-                self.max_displacement : sx-self.max_displacement,
-                ] = patch.image[..., zloc:, 
-                    self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                    self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                    ]
-            patch.label.array[..., zloc:, 
-                self.max_displacement : sy-self.max_displacement,
-                self.max_displacement : sx-self.max_displacement,
-                ] = patch.label[..., zloc:, 
-                    self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                    self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                    ]
-            if patch.has_mask:
-                patch.mask.array[..., zloc:, 
-                    self.max_displacement : sy-self.max_displacement,
-                    self.max_displacement : sx-self.max_displacement,
-                    ] = patch.label[..., zloc:, 
-                        self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                        self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                        ]
-
-        elif axis == 3:
-            # displacement at Y
-            yloc = random.randrange(1, sy)
-            
-            # print('right side shape: ', patch.image[...,  self.max_displacement+displacement : sz+displacement-self.max_displacement,yloc:,self.max_displacement+displacement : sx+displacement-self.max_displacement,].shape)
-
-            patch.image.array[..., 
-                self.max_displacement : sz-self.max_displacement,
-                yloc:, 
-                self.max_displacement : sx-self.max_displacement,
-                ] = patch.image[..., 
-                    self.max_displacement+displacement : sz+displacement-self.max_displacement, 
-                    yloc:, 
-                    self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                    ]
-            patch.label.array[..., 
-                self.max_displacement : sz-self.max_displacement,
-                yloc:,
-                self.max_displacement : sx-self.max_displacement,
-                ] = patch.label[..., 
-                    self.max_displacement+displacement : sz+displacement-self.max_displacement,
-                    yloc:, 
-                    self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                    ]
-            if patch.has_mask:
-                patch.mask.array[..., 
-                    self.max_displacement : sz-self.max_displacement,
-                    yloc:,
-                    self.max_displacement : sx-self.max_displacement,
-                    ] = patch.mask[..., 
-                        self.max_displacement+displacement : sz+displacement-self.max_displacement,
-                        yloc:, 
-                        self.max_displacement+displacement : sx+displacement-self.max_displacement,
-                        ]
-
-        elif axis == 4:
-            # displacement at X
-            xloc = random.randint(1, sx-1)
-            patch.image.array[..., 
-                self.max_displacement : sz-self.max_displacement,
-                self.max_displacement : sy-self.max_displacement,
-                xloc:, 
-                ] = patch.image[...,  
-                    self.max_displacement+displacement : sz+displacement-self.max_displacement,
-                    self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                    xloc:
-                    ]
-            patch.label.array[..., 
-                self.max_displacement : sz-self.max_displacement,
-                self.max_displacement : sy-self.max_displacement,
-                xloc:,
-                ] = patch.label[..., 
-                    self.max_displacement+displacement : sz+displacement-self.max_displacement,
-                    self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                    xloc:, 
-                    ]
-
-            if patch.has_mask:
-                patch.mask.array[..., 
-                    self.max_displacement : sz-self.max_displacement,
-                    self.max_displacement : sy-self.max_displacement,
-                    xloc:,
-                    ] = patch.mask[..., 
-                        self.max_displacement+displacement : sz+displacement-self.max_displacement,
-                        self.max_displacement+displacement : sy+displacement-self.max_displacement,
-                        xloc:, 
-                        ]
-
+        shape = patch.shape[-3:]
+        # the part after this location along the axis is moved
+        # in the other two axes
+        loc = random.randrange(1, shape[axis-2])
+
+        target = [Ellipsis]
+        source = [Ellipsis]
+        for ax, size in enumerate(shape):
+            if ax == axis - 2:
+                target.append(slice(loc, None))
+                source.append(slice(loc, None))
+            else:
+                target.append(slice(self.max_displacement, size-self.max_displacement))
+                source.append(slice(
+                    self.max_displacement+displacement, 
+                    size+displacement-self.max_displacement))
+        target = tuple(target)
+        source = tuple(source)
+        
+        chunks = [patch.image, patch.label]
+        if patch.has_mask:
+            chunks.append(patch.mask)
+        if patch.has_affinity:
+            chunks.append(patch.affinity)
+        for chunk in chunks:
+            make_writable(chunk)
+            chunk.array[target] = chunk[source]
+
+        if patch.has_affinity:
+            # the voxels in the plane at the location have new neighbors 
+            # along the axis. The affinity at the border of the moved part
+            # in other axes will be shrinked.
+            update_affinity_plane(patch.affinity.array, patch.label.array, 
+                axis-2, loc)
         return patch
 
     @cached_property
@@ -538,6 +710,218 @@ class MissAlignment(SpatialTransform):
     def shrink(self, patch: Patch):
         patch.shrink(self.shrink_size)
 
+class GridSampleTransform(SpatialTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            margin: tuple = (0, 0, 0)):
+        """resample the image, label and mask with a sampling grid.
+        The sampling grid of the whole batch is computed at once.
+        The image is resampled linearly with one `grid_sample` call,
+        the label and mask are resampled with the nearest voxel
+        so the segmentation ids are preserved.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            margin (tuple, optional): the maximum displacement in voxels, z,y,x. 
+                The patch will be shrinked by this margin on both sides. Defaults to (0, 0, 0).
+        """
+        super().__init__(probability=probability)
+        assert len(margin) == 3
+        self.margin = Cartesian.from_collection(
+            tuple(int(np.ceil(m)) for m in margin))
+
+    def __str__(self) -> str:
+        return 'GridSampleTransform'
+
+    @cached_property
+    def shrink_size(self):
+        return (*self.margin, *self.margin)
+
+    def shrink(self, patch: Patch):
+        # the patch is already shrinked in the resampling
+        pass
+
+    @abstractmethod
+    def sampling_coordinates(self, batch_size: int, output_shape: tuple):
+        """the coordinates in the input patch for every output voxel
+
+        Args:
+            batch_size (int): number of patches in the batch.
+            output_shape (tuple): z,y,x shape of output patch.
+
+        Returns:
+            torch.Tensor: N,Z,Y,X,3 coordinates with z,y,x order.
+        """
+        pass
+
+    def _resample_nearest(self, arr: np.ndarray, coordinates: np.ndarray):
+        batch_size = arr.shape[0]
+        indices = np.rint(coordinates).astype(np.int64)
+        for axis in range(3):
+            np.clip(indices[..., axis], 0, arr.shape[2+axis]-1,
+                out=indices[..., axis])
+        batch_index = np.arange(batch_size).reshape(batch_size, 1, 1, 1)
+        # the advanced indices are moved to the front: N,Z,Y,X,C
+        out = arr[batch_index, :, 
+            indices[..., 0], indices[..., 1], indices[..., 2]]
+        return np.moveaxis(out, -1, 1)
+
+    def transform(self, patch: Patch):
+        input_shape = patch.shape[-3:]
+        output_shape = tuple(s - 2*m for s, m in zip(input_shape, self.margin))
+        coordinates = self.sampling_coordinates(patch.shape[0], output_shape)
+
+        # normalize to [-1, 1] with x,y,z order for grid_sample
+        size = torch.tensor(input_shape[::-1], dtype=torch.float32)
+        grid = coordinates.flip(-1) * (2. / (size - 1.)) - 1.
+        image = torch.from_numpy(np.ascontiguousarray(
+            patch.image.array, dtype=np.float32))
+        image = F.grid_sample(image, grid, mode='bilinear',
+            padding_mode='border', align_corners=True)
+        patch.image.array = image.numpy()
+        patch.image.voxel_offset += self.margin
+
+        coordinates = coordinates.numpy()
+        patch.label.array = self._resample_nearest(
+            patch.label.array, coordinates)
+        patch.label.voxel_offset += self.margin
+        if patch.has_mask:
+            patch.mask.array = self._resample_nearest(
+                patch.mask.array, coordinates)
+            patch.mask.voxel_offset += self.margin
+        return patch
+
+
+# the identity sampling grids of different output shape and margin
+_identity_grids = {}
+
+def identity_grid(output_shape: tuple, margin: tuple = (0, 0, 0)):
+    """sampling grid without any displacement
+
+    Args:
+        output_shape (tuple): z,y,x shape of output.
+        margin (tuple, optional): the start of output in input. Defaults to (0, 0, 0).
+
+    Returns:
+        torch.Tensor: Z,Y,X,3 coordinates with z,y,x order.
+    """
+    key = (tuple(output_shape), tuple(margin))
+    if key not in _identity_grids:
+        axes = [torch.arange(s, dtype=torch.float32) + m 
+            for s, m in zip(output_shape, margin)]
+        grid = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1)
+        _identity_grids[key] = grid
+    return _identity_grids[key]
+
+
+class AffineDeformation(GridSampleTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            patch_size: Cartesian = Cartesian(128, 128, 128),
+            max_rotation: float = 10.,
+            max_scaling: float = 1.1,
+            max_shear: float = 0.05):
+        """rotate, scale and shear inside sections.
+        This replaces the RotateScale and Perspective2D using cv2 section by section.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            patch_size (Cartesian, optional): the output patch size of this transform.
+                It is used to compute the shrink size, so the patches should have
+                this size after the transform. Defaults to Cartesian(128, 128, 128).
+            max_rotation (float, optional): maximum rotation angle in degrees. Defaults to 10..
+            max_scaling (float, optional): maximum scaling factor. Defaults to 1.1.
+            max_shear (float, optional): maximum shear factor. Defaults to 0.05.
+        """
+        assert max_scaling >= 1.
+        assert max_rotation >= 0.
+        assert max_shear >= 0.
+        # the maximum norm of (A - I) bounds the displacement
+        # of a point with the distance to center
+        norm = max_scaling - 1. + 2. * np.sin(np.deg2rad(max_rotation) / 2.) + max_shear
+        radius = np.sqrt((patch_size[-2] / 2.)**2 + (patch_size[-1] / 2.)**2)
+        margin = int(np.ceil(norm * radius))
+        super().__init__(probability=probability, margin=(0, margin, margin))
+        self.patch_size = Cartesian.from_collection(patch_size)
+        self.max_rotation = max_rotation
+        self.max_scaling = max_scaling
+        self.max_shear = max_shear
+
+    def __str__(self) -> str:
+        return 'AffineDeformation'
+
+    def random_matrix(self):
+        angle = np.deg2rad(random.uniform(-self.max_rotation, self.max_rotation))
+        scale = random.uniform(1. / self.max_scaling, self.max_scaling)
+        shear = random.uniform(-self.max_shear, self.max_shear)
+        cos, sin = np.cos(angle), np.sin(angle)
+        rotation = np.array([[cos, -sin], [sin, cos]])
+        shearing = np.array([[1., shear], [0., 1.]])
+        return scale * rotation @ shearing
+
+    def sampling_coordinates(self, batch_size: int, output_shape: tuple):
+        # a larger patch would need a larger margin for the same deformation
+        assert tuple(output_shape[-2:]) == tuple(self.patch_size[-2:]), \
+            f'the output patch size {output_shape} does not match the ' \
+            f'patch size {self.patch_size} used to compute the margin.'
+        center = np.asarray(output_shape[-2:], dtype=np.float64) / 2. - 0.5
+        # the corners of the section have the largest displacement
+        corners = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]]) * (center + 0.5)
+        margin = np.asarray(self.margin[-2:], dtype=np.float64)
+
+        matrices = []
+        for _ in range(batch_size):
+            delta = self.random_matrix() - np.eye(2)
+            displacement = np.abs(corners @ delta.T).max(axis=0)
+            # the margin is computed from an approximate bound of displacement.
+            # reduce the rare deformations going outside of the input patch.
+            ratio = np.min(margin / np.maximum(displacement, 1e-6))
+            if ratio < 1.:
+                delta *= ratio
+            matrices.append(np.eye(2) + delta)
+        matrices = torch.tensor(np.stack(matrices), dtype=torch.float32)
+
+        grid = identity_grid(output_shape).expand(batch_size, *output_shape, 3)
+        yx = grid[..., 1:] - torch.tensor(center, dtype=torch.float32)
+        yx = torch.einsum('nij,nzyxj->nzyxi', matrices, yx)
+        yx += torch.tensor(center + margin, dtype=torch.float32)
+        z = grid[..., :1] + self.margin[0]
+        return torch.cat((z, yx), dim=-1)
+
+
+class ElasticDeformation(GridSampleTransform):
+    def __init__(self, probability: float = DEFAULT_PROBABILITY,
+            max_displacement: tuple = (1., 4., 4.),
+            control_point_spacing: tuple = (16, 32, 32)):
+        """smooth random deformation.
+        A coarse random displacement field is upsampled to the patch size.
+
+        Args:
+            probability (float, optional): probability of this augmentation. Defaults to DEFAULT_PROBABILITY.
+            max_displacement (tuple, optional): maximum displacement in voxels, z,y,x. Defaults to (1., 4., 4.).
+            control_point_spacing (tuple, optional): the distance of control points of 
+                the coarse displacement field, z,y,x. Defaults to (16, 32, 32).
+        """
+        assert len(max_displacement) == 3
+        assert len(control_point_spacing) == 3
+        super().__init__(probability=probability, margin=max_displacement)
+        self.max_displacement = torch.tensor(max_displacement, dtype=torch.float32)
+        self.control_point_spacing = control_point_spacing
+
+    def __str__(self) -> str:
+        return 'ElasticDeformation'
+
+    def sampling_coordinates(self, batch_size: int, output_shape: tuple):
+        coarse_shape = tuple(max(2, -(-s // c) + 1) for s, c in zip(
+            output_shape, self.control_point_spacing))
+        displacement = torch.from_numpy(np_random.uniform(
+            -1., 1., size=(batch_size, 3, *coarse_shape)).astype(np.float32))
+        displacement *= self.max_displacement.view(1, 3, 1, 1, 1)
+        # upsample once for the whole batch
+        displacement = F.interpolate(displacement, size=output_shape,
+            mode='trilinear', align_corners=True)
+        displacement = displacement.permute(0, 2, 3, 4, 1)
+        return identity_grid(output_shape, self.margin) + displacement
+
+
 # class Perspective2D(SpatialTransform):
     # def __init__(self, probability: float=DEFAULT_PROBABILITY,
             # corner_ratio: float=0.2):
@@ -680,6 +1064,10 @@ class MissAlignment(SpatialTransform):
 #        return patch
 
 class Label2AffinityMap(SpatialTransform):
+    preserves_affinity = True
+    # a local change of patch, the context crop is still co-centered
+    preserves_context = True
+
     def __init__(self, probability: float = 1., 
             validation: bool=True):
         """If this transform is used, the probability should always be 1.0."""
@@ -694,12 +1082,23 @@ class Label2AffinityMap(SpatialTransform):
         assert patch.label.shape[0] == 1
         assert patch.label.shape[1] == 1
         assert patch.label.ndim == 5
+        make_writable(patch.label)
         seg = patch.label.array[0,0,...]
-        seg = seg.astype(np.uint64)
-        remove_contact_xy(seg)
-        seg = seg.astype(np.uint64)
-        affs_ref = seg_to_affs(seg)
-        patch.label.array =  np.expand_dims(affs_ref, axis=0)
+        buffer_pool = get_buffer_pool()
+        affs = buffer_pool.acquire(
+            (1, NUM_AFFINITY_CHANNELS, *(s-1 for s in seg.shape)), np.float32)
+        if patch.has_affinity:
+            # the precomputed affinity map is aligned with the label.
+            # the contacts are already removed in the precomputation.
+            np.copyto(affs, patch.affinity.array[..., 1:, 1:, 1:], casting='unsafe')
+            patch.affinity = None
+        else:
+            # the label patch is already a copy, so we can modify it in place.
+            # the native data type is used without casting.
+            remove_contact_xy(seg)
+            seg_to_affs(seg, output=affs[0])
+        buffer_pool.release(patch.label.array)
+        patch.label.array = affs
         patch.label.voxel_offset += Cartesian(1,1,1)
         # print(f'patch shape after Label2AffinityMap: {patch.shape}')
         return patch
@@ -714,6 +1113,43 @@ class Label2AffinityMap(SpatialTransform):
         if patch.has_mask:
             patch.mask.shrink(self.shrink_size)
 
+class CompactSegmentation(AbstractTransform):
+    def __init__(self, probability: float = 1.,
+            remove_contact: bool = True):
+        """relabel the segmentation with consecutive integers.
+        The affinity map is computed in the trainer with
+        `neutorch.data.affinity.seg_to_affs_tensor`,
+        so only a compact segmentation is transferred from the workers
+        no matter how many affinity channels are used.
+        If this transform is used, the probability should always be 1.0.
+
+        Args:
+            probability (float, optional): probability of this transform. Defaults to 1..
+            remove_contact (bool, optional): remove the contacting voxels 
+                of different objects in each section. Defaults to True.
+        """
+        assert probability == 1.
+        super().__init__(probability=probability)
+        self.remove_contact = remove_contact
+
+    def __str__(self) -> str:
+        return 'CompactSegmentation'
+
+    def transform(self, patch: Patch):
+        assert patch.label.ndim == 5
+        assert patch.label.shape[0] == 1
+        assert patch.label.shape[1] == 1
+        make_writable(patch.label)
+        seg = patch.label.array[0,0,...]
+        if self.remove_contact:
+            remove_contact_xy(seg)
+
+        compact = compact_labels(seg)
+        get_buffer_pool().release(patch.label.array)
+        patch.label.array = compact[np.newaxis, np.newaxis, ...]
+        return patch
+
+
 class Compose(object):
     def __init__(self, transforms: list):
         """compose multiple transforms
@@ -742,9 +1178,14 @@ class Compose(object):
         # after the transformation, the stride of array
         # could be negative, and pytorch could not tranform
         # the array to Tensor. Copy can fix it.
+        # The copy is written to a buffer of the pool and the 
+        # previous buffer is returned to the pool.
         # print(f'patch shape after Compose call: {patch.shape}')
-        patch.image.array = patch.image.array.copy()
-        patch.label.array = patch.label.array.copy()
+        buffer_pool = get_buffer_pool()
+        patch.image.array = buffer_pool.ascontiguousarray(patch.image.array)
+        patch.label.array = buffer_pool.ascontiguousarray(patch.label.array)
         if patch.has_mask:
-            patch.mask.array = patch.mask.array.copy()
+            patch.mask.array = buffer_pool.ascontiguousarray(patch.mask.array)
+        if patch.has_context:
+            patch.context.array = buffer_pool.ascontiguousarray(patch.context.array)
 
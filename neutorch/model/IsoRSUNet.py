@@ -7,6 +7,8 @@ import torch
 
 
 WIDTH = [16, 32, 64, 128, 256, 512]
+# the channels of the light context branch
+CONTEXT_WIDTH = [8, 16, 32, 64]
 
 def _ntuple(n: int):
     """
@@ -179,12 +181,21 @@ class IsoRSUNet(nn.Module):
             if isinstance(m, nn.Conv3d):
                 nn.init.kaiming_normal_(m.weight)
 
-    def forward(self, x):
+    def forward(self, x, context: torch.Tensor = None):
+        """
+        Args:
+            x (torch.Tensor): the input features.
+            context (torch.Tensor, optional): the context features added at 
+                the bottleneck with the same shape. Defaults to None.
+        """
         x = self.input_conv(x)
         skip = []
         for down_conv in self.down_convs:
             skip.append(x)
             x = down_conv(x)
+
+        if context is not None:
+            x = x + context
         
         for up_conv in self.up_convs:
             x = up_conv(x, skip.pop())
@@ -224,11 +235,76 @@ class OutputBlock(nn.Module):
         return x
 
 
+class ContextBranch(nn.Module):
+    def __init__(self, in_channels: int, out_channels: int, 
+            factor: tuple, width: list = CONTEXT_WIDTH):
+        """A light encoder of the larger low resolution context crop.
+        The features of the region co-centered with the patch are cropped 
+        and resized to the bottleneck of the UNet.
+
+        Args:
+            in_channels (int): the number of channels of context crop.
+            out_channels (int): the number of channels of UNet bottleneck.
+            factor (tuple): the context voxel size divided by the patch voxel size.
+            width (list, optional): the channels of levels. Defaults to CONTEXT_WIDTH.
+        """
+        super().__init__()
+        self.factor = _triple(factor)
+        self.input_conv = Conv(in_channels, width[0])
+        self.down_convs = nn.ModuleList()
+        for d in range(len(width) - 1):
+            self.down_convs.append(nn.Sequential(
+                nn.MaxPool3d((2, 2, 2)),
+                BNReLUConv(width[d], width[d+1]),
+            ))
+        self.output_conv = conv(width[-1], out_channels, kernel_size=1)
+        # start from the model without context, 
+        # so a pretrained model could be fine tuned with context.
+        nn.init.zeros_(self.output_conv.weight)
+
+    def forward(self, context: torch.Tensor, patch_shape: tuple, 
+            bottleneck_shape: tuple):
+        """
+        Args:
+            context (torch.Tensor): the context crop.
+            patch_shape (tuple): the spatial shape of input patch.
+            bottleneck_shape (tuple): the spatial shape of UNet bottleneck.
+
+        Returns:
+            torch.Tensor: the features with bottleneck shape.
+        """
+        x = self.input_conv(context)
+        for down_conv in self.down_convs:
+            x = down_conv(x)
+
+        # the region of patch in the context features
+        slices = [slice(None), slice(None)]
+        for p, f, c, s in zip(patch_shape, self.factor, 
+                context.shape[-3:], x.shape[-3:]):
+            size = max(round(p / f * s / c), 1)
+            start = (s - size) // 2
+            slices.append(slice(start, start + size))
+        x = x[tuple(slices)]
+        x = nn.functional.interpolate(x, size=tuple(bottleneck_shape), 
+            mode='trilinear', align_corners=False)
+        return self.output_conv(x)
+
+
 class Model(nn.Sequential):
     """
     Residule Symmetric U-Net with down/upsampling in/output.
     """
-    def __init__(self, in_channels: int, out_channels: int, width: list=WIDTH):
+    def __init__(self, in_channels: int, out_channels: int, width: list=WIDTH,
+            context_factor: tuple = None):
+        """
+        Args:
+            in_channels (int): the number of input channels.
+            out_channels (int): the number of output channels.
+            width (list, optional): the channels of UNet levels. Defaults to WIDTH.
+            context_factor (tuple, optional): the context voxel size divided by
+                the patch voxel size. A context branch is fused at the bottleneck 
+                if it is set. Defaults to None.
+        """
         super().__init__()
 
         # assert len(in_spec)==1, "model takes a single input"
@@ -240,6 +316,26 @@ class Model(nn.Sequential):
         self.add_module('in', InputBlock(in_channels, width[0], io_kernel))
         self.add_module('core', IsoRSUNet(width=width))
         self.add_module('out', OutputBlock(width[0], out_channels, io_kernel))
+        if context_factor is not None:
+            self.add_module('context', ContextBranch(
+                in_channels, width[-1], context_factor))
+
+    @property
+    def has_context(self):
+        return 'context' in self._modules
+
+    def forward(self, x, context: torch.Tensor = None):
+        core = self._modules['core']
+        if context is not None:
+            assert self.has_context, 'the model does not have a context branch.'
+            # the bottleneck is downsampled by 2 in every level
+            scale = 2 ** len(core.down_convs)
+            bottleneck_shape = tuple(s // scale for s in x.shape[-3:])
+            context = self._modules['context'](
+                context, x.shape[-3:], bottleneck_shape)
+        x = self._modules['in'](x)
+        x = core(x, context=context)
+        return self._modules['out'](x)
 
 
 if __name__ == '__main__':
@@ -247,3 +343,9 @@ if __name__ == '__main__':
     input = torch.rand((1,1, 64, 64, 64), dtype=torch.float32)
     logits = model(input)
     assert logits.shape[1] == 1
+
+    # a 64^3 patch with a 32^3 context crop at 4x lower resolution,
+    # which covers 128^3 patch voxels.
+    model = Model(1, 1, context_factor=(4, 4, 4))
+    context = torch.rand((1, 1, 32, 32, 32), dtype=torch.float32)
+    assert torch.allclose(model(input, context), model(input))
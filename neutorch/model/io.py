@@ -1,13 +1,15 @@
+from __future__ import annotations
 import os
 import math
+from typing import TYPE_CHECKING
 
 import numpy as np
 
-from skimage.color import label2rgb
-
 import torch
 from torch import nn
-from torch.utils.tensorboard import SummaryWriter
+
+if TYPE_CHECKING:
+    from torch.utils.tensorboard import SummaryWriter
 
 
 def save_chkpt(model: nn.Module, fpath: str, chkpt_num: int, optimizer):
@@ -26,13 +28,13 @@ def save_chkpt(model: nn.Module, fpath: str, chkpt_num: int, optimizer):
              'optimizer': optimizer.state_dict()}
     torch.save(state, fname)
 
-def load_chkpt(model: nn.Module, fname: str):
+def load_chkpt(model: nn.Module, fname: str, strict: bool = True):
     # model = torch.nn.DataParallel(model, device_ids=[0])
     # assert torch.cuda.is_available()
     # device = torch.device('cuda:0')
     checkpoint = torch.load(fname, map_location='cpu') 
 
-    model.load_state_dict(checkpoint['state_dict'])
+    model.load_state_dict(checkpoint['state_dict'], strict=strict)
     return model
 
 
@@ -78,6 +80,8 @@ def volume_to_image(tensor: torch.Tensor, tensor_type: str,
         # label = torch.argmax(tensor, dim=-4, keepdim=False)
         tensor = tensor.numpy()
         # breakpoint()
+        # skimage is only imported to log a segmentation
+        from skimage.color import label2rgb
         rgb = label2rgb(tensor, 
             bg_label=0, 
             # bg_color=(100, 200, 49), 
@@ -0,0 +1,131 @@
+"""the startup time of the entry points and the data loader workers.
+
+    python -m neutorch.startup
+
+Every module is imported in a fresh interpreter, the same with a spawned
+data loader worker, and the slowest dependencies are reported.
+"""
+import os
+import re
+import subprocess
+import sys
+import multiprocessing as mp
+from time import time
+
+import click
+
+
+SETUP_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'setup.py')
+# a spawned worker imports these modules to unpickle the dataset
+WORKER_MODULES = ('neutorch.data.dataset',)
+
+
+def entry_point_modules(setup_path: str = SETUP_PATH) -> dict:
+    """the modules of console scripts in setup.py or the installed package.
+
+    Args:
+        setup_path (str, optional): the setup.py file. Defaults to SETUP_PATH.
+
+    Returns:
+        dict: console script name -> module name.
+    """
+    if os.path.exists(setup_path):
+        with open(setup_path) as file:
+            text = file.read()
+        return dict(re.findall(
+            r'^\s*([\w-]+)\s*=\s*(neutorch[\w.]*):\w+\s*$', text, flags=re.M))
+
+    from importlib.metadata import entry_points
+    return {ep.name: ep.module for ep in entry_points(group='console_scripts') \
+        if ep.module.startswith('neutorch')}
+
+
+def _parse_importtime(stderr: str) -> dict:
+    """the cumulative microseconds of the packages from -X importtime.
+    The packages of neutorch are excluded, so the dependencies are reported.
+    The dependencies imported by other dependencies are counted in both."""
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*(\S+)', line)
+        if match is None:
+            continue
+        cumulative, name = match.groups()
+        if '.' not in name and name != 'neutorch':
+            packages[name] = int(cumulative)
+    return packages
+
+
+def import_time(module: str, repeat: int = 3) -> tuple:
+    """the wall time to import a module in a fresh interpreter.
+
+    Args:
+        module (str): the module name.
+        repeat (int, optional): use the fastest one of repeated runs. Defaults to 3.
+
+    Returns:
+        tuple: the seconds, the seconds of top level packages and the error message.
+            The error message is None if the module is imported.
+    """
+    elapsed = float('inf')
+    packages = {}
+    for _ in range(repeat):
+        start = time()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            f'import {module}'], capture_output=True, text=True)
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            return None, {}, lines[-1] if lines else 'failed'
+        if time() - start < elapsed:
+            elapsed = time() - start
+            packages = _parse_importtime(result.stderr)
+    return elapsed, {k: v / 1e6 for k, v in packages.items()}, None
+
+
+def _import_modules(modules: tuple):
+    for module in modules:
+        __import__(module)
+
+
+def worker_spawn_time(modules: tuple = WORKER_MODULES, repeat: int = 3) -> float:
+    """the wall time to spawn a process importing the modules and join it.
+    It is the startup time of a data loader worker with the spawn context.
+    """
+    context = mp.get_context('spawn')
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time()
+        process = context.Process(target=_import_modules, args=(modules,))
+        process.start()
+        process.join()
+        assert process.exitcode == 0, f'failed to import {modules} in a worker.'
+        elapsed = min(elapsed, time() - start)
+    return elapsed
+
+
+@click.command()
+@click.option('--repeat', '-r',
+    type=click.INT, default=3, help='use the fastest one of repeated runs.'
+)
+@click.option('--top', '-t',
+    type=click.INT, default=4, help='the number of slowest packages to report.'
+)
+def main(repeat: int, top: int):
+    interpreter, _, _ = import_time('sys', repeat=repeat)
+    print(f'bare interpreter: {interpreter:.3f} s')
+
+    for name, module in entry_point_modules().items():
+        elapsed, packages, error = import_time(module, repeat=repeat)
+        if error is not None:
+            print(f'{name:<20} {module:<45} error: {error}')
+            continue
+        slowest = sorted(packages.items(), key=lambda x: x[1], reverse=True)[:top]
+        slowest = ', '.join(f'{k} {v:.2f}' for k, v in slowest)
+        print(f'{name:<20} {module:<45} {elapsed:.3f} s ({slowest})')
+
+    elapsed = worker_spawn_time(repeat=repeat)
+    print(f'spawned worker importing {", ".join(WORKER_MODULES)}: {elapsed:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,9 @@ import click
 from yacs.config import CfgNode
 
 from neutorch.data.dataset import AffinityMapDataset
+from neutorch.data.affinity import seg_to_affs_tensor
 from neutorch.train.base import TrainerBase, setup, cleanup
 
-from .base import TrainerBase
-
 import torch
 import torch.distributed as dist
 # torch.multiprocessing.set_start_method('spawn')
@@ -22,6 +21,28 @@ class AffinityMapTrainer(TrainerBase):
         assert isinstance(cfg, CfgNode)
         super().__init__(cfg, device=device, local_rank=local_rank)
 
+    @cached_property
+    def affinity_offsets(self):
+        """the z,y,x offsets of affinity channels computed in the trainer.
+        If it is not configured, the nearest neighbor affinity map 
+        is computed in the data loading workers."""
+        if 'affinity_offsets' not in self.cfg.train:
+            return None
+        offsets = tuple(tuple(offset) for offset in self.cfg.train.affinity_offsets)
+        assert len(offsets) == self.cfg.model.out_channels, \
+            f'the number of affinity offsets {len(offsets)} should be the same with output channels {self.cfg.model.out_channels}'
+        return offsets
+
+    def label_to_target_and_mask(self, label: torch.Tensor):
+        if self.affinity_offsets is None:
+            return super().label_to_target_and_mask(label)
+        # the label is a compact segmentation
+        return seg_to_affs_tensor(label.cuda(), offsets=self.affinity_offsets)
+
+    def label_to_target(self, label: torch.Tensor):
+        target, _ = self.label_to_target_and_mask(label)
+        return target
+
     @cached_property
     def training_dataset(self):
         return AffinityMapDataset.from_config(self.cfg, mode='training')
@@ -10,9 +10,10 @@ from chunkflow.lib.cartesian_coordinate import Cartesian
 
 import torch
 import torch.distributed as dist
-from torch.utils.tensorboard import SummaryWriter
 
 from neutorch.data.patch import collate_batch
+from neutorch.data.loader import ThreadDataLoader
+from neutorch.data.noise import share_noise_bank
 from neutorch.loss import BinomialCrossEntropyWithLogits
 from neutorch.model.io import load_chkpt, log_tensor, save_chkpt
 from neutorch.model.IsoRSUNet import Model
@@ -89,7 +90,9 @@ class TrainerBase(ABC):
 
     @cached_property
     def model(self):
-        model = Model(self.cfg.model.in_channels, self.cfg.model.out_channels)
+        # fuse a low resolution context crop at the bottleneck if it is configured
+        model = Model(self.cfg.model.in_channels, self.cfg.model.out_channels,
+            context_factor=self.cfg.model.get('context_factor', None))
                            
         if 'preload' in self.cfg.train:
             fname = self.cfg.train.preload
@@ -100,7 +103,8 @@ class TrainerBase(ABC):
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
         if os.path.exists(fname) and self.local_rank==0:
-            model = load_chkpt(model, fname)
+            # a model without context branch could be fine tuned with context
+            model = load_chkpt(model, fname, strict=not model.has_context)
 
         model.to('cuda')
         # note that we have to wrap the nn.DataParallel(model) before 
@@ -146,8 +150,40 @@ class TrainerBase(ABC):
     def is_main_process(self):
         return self.LOCAL_RANK <= 0
        
+    @cached_property
+    def thread_data_loader(self) -> bool:
+        """load the batches with threads sharing the samples 
+        rather than spawned processes with a copy of samples."""
+        data_loader = self.cfg.system.get('data_loader', 'process')
+        assert data_loader in ('process', 'thread'), \
+            f'only support process and thread data loader, but got {data_loader}'
+        return data_loader == 'thread'
+
+    def _thread_data_loader(self, dataset):
+        num_workers = max(self.cfg.system.cpus, 1)
+        # the global random generator is seeded with the system seed.
+        # the ranks and the loaders draw different patches.
+        rank = dist.get_rank() if dist.is_initialized() else 0
+        seed = random.getrandbits(31) + rank * num_workers
+        return ThreadDataLoader(dataset,
+            batch_size=self.batch_size,
+            num_workers=num_workers,
+            collate_fn=collate_batch,
+            seed=seed,
+        )
+
+    def _share_noise_bank(self):
+        """create the noise bank before spawning the workers.
+        The workers map it and this process removes it at exit."""
+        if self.cfg.system.cpus > 0:
+            share_noise_bank(self.patch_size)
+
     @cached_property
     def training_data_loader(self):
+        if self.thread_data_loader:
+            return self._thread_data_loader(self.training_dataset)
+        self._share_noise_bank()
+
         sampler = torch.utils.data.distributed.DistributedSampler(
             self.training_dataset,
             shuffle = False,
@@ -177,6 +213,10 @@ class TrainerBase(ABC):
     
     @cached_property
     def validation_data_loader(self):
+        if self.thread_data_loader:
+            return self._thread_data_loader(self.validation_dataset)
+        self._share_noise_bank()
+
         sampler = torch.utils.data.distributed.DistributedSampler(
             self.validation_dataset,
             shuffle = False,
@@ -206,6 +246,22 @@ class TrainerBase(ABC):
     def label_to_target(self, label: torch.Tensor):
         return label.cuda()
 
+    def label_to_target_and_mask(self, label: torch.Tensor):
+        """the target and the mask of valid voxels used in the loss.
+        The mask is None if all the voxels are valid."""
+        return self.label_to_target(label), None
+
+    def input_and_target(self, image: torch.Tensor, label: torch.Tensor):
+        """the model input, the target and the mask of valid voxels of a batch."""
+        target, target_mask = self.label_to_target_and_mask(label)
+        return image, target, target_mask
+
+    def predict(self, image: torch.Tensor, context: torch.Tensor = None):
+        if context is None:
+            return self.model(image)
+        else:
+            return self.model(image, context.cuda())
+
     def post_processing(self, prediction: torch.Tensor):
         if isinstance(self.loss_module, BinomialCrossEntropyWithLogits):
             return torch.sigmoid(prediction)
@@ -213,14 +269,19 @@ class TrainerBase(ABC):
             return prediction
 
     def __call__(self) -> None:
+        # tensorboard is not imported by the data loader workers
+        from torch.utils.tensorboard import SummaryWriter
         writer = SummaryWriter(log_dir=self.cfg.train.output_dir)
         accumulated_loss = 0.
         iter_idx = self.cfg.train.iter_start
 
         for iter_idx in range(self.cfg.train.iter_start, self.cfg.train.iter_stop):
-            image, label = next(iter(self.training_data_loader))
+            batch = next(iter(self.training_data_loader))
+            image, label = batch[:2]
+            # the context crops are appended if they are configured
+            context = batch[2] if len(batch) > 2 else None
         # for image, label in self.training_data_loader:
-            target = self.label_to_target(label)
+            image, target, target_mask = self.input_and_target(image, label)
 
             # iter_idx += 1
             # if iter_idx> self.cfg.train.iter_stop:
@@ -232,9 +293,9 @@ class TrainerBase(ABC):
             # print(f'preparing patch takes {round(time()-ping, 3)} seconds')
             # image.to(self.device)
             # self.model.to(self.device)
-            predict = self.model(image)
+            predict = self.predict(image, context)
             predict = self.post_processing(predict)
-            loss = self.loss_module(predict, target)
+            loss = self.loss_module(predict, target, mask=target_mask)
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
@@ -268,12 +329,18 @@ class TrainerBase(ABC):
                     )
 
                 print('evaluate prediction: ')
-                validation_image, validation_label = next(iter(self.validation_data_iter))
-                validation_target = self.label_to_target(validation_label)
+                validation_batch = next(iter(self.validation_data_iter))
+                validation_image, validation_label = validation_batch[:2]
+                validation_context = validation_batch[2] \
+                    if len(validation_batch) > 2 else None
+                validation_image, validation_target, validation_mask = \
+                    self.input_and_target(validation_image, validation_label)
 
                 with torch.no_grad():
-                    validation_predict = self.model(validation_image)
-                    validation_loss = self.loss_module(validation_predict, validation_target)
+                    validation_predict = self.predict(
+                        validation_image, validation_context)
+                    validation_loss = self.loss_module(
+                        validation_predict, validation_target, mask=validation_mask)
                     validation_predict = self.post_processing(validation_predict)
                     per_voxel_loss = validation_loss.tolist() / self.voxel_num
                     print(f'iter {iter_idx}: validation loss: {round(per_voxel_loss, 3)}')
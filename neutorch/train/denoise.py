@@ -7,6 +7,7 @@ import click
 from yacs.config import CfgNode
 
 from neutorch.data.dataset import VolumeWithMask
+from neutorch.data.noise import noisy_pairs
 from neutorch.train.base import TrainerBase, setup, cleanup
 
 import torch
@@ -23,6 +24,20 @@ class WholeBrainTrainer(TrainerBase):
         super().__init__(cfg, device=device, local_rank=local_rank)
         assert isinstance(cfg, CfgNode)
 
+    @cached_property
+    def noise_variance(self):
+        """the maximum variance of the noise synthesized in the trainer.
+        If it is configured, the samples should be self supervised and 
+        the Noise2Noise style pairs are synthesized from the clean patches in batch."""
+        return self.cfg.train.get('noise_variance', None)
+
+    def input_and_target(self, image: torch.Tensor, label: torch.Tensor):
+        if self.noise_variance is None:
+            return super().input_and_target(image, label)
+        # the label is the clean image of self supervised samples
+        return noisy_pairs(label.cuda(), self.noise_variance,
+            mask_ratio=self.cfg.train.get('noise_mask_ratio', 0.))
+
     @cached_property
     def training_dataset(self):
         return VolumeWithMask.from_config(self.cfg, mode='training')
@@ -7,7 +7,6 @@ from yacs.config import CfgNode
 
 import torch
 # from torch.nn import CrossEntropyLoss
-from torch.utils.tensorboard import SummaryWriter
 
 from .base import SemanticTrainer
 from neutorch.data.dataset import OrganelleDataset #, to_tensor
@@ -52,6 +51,7 @@ class OrganelleTrainer(SemanticTrainer):
     #     return predict
 
     def __call__(self) -> None:
+        from torch.utils.tensorboard import SummaryWriter
         writer = SummaryWriter(log_dir=self.cfg.train.output_dir)
         accumulated_loss = 0.
         iter_idx = self.cfg.train.iter_start
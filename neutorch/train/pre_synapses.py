@@ -10,7 +10,6 @@ import numpy as np
 from chunkflow.lib.cartesian_coordinate import Cartesian
 
 import torch
-from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
 from neutorch.data.patch import collate_batch
 
@@ -63,6 +62,7 @@ def main(config_file: str):
     print(f'split {len(path_list)} ground truth samples to {len(training_path_list)} training samples, {len(validation_path_list)} validation samples, and {len(path_list)-len(training_path_list)-len(validation_path_list)} test samples.')
 
     random.seed(cfg.system.seed)
+    from torch.utils.tensorboard import SummaryWriter
     writer = SummaryWriter(log_dir=cfg.train.output_dir)
 
     model = Model(cfg.model.in_channels, cfg.model.out_channels)
@@ -92,15 +92,19 @@ def main(config_file: str):
     optimizer = torch.optim.Adam(model.parameters(), lr=cfg.train.learning_rate)
     
     loss_module = BinomialCrossEntropyWithLogits()
+    # read the synapse centered crops rather than cutting out the volumes
+    crop_bank_dir = cfg.dataset.get('crop_bank', None)
     training_dataset = PreSynapsesDataset(
         training_path_list,
         cfg.dataset.sample_name_to_image_versions,
         patch_size=patch_size,
+        crop_bank_dir=crop_bank_dir,
     )
     validation_dataset = PreSynapsesDataset(
         validation_path_list,
         cfg.dataset.sample_name_to_image_versions,
         patch_size=patch_size,
+        crop_bank_dir=crop_bank_dir,
     )
   
     training_data_loader = DataLoader(
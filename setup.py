@@ -20,6 +20,8 @@ setup(
         neutrain-affs=neutorch.train.affinity_map:main
         neutrain-affs-vol=neutorch.train.whole_brain_affinity_map:main
         neutrain-ba=neutorch.train.boundary_aug:main
+        neutorch-crop-bank=neutorch.data.crop_bank:main
+        neutorch-catalog=neutorch.data.catalog:main
     ''',
     classifiers=[
         'Development Status :: 4 - Beta',
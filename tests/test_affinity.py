@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from neutorch.data.affinity import HAS_NUMBA, PackedAffinityMap, \
+    remove_contact_xy, seg_to_affs
+
+
+METHODS = ['numpy'] + (['numba'] if HAS_NUMBA else [])
+
+
+def random_segmentation(shape: tuple, num_labels: int = 4, 
+        dtype: np.dtype = np.uint64, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, num_labels, size=shape).astype(dtype)
+
+
+def sequential_remove_contact_xy(seg: np.ndarray):
+    """the reference scan of reneu: C order and removed in place."""
+    seg = seg.copy()
+    sz, sy, sx = seg.shape
+    for z in range(sz):
+        for y in range(sy):
+            for x in range(sx):
+                label = seg[z, y, x]
+                if label == 0:
+                    continue
+                for neighbor in ((z, y-1, x), (z, y, x-1)):
+                    if min(neighbor) < 0:
+                        continue
+                    if seg[neighbor] > 0 and seg[neighbor] != label:
+                        seg[z, y, x] = 0
+                        seg[neighbor] = 0
+    return seg
+
+
+def dense_seg_to_affs(seg: np.ndarray):
+    sz, sy, sx = seg.shape
+    affs = np.zeros((3, sz-1, sy-1, sx-1), dtype=np.float32)
+    for z, y, x in np.ndindex(affs.shape[1:]):
+        label = seg[z+1, y+1, x+1]
+        if label > 0:
+            affs[0, z, y, x] = label == seg[z, y+1, x+1]
+            affs[1, z, y, x] = label == seg[z+1, y, x+1]
+            affs[2, z, y, x] = label == seg[z+1, y+1, x]
+    return affs
+
+
+def test_remove_contact_xy_is_sequential():
+    # the middle voxel does not contact the removed first one
+    seg = np.array([[[1, 2, 3]]], dtype=np.uint32)
+    for method in METHODS:
+        np.testing.assert_array_equal(
+            remove_contact_xy(seg.copy(), method=method), [[[0, 0, 3]]])
+
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('dtype', [np.uint8, np.int32, np.uint64])
+def test_remove_contact_xy(method, dtype):
+    for seed in range(20):
+        seg = random_segmentation((3, 7, 9), dtype=dtype, seed=seed)
+        expected = sequential_remove_contact_xy(seg)
+        result = remove_contact_xy(seg, method=method)
+        assert result is seg
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int32, np.uint64])
+def test_seg_to_affs(dtype):
+    seg = random_segmentation((6, 7, 9), dtype=dtype)
+    expected = dense_seg_to_affs(seg)
+    for method in METHODS:
+        np.testing.assert_array_equal(seg_to_affs(seg, method=method), expected)
+
+
+@pytest.mark.parametrize('block_size', [2, 32])
+def test_packed_affinity_map(block_size):
+    seg = random_segmentation((5, 6, 19))
+    packed = PackedAffinityMap.from_segmentation(seg, block_size=block_size)
+    affs = packed.cutout((0, 0, 0), seg.shape)
+    assert affs.shape == (3, *seg.shape)
+    # the packed affinity is aligned with the segmentation
+    np.testing.assert_array_equal(affs[:, 1:, 1:, 1:], seg_to_affs(seg))
+    np.testing.assert_array_equal(
+        packed.cutout((1, 2, 3), (3, 4, 13)), affs[:, 1:4, 2:6, 3:16])
+
+
+def test_packed_affinity_map_removes_contact_in_copy():
+    seg = random_segmentation((5, 6, 19))
+    original = seg.copy()
+    packed = PackedAffinityMap.from_segmentation(seg, block_size=2,
+        remove_contact=True)
+    np.testing.assert_array_equal(seg, original)
+
+    cleaned = remove_contact_xy(seg.copy())
+    affs = packed.cutout((0, 0, 0), seg.shape)
+    np.testing.assert_array_equal(affs[:, 1:, 1:, 1:], seg_to_affs(cleaned))
+    contact = packed.contact_cutout((1, 2, 3), (3, 4, 13))
+    np.testing.assert_array_equal(contact, 
+        (cleaned != seg)[1:4, 2:6, 3:16])
@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+from neutorch.data.buffer import BufferPool, get_buffer_pool
+from neutorch.data.patch import collate_batch
+
+
+def _pooled_patch(shape: tuple, value: int):
+    buffer_pool = get_buffer_pool()
+    image = buffer_pool.acquire(shape, np.float32)
+    label = buffer_pool.acquire(shape, np.float32)
+    image.fill(value)
+    label.fill(-value)
+    return torch.from_numpy(image), torch.from_numpy(label)
+
+
+def test_acquire_release():
+    buffer_pool = BufferPool(max_free_buffers=1)
+    buf = buffer_pool.acquire((2, 3), np.uint8)
+    assert buffer_pool.owns(buf)
+    assert not buffer_pool.owns(buf[:, :2])
+    assert buffer_pool.release(buf[:1])
+    # the same buffer is not released twice
+    assert not buffer_pool.release(buf)
+    assert buffer_pool.acquire((2, 3), np.uint8) is buf
+    # the arrays not acquired from the pool are ignored
+    assert not buffer_pool.release(np.zeros((2, 3), dtype=np.uint8))
+
+
+def test_collate_batch_shape():
+    shape = (1, 1, 4, 5, 6)
+    batch = collate_batch([_pooled_patch(shape, i) for i in range(3)])
+    assert len(batch) == 2
+    assert batch[0].shape == (3, 1, 4, 5, 6)
+    assert batch[1].shape == (3, 1, 4, 5, 6)
+
+
+def test_collate_batch_does_not_share_released_buffers():
+    shape = (1, 1, 4, 5, 7)
+    buffer_pool = get_buffer_pool()
+    for batch_size in (1, 3):
+        items = [_pooled_patch(shape, i + 1) for i in range(batch_size)]
+        pointers = {t.data_ptr() for item in items for t in item}
+        image, label = collate_batch(items)
+        assert image.data_ptr() not in pointers
+        assert label.data_ptr() not in pointers
+
+        # reuse all the released buffers for the next patches
+        reused = [buffer_pool.acquire(shape, np.float32) \
+            for _ in range(len(pointers))]
+        assert {b.ctypes.data for b in reused} == pointers
+        for buf in reused:
+            buf.fill(100)
+
+        expected = torch.arange(1, batch_size + 1, dtype=torch.float32)
+        expected = expected.reshape(-1, 1, 1, 1, 1).expand(image.shape)
+        torch.testing.assert_close(image, expected)
+        torch.testing.assert_close(label, -expected)
+        for buf in reused:
+            buffer_pool.release(buf)
@@ -0,0 +1,92 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.buffer import get_buffer_pool
+from neutorch.data.compressed import CompressedChunk, pack_bits, unpack_bits
+
+
+def random_segmentation(shape: tuple, num_labels: int, seed: int = 0):
+    """blocky segmentation with large label values."""
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(1, 2**40, size=num_labels, dtype=np.uint64)
+    seg = np.zeros(shape, dtype=np.uint64)
+    for label in labels:
+        z, y, x = (rng.integers(0, s) for s in shape[-3:])
+        seg[..., z:z+9, y:y+9, x:x+9] = label
+    return seg
+
+
+def assert_cutouts_equal(compressed: CompressedChunk, arr: np.ndarray,
+        voxel_offset: Cartesian, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    shape = np.asarray(arr.shape[-3:])
+    for _ in range(20):
+        start = rng.integers(0, shape)
+        stop = start + rng.integers(1, shape - start + 1)
+        bbox = BoundingBox(voxel_offset + Cartesian(*start),
+            voxel_offset + Cartesian(*stop))
+        cutout = compressed.cutout(bbox)
+        assert cutout.voxel_offset == bbox.start
+        np.testing.assert_array_equal(cutout.array, arr[...,
+            start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+        get_buffer_pool().release(cutout.array)
+
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8, 16, 32])
+def test_pack_bits_round_trip(bits):
+    rng = np.random.default_rng(bits)
+    values = rng.integers(0, 2**bits, size=1001, dtype=np.uint64)
+    data = pack_bits(values, bits)
+    np.testing.assert_array_equal(unpack_bits(data, bits, len(values)), values)
+
+
+@pytest.mark.parametrize('num_labels', [0, 1, 3, 40, 600])
+def test_segmentation_round_trip(num_labels):
+    arr = random_segmentation((37, 50, 45), num_labels, seed=num_labels)
+    voxel_offset = Cartesian(3, -5, 100)
+    compressed = CompressedChunk.from_chunk(
+        Chunk(arr, voxel_offset=voxel_offset), block_size=(16, 16, 16))
+    assert compressed.nbytes < arr.nbytes
+    np.testing.assert_array_equal(compressed.array, arr)
+    assert_cutouts_equal(compressed, arr, voxel_offset)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+def test_image_round_trip(dtype):
+    rng = np.random.default_rng(0)
+    arr = (rng.random((2, 20, 33, 40)) * 255).astype(dtype)
+    voxel_offset = Cartesian(0, 7, 11)
+    compressed = CompressedChunk.from_chunk(
+        Chunk(arr, voxel_offset=voxel_offset), block_size=(8, 16, 16))
+    assert compressed.shape == arr.shape
+    assert compressed.dtype == arr.dtype
+    np.testing.assert_array_equal(compressed.array, arr)
+    assert_cutouts_equal(compressed, arr, voxel_offset)
+
+
+def test_cache_and_pickle():
+    arr = random_segmentation((32, 32, 32), 10)
+    compressed = CompressedChunk.from_chunk(Chunk(arr),
+        block_size=(16, 16, 16), cache_size=2)
+    encoded_nbytes = compressed.nbytes
+    np.testing.assert_array_equal(compressed.array, arr)
+    # only the last decoded blocks are cached
+    assert len(compressed._cache) == 2
+    assert compressed.nbytes >= encoded_nbytes
+
+    copied = pickle.loads(pickle.dumps(compressed))
+    assert len(copied._cache) == 0
+    assert copied.nbytes == encoded_nbytes
+    np.testing.assert_array_equal(copied.array, arr)
+
+
+def test_cutout_outside_of_chunk():
+    compressed = CompressedChunk.from_chunk(
+        Chunk(np.zeros((8, 8, 8), dtype=np.uint8)))
+    with pytest.raises(AssertionError):
+        compressed.cutout(BoundingBox(Cartesian(0, 0, 0), Cartesian(9, 8, 8)))
@@ -0,0 +1,138 @@
+import numpy as np
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import Cartesian
+
+from neutorch.data.buffer import get_buffer_pool
+from neutorch.data.crop_bank import CropBank
+from neutorch.data.rng import seed_thread
+from neutorch.data.sample import CropBankSample
+from neutorch.data.synapses import PreSynapsesDataset
+from neutorch.data.transform import Compose
+
+
+VOXEL_OFFSET = Cartesian(100, 200, 300)
+CROP_SIZE = Cartesian(12, 16, 20)
+
+
+def random_images(shape: tuple = (40, 50, 60), version_num: int = 2, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [Chunk(rng.integers(0, 255, size=shape, dtype=np.uint8),
+        voxel_offset=VOXEL_OFFSET) for _ in range(version_num)]
+
+
+def random_synapses(num: int = 10, seed: int = 0):
+    """the global centers of crops inside the images and the points near them."""
+    rng = np.random.default_rng(seed)
+    offset = np.asarray(VOXEL_OFFSET)
+    margin = np.asarray(CROP_SIZE) // 2
+    centers = offset + margin + np.stack([rng.integers(0, s, size=num) \
+        for s in np.asarray((40, 50, 60)) - 2 * margin], axis=1)
+    points = np.concatenate([centers,
+        centers + rng.integers(-10, 10, size=centers.shape)], axis=0)
+    return centers, points
+
+
+def build_crop_bank(path: str):
+    images = random_images()
+    centers, points = random_synapses()
+    CropBank.build(path, images, centers, CROP_SIZE, points=points)
+    return images, centers, points
+
+
+def sort_points(points: np.ndarray):
+    return points[np.lexsort(points.T[::-1])]
+
+
+def dense_cubes(shape: tuple, points: np.ndarray, expand_distance: int):
+    label = np.full(shape, 0.05, dtype=np.float32)
+    for z, y, x in points:
+        label[max(z-expand_distance, 0) : z+expand_distance,
+              max(y-expand_distance, 0) : y+expand_distance,
+              max(x-expand_distance, 0) : x+expand_distance] = 0.95
+    return label
+
+
+def test_build_and_reopen(tmp_path):
+    images, centers, points = build_crop_bank(str(tmp_path))
+    crop_bank = CropBank.from_dir(str(tmp_path))
+    assert isinstance(crop_bank.images, np.memmap)
+    assert len(crop_bank) == len(centers)
+    assert crop_bank.version_num == len(images)
+    assert crop_bank.crop_size == CROP_SIZE
+
+    crop_size = np.asarray(CROP_SIZE)
+    np.testing.assert_array_equal(crop_bank.offsets, centers - crop_size // 2)
+    for idx, offset in enumerate(crop_bank.offsets):
+        start = offset - np.asarray(VOXEL_OFFSET)
+        stop = start + crop_size
+        for version, image in enumerate(images):
+            np.testing.assert_array_equal(crop_bank.images[idx, version],
+                image.array[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+        inside = np.all((points >= offset) & (points < offset + crop_size), axis=1)
+        np.testing.assert_array_equal(sort_points(crop_bank.points_in_crop(idx)),
+            sort_points(points[inside] - offset))
+
+
+def test_random_patch_matches_dense_rasterization(tmp_path):
+    build_crop_bank(str(tmp_path))
+    crop_bank = CropBank.from_dir(str(tmp_path))
+    output_patch_size = Cartesian(8, 12, 12)
+    # no spatial transform, the patch is the jittered crop
+    sample = CropBankSample.from_dir(str(tmp_path), output_patch_size,
+        transform=Compose([]))
+    assert sample.patch_size_before_transform == output_patch_size
+
+    labels = [dense_cubes(tuple(CROP_SIZE), crop_bank.points_in_crop(idx),
+        sample.expand_distance) for idx in range(len(crop_bank))]
+    seed_thread(0)
+    try:
+        for _ in range(20):
+            patch = sample.random_patch
+            # find the crop by the global offset of patch
+            start = np.asarray(patch.image.voxel_offset)
+            idx = [i for i, offset in enumerate(crop_bank.offsets) \
+                if np.all(start >= offset) and \
+                    np.all(start + np.asarray(output_patch_size) <= offset + np.asarray(CROP_SIZE))]
+            # the crops could overlap
+            assert len(idx) > 0
+            label = patch.label.array.reshape(tuple(output_patch_size))
+            expected = []
+            for i in idx:
+                local = start - crop_bank.offsets[i]
+                stop = local + np.asarray(output_patch_size)
+                expected.append(labels[i][local[0]:stop[0], local[1]:stop[1], local[2]:stop[2]])
+            assert any(np.array_equal(label, e) for e in expected)
+            get_buffer_pool().release(patch.image.array)
+            get_buffer_pool().release(patch.label.array)
+    finally:
+        seed_thread(None)
+
+
+def test_synapse_dataset_reads_crop_bank(tmp_path):
+    # the synapse file is not read and the volumes are not opened
+    syns_path = '/data/sample1/vol_0/syns_zyx_0-1_0-1_0-1.h5'
+    versions = {'sample1': ['/no/volume']}
+    patch_size = Cartesian(32, 32, 32)
+    empty = PreSynapsesDataset([], versions, patch_size=patch_size,
+        crop_bank_dir=str(tmp_path))
+    crop_size = empty.patch_size_before_transform
+    images = random_images(shape=tuple(crop_size * 2), version_num=1)
+    centers = np.asarray(VOXEL_OFFSET + crop_size)[np.newaxis, :]
+    CropBank.build(str(tmp_path / 'sample1' / 'syns_zyx_0-1_0-1_0-1'),
+        images, centers, crop_size)
+
+    dataset = PreSynapsesDataset([syns_path], versions, patch_size=patch_size,
+        crop_bank_dir=str(tmp_path))
+    assert len(dataset.vols) == 0
+    assert len(dataset.samples) == 1
+    sample = dataset.samples[0]
+    assert isinstance(sample, CropBankSample)
+    assert sample.transform is dataset.transform
+    assert sample.patch_size_before_transform == crop_size
+    seed_thread(0)
+    try:
+        patch = sample.random_patch
+    finally:
+        seed_thread(None)
+    assert patch.shape[-3:] == tuple(patch_size)
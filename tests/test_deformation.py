@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import Cartesian
+
+from neutorch.data.patch import Patch
+from neutorch.data.rng import seed_thread
+from neutorch.data.transform import AffineDeformation, ElasticDeformation
+
+
+OUTPUT_SIZE = Cartesian(8, 24, 24)
+
+
+def random_patch(transform, batch_size: int = 2, seed: int = 0):
+    """a patch whose size shrinks to OUTPUT_SIZE after the transform."""
+    shrink_size = np.asarray(transform.shrink_size)
+    shape = tuple(np.asarray(OUTPUT_SIZE) + shrink_size[:3] + shrink_size[3:])
+    rng = np.random.default_rng(seed)
+    image = rng.random((batch_size, 1, *shape)).astype(np.float32)
+    # the large ids could not be represented by float
+    label = rng.integers(2**60, 2**60 + 5, size=(batch_size, 1, *shape),
+        dtype=np.uint64)
+    return Patch(Chunk(image), Chunk(label))
+
+
+def deformations():
+    return [
+        AffineDeformation(patch_size=OUTPUT_SIZE, max_rotation=20.,
+            max_scaling=1.2, max_shear=0.1),
+        ElasticDeformation(max_displacement=(1., 3., 3.),
+            control_point_spacing=(4, 8, 8)),
+    ]
+
+
+def center_crop(arr: np.ndarray, margin: tuple):
+    return arr[..., margin[0]:arr.shape[-3]-margin[3],
+        margin[1]:arr.shape[-2]-margin[4], margin[2]:arr.shape[-1]-margin[5]]
+
+
+@pytest.mark.parametrize('transform', deformations(), ids=str)
+def test_zero_displacement_returns_center_crop(transform, monkeypatch):
+    if isinstance(transform, AffineDeformation):
+        monkeypatch.setattr(transform, 'random_matrix', lambda: np.eye(2))
+    else:
+        transform.max_displacement = transform.max_displacement * 0.
+    patch = random_patch(transform)
+    image = patch.image.array.copy()
+    label = patch.label.array.copy()
+    transform.transform(patch)
+    np.testing.assert_allclose(patch.image.array,
+        center_crop(image, transform.shrink_size), atol=1e-5)
+    np.testing.assert_array_equal(patch.label.array,
+        center_crop(label, transform.shrink_size))
+
+
+@pytest.mark.parametrize('transform', deformations(), ids=str)
+def test_nearest_resampling_keeps_ids(transform):
+    patch = random_patch(transform, seed=1)
+    ids = np.unique(patch.label.array)
+    seed_thread(0)
+    try:
+        transform.transform(patch)
+    finally:
+        seed_thread(None)
+    assert patch.label.array.dtype == np.uint64
+    assert np.all(np.isin(patch.label.array, ids))
+
+
+@pytest.mark.parametrize('transform', deformations(), ids=str)
+def test_shrink_size_matches_the_output(transform):
+    for probability in (1., 1e-9):
+        # the patch is shrinked by the same size if it is not transformed
+        transform.probability = probability
+        patch = random_patch(transform)
+        input_start = patch.image.voxel_offset
+        transform(patch)
+        assert patch.image.shape[-3:] == tuple(OUTPUT_SIZE)
+        assert patch.label.shape[-3:] == tuple(OUTPUT_SIZE)
+        assert patch.image.voxel_offset == \
+            input_start + Cartesian(*transform.shrink_size[:3])
+
+
+def test_affine_deformation_rejects_other_patch_size():
+    transform = AffineDeformation(patch_size=Cartesian(8, 16, 16))
+    patch = random_patch(transform)
+    with pytest.raises(AssertionError):
+        transform.transform(patch)
+
+
+def test_elastic_deformation_follows_the_thread_seed():
+    transform = ElasticDeformation()
+    results = []
+    for _ in range(2):
+        seed_thread(3)
+        try:
+            results.append(transform.sampling_coordinates(2, (8, 24, 24)))
+        finally:
+            seed_thread(None)
+    assert np.array_equal(results[0].numpy(), results[1].numpy())
@@ -0,0 +1,48 @@
+import pickle
+import threading
+from time import sleep
+
+from neutorch.data.lazy import locked_cached_property, LOCK_ATTRIBUTE, \
+    drop_object_lock
+
+
+class _Slow(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __getstate__(self):
+        return drop_object_lock(self.__dict__.copy())
+
+    @locked_cached_property
+    def value(self):
+        self.calls += 1
+        # give the other threads time to miss the cache
+        sleep(0.05)
+        return self.nested + 1
+
+    @locked_cached_property
+    def nested(self):
+        return 41
+
+
+def test_locked_cached_property_computes_once():
+    obj = _Slow()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(obj.value)) \
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [42] * 8
+    assert obj.calls == 1
+
+
+def test_locked_cached_property_pickles_without_lock():
+    obj = _Slow()
+    assert obj.value == 42
+    assert LOCK_ATTRIBUTE in obj.__dict__
+    copied = pickle.loads(pickle.dumps(obj))
+    assert LOCK_ATTRIBUTE not in copied.__dict__
+    assert copied.value == 42
+    assert copied.calls == 1
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import Cartesian
+
+from neutorch.data.dataset import DatasetBase
+from neutorch.data.loader import ThreadDataLoader
+from neutorch.data.patch import Patch
+from neutorch.data.rng import random
+from neutorch.data.sample import AbstractSample
+
+
+PATCH_SIZE = Cartesian(4, 8, 8)
+
+
+class RandomCutoutSample(AbstractSample):
+    def __init__(self, image: np.ndarray, label: np.ndarray):
+        """cut out random patches from the arrays without any transform."""
+        super().__init__(output_patch_size=PATCH_SIZE)
+        self.image = image
+        self.label = label
+
+    @property
+    def random_patch(self):
+        start = tuple(random.randint(0, s - p) for s, p in zip(
+            self.image.shape, PATCH_SIZE))
+        slices = tuple(slice(s, s + p) for s, p in zip(start, PATCH_SIZE))
+        return Patch(
+            Chunk(self.image[slices][np.newaxis, np.newaxis, ...].copy(),
+                voxel_offset=Cartesian(*start)),
+            Chunk(self.label[slices][np.newaxis, np.newaxis, ...].copy(),
+                voxel_offset=Cartesian(*start)),
+        )
+
+
+class FailingSample(RandomCutoutSample):
+    @property
+    def random_patch(self):
+        raise RuntimeError('failed to read the patch.')
+
+
+def tiny_dataset(sample_class=RandomCutoutSample, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    image = rng.random((12, 20, 20)).astype(np.float32)
+    label = (rng.random(image.shape) > 0.5).astype(np.float32)
+    return DatasetBase([sample_class(image, label)])
+
+
+def test_batch_shape():
+    loader = ThreadDataLoader(tiny_dataset(), batch_size=3, num_workers=2, seed=0)
+    try:
+        for _ in range(4):
+            image, label = next(loader)
+            assert image.shape == (3, 1, *PATCH_SIZE)
+            assert label.shape == (3, 1, *PATCH_SIZE)
+    finally:
+        loader.close()
+
+
+def test_exception_is_reraised():
+    loader = ThreadDataLoader(tiny_dataset(FailingSample), num_workers=2)
+    try:
+        with pytest.raises(RuntimeError, match='failed to read the patch'):
+            next(loader)
+    finally:
+        loader.close()
+
+
+def test_close_unblocks_producers():
+    loader = ThreadDataLoader(tiny_dataset(), num_workers=2, prefetch_factor=1)
+    next(loader)
+    # the producers are blocked on the full queue
+    deadline = time.time() + 10.
+    while not loader._queue.full():
+        assert time.time() < deadline, 'the queue is never filled.'
+        time.sleep(0.01)
+    threads = list(loader._threads)
+    assert all(thread.is_alive() for thread in threads)
+
+    closing = threading.Thread(target=loader.close, daemon=True)
+    closing.start()
+    closing.join(timeout=10.)
+    assert not closing.is_alive()
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_same_seed_same_batches():
+    dataset = tiny_dataset()
+    batches = []
+    for _ in range(2):
+        loader = ThreadDataLoader(dataset, batch_size=2, num_workers=1, seed=3)
+        try:
+            batches.append([next(loader) for _ in range(5)])
+        finally:
+            loader.close()
+    for batch0, batch1 in zip(*batches):
+        for tensor0, tensor1 in zip(batch0, batch1):
+            assert torch.equal(tensor0, tensor1)
+    # the batches are not all the same patch
+    assert not torch.equal(batches[0][0][0], batches[0][1][0])
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.mask_integral import MaskIntegral
+from neutorch.data.rng import seed_thread
+
+
+VOXEL_OFFSET = Cartesian(2, -3, 5)
+
+
+def random_mask(shape: tuple = (12, 15, 17), seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.random(shape) > 0.4).astype(np.uint8)
+
+
+def brute_force_count(mask: np.ndarray, start: np.ndarray, stop: np.ndarray):
+    start = np.clip(start - np.asarray(VOXEL_OFFSET), 0, mask.shape)
+    stop = np.clip(stop - np.asarray(VOXEL_OFFSET), start, mask.shape)
+    return int(np.count_nonzero(mask[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]))
+
+
+def test_count_matches_brute_force():
+    mask = random_mask()
+    integral = MaskIntegral.from_mask(Chunk(mask, voxel_offset=VOXEL_OFFSET),
+        Cartesian(1, 1, 1))
+    assert integral.shape == mask.shape
+    rng = np.random.default_rng(1)
+    offset = np.asarray(VOXEL_OFFSET)
+    for _ in range(200):
+        # the boxes could be partly or completely outside of the mask
+        start = offset + rng.integers(-4, 20, size=3)
+        stop = start + rng.integers(0, 12, size=3)
+        assert integral.count(start, stop) == brute_force_count(mask, start, stop)
+
+
+@pytest.mark.parametrize('threshold', [0.3, 0.6, 0.8])
+def test_candidate_starts_match_brute_force(threshold):
+    mask = random_mask(seed=2)
+    factor = Cartesian(2, 4, 4)
+    patch_size = Cartesian(6, 8, 12)
+    integral = MaskIntegral.from_mask(Chunk(mask, voxel_offset=VOXEL_OFFSET), factor)
+    region = BoundingBox(Cartesian(4, -12, 20), Cartesian(28, 60, 88))
+    candidates = integral.candidate_starts(patch_size, threshold, region)
+
+    box_size = np.asarray((3, 2, 3))
+    expected = []
+    for start in np.ndindex(*(np.asarray(mask.shape) - box_size + 1)):
+        start = np.asarray(start) + np.asarray(VOXEL_OFFSET)
+        patch_start = start * np.asarray(factor)
+        inside = np.all(patch_start >= np.asarray(region.start)) and \
+            np.all(patch_start + np.asarray(patch_size) <= np.asarray(region.stop))
+        count = brute_force_count(mask, start, start + box_size)
+        if inside and count >= threshold * np.prod(box_size):
+            expected.append(start)
+    np.testing.assert_array_equal(candidates, np.asarray(expected).reshape(-1, 3))
+
+
+def test_random_patch_bbox_is_covered():
+    mask = random_mask(seed=3)
+    factor = Cartesian(2, 4, 4)
+    patch_size = Cartesian(6, 8, 12)
+    threshold = 0.5
+    integral = MaskIntegral.from_mask(Chunk(mask, voxel_offset=VOXEL_OFFSET), factor)
+    region = BoundingBox(Cartesian(4, -12, 20), Cartesian(28, 60, 88))
+    seed_thread(0)
+    try:
+        for _ in range(100):
+            bbox = integral.random_patch_bbox(patch_size, threshold, region)
+            assert tuple(bbox.stop - bbox.start) == tuple(patch_size)
+            assert np.all(np.asarray(bbox.start) >= np.asarray(region.start))
+            assert np.all(np.asarray(bbox.stop) <= np.asarray(region.stop))
+            assert integral.coverage(bbox) >= threshold
+    finally:
+        seed_thread(None)
+
+
+def test_from_volume_caches_the_table(tmp_path):
+    mask = Chunk(random_mask(seed=4), voxel_offset=VOXEL_OFFSET)
+    path = str(tmp_path / 'mask_integral.npz')
+    integral = MaskIntegral.from_volume(mask, Cartesian(1, 1, 1), path=path)
+    loaded = MaskIntegral.from_volume(None, Cartesian(1, 1, 1), path=path)
+    np.testing.assert_array_equal(loaded.table, integral.table)
+    assert loaded.voxel_offset == integral.voxel_offset
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import BoundingBox, Cartesian
+
+from neutorch.data.sample import OrganelleSample
+
+
+def baseline_remap(label: np.ndarray, skip_classes: list, selected_classes: list):
+    """the remapping of the whole label at construction before the lookup table."""
+    label = label.copy()
+    if skip_classes is not None:
+        for class_idx in skip_classes:
+            label[label>class_idx] -= 1
+    if selected_classes is not None:
+        label = np.isin(label, selected_classes)
+    return label
+
+
+def organelle_sample(label: np.ndarray, **kwargs):
+    image = Chunk(np.zeros(label.shape, dtype=np.uint8))
+    return OrganelleSample([image], Chunk(label), Cartesian(8, 8, 8),
+        num_classes=8, **kwargs)
+
+
+@pytest.mark.parametrize('skip_classes, selected_classes', [
+    (None, None),
+    ([2], None),
+    ([1, 4], None),
+    (None, [1, 3]),
+    ([3], [2, 5]),
+])
+def test_label_lut_matches_baseline(skip_classes, selected_classes):
+    rng = np.random.default_rng(0)
+    label = rng.integers(0, 8, size=(16, 20, 24)).astype(np.uint32)
+    original = label.copy()
+    sample = organelle_sample(label,
+        skip_classes=skip_classes, selected_classes=selected_classes)
+    expected = baseline_remap(label, skip_classes, selected_classes)
+
+    for _ in range(10):
+        start = rng.integers(0, np.asarray(label.shape) - 8 + 1)
+        bbox = BoundingBox.from_delta(Cartesian(*start), Cartesian(8, 8, 8))
+        image_patch = sample.images[0].cutout(bbox)
+        label_patch = sample.label_patch_from_bbox(bbox, image_patch)
+        stop = start + 8
+        np.testing.assert_array_equal(
+            label_patch.array.reshape(8, 8, 8),
+            expected[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+
+    # the shared label is not modified
+    np.testing.assert_array_equal(sample.label.array, original)
+
+
+def test_label_lut_is_extended():
+    sample = organelle_sample(np.zeros((8, 8, 8), dtype=np.uint32),
+        skip_classes=[1])
+    assert len(sample.label_lut(3)) == 4
+    lut = sample.label_lut(9)
+    np.testing.assert_array_equal(lut,
+        baseline_remap(np.arange(10, dtype=np.uint32), [1], None))
+
+
+@pytest.mark.parametrize('skip_classes, selected_classes', [
+    (None, None),
+    ([1, 4], None),
+    ([3], [2, 5]),
+])
+def test_class_counts_match_baseline(skip_classes, selected_classes):
+    rng = np.random.default_rng(1)
+    label = rng.integers(0, 8, size=(16, 20, 24)).astype(np.uint32)
+    sample = organelle_sample(label,
+        skip_classes=skip_classes, selected_classes=selected_classes)
+    expected = baseline_remap(label, skip_classes, selected_classes)
+    np.testing.assert_array_equal(sample.class_counts,
+        np.bincount(expected.astype(np.int64).ravel(), minlength=8))
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from neutorch.data.points import PointGridIndex, group_to_csr, paint_cubes
+
+
+def random_points(num: int, shape: tuple, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.integers(0, s, size=num) for s in shape], axis=1)
+
+
+def dense_cubes(shape: tuple, points: np.ndarray, expand_distance: int):
+    """paint the cubes of all the points one by one and clip them to the array."""
+    label = np.full(shape, 0.05, dtype=np.float32)
+    for z, y, x in points:
+        label[max(z-expand_distance, 0) : z+expand_distance,
+              max(y-expand_distance, 0) : y+expand_distance,
+              max(x-expand_distance, 0) : x+expand_distance] = 0.95
+    return label
+
+
+@pytest.mark.parametrize('cell_size', [(4, 4, 4), (7, 16, 5), (64, 64, 64)])
+def test_query_matches_brute_force(cell_size):
+    points = random_points(500, (40, 50, 60))
+    index = PointGridIndex(points, cell_size=cell_size)
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        start = rng.integers(-10, 50, size=3)
+        stop = start + rng.integers(0, 30, size=3)
+        inside = np.all((points >= start) & (points < stop), axis=1)
+        indices = index.query(start, stop, return_indices=True)
+        np.testing.assert_array_equal(np.sort(indices), np.nonzero(inside)[0])
+        found = index.query(start, stop)
+        np.testing.assert_array_equal(
+            found[np.lexsort(found.T[::-1])],
+            points[inside][np.lexsort(points[inside].T[::-1])])
+
+
+def test_query_empty_index():
+    index = PointGridIndex(np.zeros((0, 3), dtype=np.int64))
+    assert len(index.query((0, 0, 0), (10, 10, 10))) == 0
+
+
+@pytest.mark.parametrize('expand_distance', [1, 2, 3])
+def test_patch_label_matches_dense_rasterization(expand_distance):
+    shape = (32, 40, 48)
+    points = random_points(200, shape, seed=2)
+    dense = dense_cubes(shape, points, expand_distance)
+    index = PointGridIndex(points, cell_size=(8, 8, 8))
+    patch_shape = np.asarray((12, 16, 20))
+    rng = np.random.default_rng(3)
+    for _ in range(20):
+        start = rng.integers(0, np.asarray(shape) - patch_shape + 1)
+        # the cubes of points outside of patch could also cover the patch
+        near = index.query(start - expand_distance,
+            start + patch_shape + expand_distance)
+        label = np.full(tuple(patch_shape), 0.05, dtype=np.float32)
+        paint_cubes(label, near - start, expand_distance, 0.95)
+        stop = start + patch_shape
+        np.testing.assert_array_equal(label,
+            dense[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+
+
+def test_group_to_csr():
+    groups = np.array([2, 0, 2, 1, 0, 2])
+    indptr, indices = group_to_csr(groups, 4)
+    np.testing.assert_array_equal(indptr, [0, 2, 3, 6, 6])
+    for group in range(4):
+        members = indices[indptr[group] : indptr[group+1]]
+        np.testing.assert_array_equal(members, np.nonzero(groups == group)[0])
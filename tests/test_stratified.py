@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from chunkflow.lib.cartesian_coordinate import Cartesian
+
+from neutorch.data.rng import seed_thread
+from neutorch.data.stratified import AliasTable, BlockClassIndex
+
+
+def table_probabilities(table: AliasTable) -> np.ndarray:
+    """the exact probability of every index drawn from the table."""
+    num = len(table)
+    probabilities = table.prob.copy()
+    np.add.at(probabilities, table.alias, 1. - table.prob)
+    return probabilities / num
+
+
+@pytest.mark.parametrize('weights', [
+    [1.],
+    [1., 1., 1., 1.],
+    [0., 3., 0., 1.],
+    [5., 1e-3, 2., 0., 7., 0.5],
+    np.random.default_rng(0).random(100),
+])
+def test_alias_table_probabilities(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    table = AliasTable(weights)
+    np.testing.assert_allclose(table_probabilities(table),
+        weights / weights.sum(), atol=1e-12)
+
+
+def test_alias_table_frequencies():
+    weights = np.array([0., 1., 2., 3., 4., 0.])
+    table = AliasTable(weights)
+    seed_thread(0)
+    try:
+        draws = np.array([table.sample() for _ in range(100000)])
+    finally:
+        seed_thread(None)
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+    assert frequencies[0] == 0 and frequencies[-1] == 0
+    np.testing.assert_allclose(frequencies, weights / weights.sum(), atol=0.01)
+
+
+def test_alias_table_rejects_zero_weights():
+    with pytest.raises(AssertionError):
+        AliasTable(np.zeros((3,)))
+
+
+def test_block_class_index_centers_cover_the_class():
+    # 4x4x4 blocks of 8 voxels and the class 1 only in one block
+    class_counts = np.zeros((4, 4, 4, 2), dtype=np.int64)
+    class_counts[..., 0] = 8 ** 3
+    class_counts[1, 2, 3, 1] = 10
+    index = BlockClassIndex(class_counts, Cartesian(8, 8, 8),
+        center_start=Cartesian(4, 4, 4), center_stop=Cartesian(29, 29, 29),
+        patch_start=Cartesian(-4, -4, -4), patch_stop=Cartesian(12, 12, 12))
+    block_start = np.array([8, 16, 24])
+    assert index.class_weight(1) > 0
+    seed_thread(0)
+    try:
+        for _ in range(100):
+            center = np.asarray(index.random_center(1))
+            assert np.all(center >= 4) and np.all(center < 29)
+            # the patch covers the whole block containing the class
+            assert np.all(center - 4 <= block_start)
+            assert np.all(center + 12 >= block_start + 8)
+    finally:
+        seed_thread(None)